@@ -0,0 +1,237 @@
+"""
+Popularity and trend analytics, answered from precomputed daily rollups.
+
+Loan activity comes from the loan_events outbox (see counters.py). Each run
+re-aggregates the UTC days that received events since the last run and writes
+them with $merge into two rollup collections:
+
+    analytics_book_daily       _id {day, book_id}: category_key, borrows, renewals, returns
+    analytics_category_daily   _id {day, category_key}: borrows, renewals, returns
+
+A touched day is recomputed from all of its events and replaces the stored
+documents, so an interrupted run (or two runs at once) never counts an event
+twice. Books are counted under their current category; the category rollups of
+the touched days are rebuilt from scratch, so a recategorized book leaves
+nothing behind under its old category. The run then refreshes, from the rollups:
+
+- the most borrowed books of the last 7 and 30 days, kept in one app_meta
+  document that /analytics/top reads;
+- each book's popularity (its borrows in the last ANALYTICS_POPULARITY_DAYS
+  days), which the catalog's sort by popularity uses.
+
+Usage (e.g. every few minutes from cron):
+    python analytics.py [--full]
+"""
+import argparse
+import json
+import sys
+from datetime import datetime, timedelta, timezone
+
+from bson.objectid import ObjectId
+
+from config import (
+    LOAN_EVENTS_COLLECTION_NAME, LOAN_EVENT_LAG_SECONDS,
+    ANALYTICS_POPULARITY_DAYS, ANALYTICS_TOP_MAX, ANALYTICS_TREND_MAX_DAYS
+)
+from models import ensure_collection_indexes, normalize_category, LOAN_BORROWED, LOAN_RENEWED, LOAN_RETURNED
+
+# Windows of the precomputed top lists: name -> days (today included)
+TOP_WINDOWS = {'week': 7, 'month': 30}
+
+# Rollup field -> loan event type it counts
+ROLLUP_FIELDS = {'borrows': LOAN_BORROWED, 'renewals': LOAN_RENEWED, 'returns': LOAN_RETURNED}
+
+
+def day_key(value):
+    """The rollup key ('YYYY-MM-DD') of a date or datetime."""
+    return value.strftime('%Y-%m-%d')
+
+
+class LoanAnalytics:
+    """Maintains the daily loan rollups, the top lists and book popularity, and reads them."""
+
+    BOOK_DAILY_COLLECTION = 'analytics_book_daily'
+    CATEGORY_DAILY_COLLECTION = 'analytics_category_daily'
+
+    # (name, keys, options) for the indexes on the rollup collections
+    BOOK_DAILY_INDEXES = [
+        # The rollups of a range of days (top lists, popularity, category rollup)
+        ('day', [('day', 1)], {})
+    ]
+    CATEGORY_DAILY_INDEXES = [
+        # A category's days in order (get_category_trend)
+        ('category_day', [('category_key', 1), ('day', 1)], {})
+    ]
+
+    CHECKPOINT_ID = 'analytics'
+    TOP_ID = 'analytics_top'
+
+    def __init__(self, connection, book_model, lag_seconds=LOAN_EVENT_LAG_SECONDS):
+        self.connection = connection
+        # The Book model, whose popularity field the runs keep up to date
+        self.book_model = book_model
+        self.lag_seconds = lag_seconds
+
+    @property
+    def events_collection(self):
+        return self.connection.db[LOAN_EVENTS_COLLECTION_NAME]
+
+    @property
+    def book_daily_collection(self):
+        return self.connection.db[self.BOOK_DAILY_COLLECTION]
+
+    @property
+    def category_daily_collection(self):
+        return self.connection.db[self.CATEGORY_DAILY_COLLECTION]
+
+    @property
+    def meta_collection(self):
+        return self.connection.db['app_meta']
+
+    def ensure_indexes(self):
+        """Creates and verifies the indexes on the rollup collections."""
+        return (ensure_collection_indexes(self.book_daily_collection, self.BOOK_DAILY_INDEXES)
+                + ensure_collection_indexes(self.category_daily_collection, self.CATEGORY_DAILY_INDEXES))
+
+    # --- Rollups ---
+
+    def run(self, full=False, now=None):
+        """
+        Rolls up the days with new events (every retained day if full or on the first run),
+        then refreshes the top lists and popularity. Returns the statistics as a dictionary.
+        """
+        now = now or datetime.now(timezone.utc)
+        # Events younger than the lag may have older ones still in open transactions
+        horizon = ObjectId.from_datetime(now - timedelta(seconds=self.lag_seconds))
+        checkpoint = self.meta_collection.find_one({'_id': self.CHECKPOINT_ID}) or {}
+        last_event_id = None if full else checkpoint.get('last_event_id')
+
+        query = {'_id': {'$lt': horizon}}
+        if last_event_id is not None:
+            query['_id']['$gt'] = last_event_id
+        first = self.events_collection.find_one(query, sort=[('_id', 1)])
+        stats = {'days': 0}
+
+        if first:
+            last = self.events_collection.find_one(query, sort=[('_id', -1)])
+            since = datetime.combine(first['at'].date(), datetime.min.time())
+            stats['days'] = (now.date() - since.date()).days + 1
+            self._roll_up(since, now)
+            self.meta_collection.update_one(
+                {'_id': self.CHECKPOINT_ID},
+                {'$set': {'last_event_id': last['_id'], 'updated_at': now}},
+                upsert=True
+            )
+
+        stats['top'] = self.refresh_top(now)
+        stats['popularity_changed'] = self.refresh_popularity(now)
+        return stats
+
+    def _roll_up(self, since, now):
+        """Recomputes the book and category rollups of every day from since, with two $merge aggregations."""
+        counts = {
+            field: {'$sum': {'$cond': [{'$eq': ['$type', event_type]}, 1, 0]}}
+            for field, event_type in ROLLUP_FIELDS.items()
+        }
+
+        # Events per (day, book), with the book's category, replace the stored rollups of those days
+        self.events_collection.aggregate([
+            {'$match': {'at': {'$gte': since}}},
+            {'$group': {'_id': {'day': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$at'}}, 'book_id': '$book_id'}, **counts}},
+            # Loans store the book id as a string
+            {'$set': {'book_object_id': {'$convert': {'input': '$_id.book_id', 'to': 'objectId', 'onError': None}}}},
+            {'$lookup': {'from': self.book_model.collection.name, 'localField': 'book_object_id', 'foreignField': '_id', 'as': 'book'}},
+            {'$project': {
+                'day': '$_id.day',
+                'book_id': '$_id.book_id',
+                'category_key': {'$ifNull': [{'$arrayElemAt': ['$book.category_key', 0]}, normalize_category(None)]},
+                **{field: 1 for field in ROLLUP_FIELDS},
+                'updated_at': {'$literal': now}
+            }},
+            {'$merge': {'into': self.BOOK_DAILY_COLLECTION, 'on': '_id', 'whenMatched': 'replace', 'whenNotMatched': 'insert'}}
+        ])
+
+        # The category rollups of the same days, from the book rollups just written. They are
+        # cleared first: a book that changed category leaves no row under the old one to merge over
+        self.category_daily_collection.delete_many({'day': {'$gte': day_key(since)}})
+        self.book_daily_collection.aggregate([
+            {'$match': {'day': {'$gte': day_key(since)}}},
+            {'$group': {
+                '_id': {'day': '$day', 'category_key': '$category_key'},
+                **{field: {'$sum': f'${field}'} for field in ROLLUP_FIELDS}
+            }},
+            {'$project': {
+                'day': '$_id.day',
+                'category_key': '$_id.category_key',
+                **{field: 1 for field in ROLLUP_FIELDS},
+                'updated_at': {'$literal': now}
+            }},
+            {'$merge': {'into': self.CATEGORY_DAILY_COLLECTION, 'on': '_id', 'whenMatched': 'replace', 'whenNotMatched': 'insert'}}
+        ])
+
+    def _window_borrows(self, days, now, limit=None):
+        """Returns [{'book_id', 'borrows'}] summed over the last days days, most borrowed first."""
+        pipeline = [
+            {'$match': {'day': {'$gte': day_key(now - timedelta(days=days - 1))}, 'borrows': {'$gt': 0}}},
+            {'$group': {'_id': '$book_id', 'borrows': {'$sum': '$borrows'}}},
+            {'$sort': {'borrows': -1, '_id': 1}}
+        ]
+        if limit:
+            pipeline.append({'$limit': limit})
+        pipeline.append({'$project': {'_id': 0, 'book_id': '$_id', 'borrows': 1}})
+        return list(self.book_daily_collection.aggregate(pipeline))
+
+    def refresh_top(self, now=None):
+        """Recomputes the top ANALYTICS_TOP_MAX books of each window into one app_meta document."""
+        now = now or datetime.now(timezone.utc)
+        top = {window: self._window_borrows(days, now, limit=ANALYTICS_TOP_MAX) for window, days in TOP_WINDOWS.items()}
+        self.meta_collection.update_one({'_id': self.TOP_ID}, {'$set': dict(top, updated_at=now)}, upsert=True)
+        return {window: len(books) for window, books in top.items()}
+
+    def refresh_popularity(self, now=None):
+        """Sets each book's popularity to its borrows in the last ANALYTICS_POPULARITY_DAYS days."""
+        now = now or datetime.now(timezone.utc)
+        scores = {entry['book_id']: entry['borrows'] for entry in self._window_borrows(ANALYTICS_POPULARITY_DAYS, now)}
+        return self.book_model.update_popularity(scores)
+
+    # --- Reading ---
+
+    def get_top(self, window='week', limit=10):
+        """Returns [{'book_id', 'borrows'}] for the most borrowed books of a window ('week' or 'month')."""
+        top = self.meta_collection.find_one({'_id': self.TOP_ID}, {window: 1}) or {}
+        return top.get(window, [])[:limit]
+
+    def get_category_trend(self, category, days=30, today=None):
+        """Returns [{'day', 'borrows', 'renewals', 'returns'}] of a category for the last days days, oldest first."""
+        today = (today or datetime.now(timezone.utc)).date()
+        days = max(1, min(days, ANALYTICS_TREND_MAX_DAYS))
+        keys = [day_key(today - timedelta(days=offset)) for offset in range(days - 1, -1, -1)]
+        found = {
+            doc['day']: doc for doc in self.category_daily_collection.find(
+                {'category_key': normalize_category(category), 'day': {'$gte': keys[0], '$lte': keys[-1]}}
+            )
+        }
+        return [{'day': key, **{field: found.get(key, {}).get(field, 0) for field in ROLLUP_FIELDS}} for key in keys]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Roll up loan events into daily analytics and refresh popularity.")
+    parser.add_argument('--full', action='store_true', help="Recompute every day still in the event outbox")
+    args = parser.parse_args(argv)
+
+    from db import MongoConnection
+    from models import create_models
+
+    connection = MongoConnection.from_config()
+    analytics = LoanAnalytics(connection, create_models(connection)['book_model'])
+    try:
+        stats = analytics.run(full=args.full)
+    finally:
+        connection.close()
+
+    print(json.dumps(stats, default=str))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
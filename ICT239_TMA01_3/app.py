@@ -1,160 +1,519 @@
-import math
-from flask import Flask, render_template, request, abort, session, redirect, url_for, flash, redirect, url_for
-# This import is necessary for the CATEGORY_CHOICES in NewBookForm
-from books_data import ALL_CATEGORIES 
-# RESTORED: Import book_model, user_model, and loan_model instance/module
-from models import book_model, user_model, loan_model
-from flask_wtf import FlaskForm
-from wtforms import (
-    StringField, TextAreaField, IntegerField, SelectMultipleField, SubmitField, 
-    FieldList, FormField, SelectField
-)
-from wtforms.validators import DataRequired, URL, NumberRange, Optional, Length
+from datetime import datetime, timedelta, timezone
 from functools import wraps
-import re # Import regex for number validation
-# CORRECTED: Only one combined import line for datetime and timedelta, and one for random.
-# We are importing the 'datetime' class from the 'datetime' module here.
-from datetime import datetime, timedelta 
-import random 
+import hashlib
+import io
+import json
+import os
+import random
+import time
+
+from flask import Flask, Blueprint, current_app, g, render_template, request, abort, session, redirect, url_for, flash, jsonify, make_response, send_from_directory
+from markupsafe import Markup
+from werkzeug.local import LocalProxy
+
+# Category names for the category search on the Book Titles page
+from books_data import ALL_CATEGORIES
+from config import (
+    CATALOG_PAGE_SIZE, CATALOG_MAX_PAGE_SIZE,
+    CARD_CACHE_MAX_ENTRIES, CARD_CACHE_TTL_SECONDS, AVAILABILITY_MAX_IDS,
+    ACTIVE_LOANS_SESSION_TTL_SECONDS,
+    SEARCH_SYNC_INTERVAL_SECONDS, SUGGEST_MAX_RESULTS,
+    IMPORT_BATCH_SIZE, IMPORT_ERRORS_DIR, OVERDUE_REPORT_LIMIT, MY_LOANS_PAGE_SIZE,
+    ANALYTICS_POPULARITY_DAYS, ANALYTICS_TOP_MAX, ANALYTICS_TREND_MAX_DAYS, REFUSE_OVERDUE_RENEWALS
+)
+from db import MongoConnection
+from models import create_models, normalize_filters, normalize_category, PAGE_RANGES
+# Form classes live in forms.py so the bulk importer can share the validation rules
+from forms import NewBookForm
+from cache import CatalogCache, MISSING
+from search import SearchIndex, SuggestIndex
+from bulk_import import ErrorFile, run_import, detect_format
+from overdue import OverdueScanner
+from counters import LoanCounters
+from analytics import LoanAnalytics
+from recommendations import BookRecommender
+
+# Every route lives on this blueprint; create_app registers it on each app
+library = Blueprint('library', __name__)
+
+# Placeholders left in a cached card for the numbers that change with every loan
+COPIES_PLACEHOLDER = '%%COPIES%%'
+AVAILABLE_PLACEHOLDER = '%%AVAILABLE%%'
+
+
+def create_app(config=None):
+    """
+    Application factory. config (a mapping or an object with upper-case attributes)
+    overrides the defaults in config.py.
+
+    No MongoDB connection is opened here: the models share one db.MongoConnection,
+    which creates the MongoClient of each worker process on its first query (after
+    fork under a pre-fork server such as gunicorn).
+    """
+    app = Flask(__name__)
+    app.config.from_object('config')
+    if isinstance(config, dict):
+        app.config.from_mapping(config)
+    elif config is not None:
+        app.config.from_object(config)
+
+    connection = MongoConnection.from_config(app.config)
+    models = create_models(connection)
+
+    # In-memory search index, built on the first search, then kept current as books are added
+    search_index = SearchIndex(sync_interval_seconds=SEARCH_SYNC_INTERVAL_SECONDS)
+    models['book_model'].add_insert_listener(search_index.add_document)
+
+    # Title/author autocomplete; built lazily on the first /suggest request
+    suggest_index = SuggestIndex(sync_interval_seconds=SEARCH_SYNC_INTERVAL_SECONDS)
+    models['book_model'].add_insert_listener(suggest_index.add_book)
+
+    app.extensions['library'] = dict(
+        models,
+        connection=connection,
+        search_index=search_index,
+        suggest_index=suggest_index,
+        overdue_scanner=OverdueScanner(connection, hold_model=models['hold_model']),
+        loan_counters=LoanCounters(connection),
+        analytics=LoanAnalytics(connection, models['book_model']),
+        recommender=BookRecommender(connection, models['book_model']),
+        # Rendered book card HTML keyed by (book id, content_version)
+        card_fragment_cache=CatalogCache(CARD_CACHE_MAX_ENTRIES, CARD_CACHE_TTL_SECONDS)
+    )
+    app.register_blueprint(library)
+    return app
+
+
+def library_extension(name):
+    """Proxy to one of the objects create_app stored for the app handling the request."""
+    return LocalProxy(lambda: current_app.extensions['library'][name])
+
 
-app = Flask(__name__)
-# Secret key is REQUIRED for Flask sessions to work.
-app.secret_key = 'your_hard-to-guess_secret_key_for_suss_library'
+book_model = library_extension('book_model')
+loan_model = library_extension('loan_model')
+hold_model = library_extension('hold_model')
+user_model = library_extension('user_model')
+search_index = library_extension('search_index')
+suggest_index = library_extension('suggest_index')
+card_fragment_cache = library_extension('card_fragment_cache')
+overdue_scanner = library_extension('overdue_scanner')
+loan_counters = library_extension('loan_counters')
+analytics = library_extension('analytics')
+recommender = library_extension('recommender')
 
-def get_description_paragraphs(description):
+
+@library.before_app_request
+def start_background_jobs():
     """
-    Splits the description and returns the first and last non-empty paragraphs.
+    Starts the overdue scanner and loan event consumer threads of this worker on its
+    first request, if enabled. Starting them here rather than in create_app keeps them
+    out of a pre-fork master process.
     """
-    paragraphs = [p.strip() + "." for p in description.split('.') if p.strip()]
+    if current_app.config.get('OVERDUE_SCAN_IN_APP'):
+        overdue_scanner.start()
+    if current_app.config.get('LOAN_EVENT_CONSUMER_IN_APP'):
+        loan_counters.start()
 
-    first_paragraph = paragraphs[0] if paragraphs else ""
-    last_paragraph = ""
+# --- Q3(c) Restored Helper Function for Frontend Logic (Using loan_model instance) ---
+def get_active_loan_book_ids():
+    """
+    Returns the ids of the books the logged-in user has on loan (empty if logged out).
+    They are loaded with one query, kept for the rest of the request in g and in the
+    session for ACTIVE_LOANS_SESSION_TTL_SECONDS, so most pages make no loan query at all.
+    forget_active_loans() drops them after a borrow or return.
+    """
+    user_id = session.get('user_id')
+    if not user_id:
+        return frozenset()
 
-    if len(paragraphs) > 1 and first_paragraph != paragraphs[-1]:
-        last_paragraph = paragraphs[-1]
-    elif len(paragraphs) == 1:
-        last_paragraph = ""
+    if 'active_loan_book_ids' not in g:
+        cached = session.get('active_loans')
+        if (not cached or cached.get('user_id') != user_id
+                or time.time() - cached.get('loaded_at', 0) > ACTIVE_LOANS_SESSION_TTL_SECONDS):
+            cached = {
+                'user_id': user_id,
+                'book_ids': sorted(loan_model.get_active_book_ids(user_id)),
+                'loaded_at': time.time()
+            }
+            session['active_loans'] = cached
+        g.active_loan_book_ids = frozenset(cached['book_ids'])
+    return g.active_loan_book_ids
+
+
+def forget_active_loans():
+    """Drops the cached on-loan book ids after the user borrowed or returned a book."""
+    session.pop('active_loans', None)
+    g.pop('active_loan_book_ids', None)
 
-    return first_paragraph, last_paragraph
 
-# --- Q3(c) Restored Helper Function for Frontend Logic (Using loan_model instance) ---
 def check_active_loan(book_id, user_id):
     """
-    Checks if the given user has an active, unreturned loan for the specified book 
-    by querying the dedicated loans collection via loan_model.
+    Checks if the given user has an active, unreturned loan for the specified book,
+    using the on-loan book ids loaded once for the request.
     """
     if not user_id:
         return False
-        
-    # Access the loans collection directly through the loan_model instance
-    # NOTE: Since the real model.py is using the loan_model instance for this check,
-    # we must update this helper to use the method provided in the user's model.py.
-    # The user's model.py provides: loan_model.has_active_loan(book_id, user_id)
-    return loan_model.has_active_loan(book_id, user_id)
+    return book_id in get_active_loan_book_ids()
 # --- END HELPER FUNCTION ---
 
 
+def get_page_size():
+    """
+    Reads the page_size query parameter, falling back to CATALOG_PAGE_SIZE and
+    clamping it to the range 1..CATALOG_MAX_PAGE_SIZE.
+    """
+    page_size = request.args.get('page_size', CATALOG_PAGE_SIZE, type=int)
+    return max(1, min(page_size, CATALOG_MAX_PAGE_SIZE))
+
+
+def get_facet_filters():
+    """
+    Reads the facet filters from the query string:
+    genre (repeatable, all must match), pages (a PAGE_RANGES key) and available=1.
+    Returns (filters, url_args) where url_args rebuilds the same filters (and sort order) in url_for.
+    """
+    genres = request.args.getlist('genre')
+    filters = normalize_filters(genres, request.args.get('pages'), request.args.get('available') == '1')
+
+    url_args = {}
+    if get_sort() != 'title':
+        url_args['sort'] = get_sort()
+    if filters[0]:
+        url_args['genre'] = list(filters[0])
+    if filters[1]:
+        url_args['pages'] = filters[1]
+    if filters[2]:
+        url_args['available'] = '1'
+    return filters, url_args
+
+
+def get_sort():
+    """Reads the list order from the query string: 'title' (default) or 'popular'."""
+    sort = request.args.get('sort', 'title')
+    return sort if sort in book_model.SORT_ORDERS else 'title'
+
+
+# --- Conditional GET Helpers (ETag / Last-Modified / 304) ---
+
+def session_fingerprint():
+    """The session values that change what a page shows (sidebar name, admin link)."""
+    return [session.get('user_id'), session.get('name'), bool(session.get('is_admin'))]
+
+
+def build_etag(*parts):
+    """Builds a strong ETag value from everything a rendered page depends on."""
+    return hashlib.sha1(json.dumps(parts, default=str).encode('utf-8')).hexdigest()
+
+
+def as_http_date(updated_at):
+    """Converts a stored updated_at (naive UTC from pymongo) for use as Last-Modified."""
+    if updated_at is None:
+        return None
+    if updated_at.tzinfo is None:
+        updated_at = updated_at.replace(tzinfo=timezone.utc)
+    # HTTP dates have one second resolution
+    return updated_at.replace(microsecond=0)
+
+
+def not_modified_response(etag, last_modified):
+    """
+    Returns a 304 response if the request's validators match the current page,
+    otherwise None. If-None-Match takes precedence over If-Modified-Since.
+    """
+    if request.method != 'GET' or session.get('_flashes'):
+        # Pending flash messages are shown exactly once, so the page must be rendered
+        return None
+
+    if request.if_none_match:
+        matched = request.if_none_match.contains(etag)
+    elif request.if_modified_since and last_modified:
+        matched = last_modified <= request.if_modified_since
+    else:
+        matched = False
+
+    if not matched:
+        return None
+    return add_validators(current_app.response_class(status=304), etag, last_modified)
+
+
+def add_validators(response, etag, last_modified):
+    """Adds the ETag, Last-Modified and caching headers to a response."""
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    # Always revalidate; pages for logged-in users must not be stored by shared caches
+    response.headers['Cache-Control'] = 'private, no-cache' if session.get('user_id') else 'public, no-cache'
+    response.vary.add('Cookie')
+    return response
+
+
+def render_book_cards(books):
+    """
+    Returns the HTML of a book card for each book document.
+    The card itself is rendered once per (book id, content_version, on loan to the
+    user) and cached; only the Copies/Available numbers are merged in per request,
+    read for the whole list with a single projection query.
+    """
+    availability = book_model.get_availability([book['id'] for book in books])
+    active_loan_book_ids = get_active_loan_book_ids()
+
+    cards = []
+    for book in books:
+        on_loan = book['id'] in active_loan_book_ids
+        cache_key = (book['id'], book.get('content_version'), on_loan)
+        fragment = card_fragment_cache.get(cache_key)
+        if fragment is MISSING:
+            # The display fields are precomputed by the Book model when the document is written
+            display_book = {
+                'id': book['id'],
+                'title': book['title'],
+                'author': book.get('primary_author', 'N/A'), # Display the primary author
+                'category': book.get('category', 'General'), # Safely retrieve category
+                'genres': book.get('genres_text', ''),
+                'pages': book.get('pages'),
+                'first_para': book.get('first_para', ''),
+                'last_para': book.get('last_para', ''),
+                'image_file': book['image_file']
+            }
+            fragment = render_template(
+                '_book_card.html',
+                book=display_book,
+                num_copies=COPIES_PLACEHOLDER,
+                available_copies=AVAILABLE_PLACEHOLDER,
+                on_loan=on_loan
+            )
+            card_fragment_cache.set(cache_key, fragment)
+
+        counts = availability.get(book['id'], {})
+        fragment = fragment.replace(COPIES_PLACEHOLDER, str(counts.get('copies', book.get('copies', 0))))
+        fragment = fragment.replace(AVAILABLE_PLACEHOLDER, str(counts.get('available', book.get('available', 0))))
+        cards.append(Markup(fragment))
+
+    return cards
+
+
 # --- Q2(a) & Q2(b) Book Routes (UNCHANGED) ---
 
-@app.route('/', methods=['GET', 'POST'])
-@app.route('/books_titles', methods=['GET', 'POST'])
+@library.route('/', methods=['GET', 'POST'])
+@library.route('/books_titles', methods=['GET', 'POST'])
 def books_titles():
-    """Renders the Book Titles page, handling category search."""
+    """Renders the Book Titles page, handling category search and pagination."""
 
     # Retrieve current user info from session for potential display/logic
     user_name = session.get('name')
 
     selected_category = 'All'
+    cursor = None
+    sort = 'title'
+    filters, filter_args = normalize_filters(), {}
 
     if request.method == 'POST':
+        # A new search always starts again from the first page, without facet filters
         selected_category = request.form.get('category_select', 'All')
-    elif request.args.get('category'):
-        selected_category = request.args.get('category')
+    else:
+        selected_category = request.args.get('category') or 'All'
+        cursor = request.args.get('cursor')
+        sort = get_sort()
+        filters, filter_args = get_facet_filters()
+
+    page_size = get_page_size()
+
+    # The page only changes when the category (or whole catalog) revision does.
+    # Facet counts span all categories, so they follow the whole catalog's revision.
+    catalog_revision = book_model.get_catalog_revision('All')
+    etag = build_etag('titles', catalog_revision['revision'], selected_category,
+                      page_size, cursor, sort, filters, session_fingerprint(),
+                      sorted(get_active_loan_book_ids()))
+    last_modified = as_http_date(catalog_revision['updated_at'])
+    not_modified = not_modified_response(etag, last_modified)
+    if not_modified:
+        return not_modified
+
+    # Fetch one page of data from MongoDB via the Book model. Cached reads are only used
+    # if they were made at the revision in the ETag (another worker may have written since).
+    revision = catalog_revision['revision']
+    filtered_books_from_db, next_cursor = book_model.get_books_page(
+        category=selected_category, page_size=page_size, cursor=cursor, filters=filters, sort=sort, revision=revision
+    )
+
+    page = render_template(
+        'books_titles.html',
+        cards=render_book_cards(filtered_books_from_db),
+        num_titles=book_model.count_books(selected_category, filters, revision=revision),
+        categories=ALL_CATEGORIES,
+        selected_category=selected_category,
+        facets=book_model.get_facets(selected_category, filters, revision=revision),
+        page_ranges=PAGE_RANGES,
+        selected_genres=filters[0],
+        selected_pages=filters[1],
+        only_available=filters[2],
+        selected_sort=sort,
+        popularity_days=ANALYTICS_POPULARITY_DAYS,
+        normalize_category=normalize_category,
+        first_page_url=url_for('library.books_titles', category=selected_category, page_size=page_size, **filter_args) if cursor else None,
+        next_page_url=url_for('library.books_titles', category=selected_category, page_size=page_size, cursor=next_cursor, **filter_args) if next_cursor else None,
+        active_page='titles',
+        user_name=user_name
+    )
+    return add_validators(make_response(page), etag, last_modified)
 
-    # Fetch data from MongoDB via the Book model
-    filtered_books_from_db = book_model.get_all_books(category=selected_category)
 
-    display_books = []
-    for book in filtered_books_from_db:
-        # Handling the potential change from 'author' string to 'authors' list
-        if 'authors' in book and book['authors']:
-            display_author = book['authors'][0]
-        else:
-            display_author = book.get('author', 'N/A')
-            
-        first_para, last_para = get_description_paragraphs(book.get('description', '')) # Added safety for missing description
-
-        display_books.append({
-            'id': book['id'],
-            'title': book['title'],
-            'author': display_author, # Display the primary author
-            'category': book.get('category', 'General'), # Safely retrieve category
-            'genres': book.get('genres', []),
-            'pages': book.get('pages'),
-            'first_para': first_para,
-            'last_para': last_para,
-            'image_file': book['image_file'],
-            'num_copies': book.get('copies', 0),
-            'available_copies': book.get('available', 0) # Mapped to {{ book.available_copies }}
-        })
+@library.route('/search')
+def search_books():
+    """
+    Keyword search over titles, authors, genres and descriptions.
+    Matching and ranking are answered by the in-memory search index;
+    only the cards of the requested page are read from MongoDB.
+    """
+    query = request.args.get('q', '').strip()
+    page_size = get_page_size()
+    offset = max(0, request.args.get('offset', 0, type=int))
+
+    search_index.sync(book_model)
+    results = search_index.search(query) if query else []
+    page_ids = [book_id for book_id, _ in results[offset:offset + page_size]]
 
+    next_offset = offset + page_size
     return render_template(
         'books_titles.html',
-        books=display_books,
-        num_titles=len(display_books),
+        cards=render_book_cards(book_model.get_books_by_ids(page_ids)),
+        num_titles=len(results),
         categories=ALL_CATEGORIES,
-        selected_category=selected_category,
+        selected_category='All',
+        search_query=query,
+        first_page_url=url_for('library.search_books', q=query, page_size=page_size) if offset else None,
+        next_page_url=url_for('library.search_books', q=query, page_size=page_size, offset=next_offset) if next_offset < len(results) else None,
         active_page='titles',
-        user_name=user_name
+        user_name=session.get('name')
     )
 
 
-@app.route('/book/<string:book_id>')
+@library.route('/suggest')
+def suggest():
+    """
+    Returns title and author suggestions for a typed prefix as JSON.
+    Usage: /suggest?prefix=<text>&limit=<n>
+    Answered from the in-memory suggestion index, so it can be called on every keystroke.
+    """
+    prefix = request.args.get('prefix', '')
+    limit = max(1, min(request.args.get('limit', SUGGEST_MAX_RESULTS, type=int), SUGGEST_MAX_RESULTS))
+
+    suggest_index.sync(book_model)
+    return jsonify({'prefix': prefix, 'suggestions': suggest_index.suggest(prefix, limit)})
+
+
+@library.route('/api/availability')
+def book_availability():
+    """
+    Returns the live Copies/Available numbers for a batch of books as JSON.
+    Usage: /api/availability?ids=<id>,<id>,...
+    """
+    book_ids = [book_id for book_id in request.args.get('ids', '').split(',') if book_id]
+    if len(book_ids) > AVAILABILITY_MAX_IDS:
+        return jsonify({'error': f'At most {AVAILABILITY_MAX_IDS} ids per request.'}), 400
+
+    return jsonify(book_model.get_availability(book_ids))
+
+
+@library.route('/analytics/top')
+def analytics_top():
+    """
+    Returns the most borrowed books of the last week or month as JSON.
+    Usage: /analytics/top?window=week|month&limit=<n>
+    Read from the list precomputed by analytics.py, so it costs one small document read.
+    """
+    window = request.args.get('window', 'week')
+    if window not in ('week', 'month'):
+        return jsonify({'error': "window must be 'week' or 'month'."}), 400
+    limit = max(1, min(request.args.get('limit', 10, type=int), ANALYTICS_TOP_MAX))
+
+    top = analytics.get_top(window, limit)
+    books = {book['id']: book for book in book_model.get_books_by_ids(
+        [entry['book_id'] for entry in top], projection={'title': 1}
+    )}
+    for entry in top:
+        entry['title'] = books.get(str(entry['book_id']), {}).get('title', 'Unknown Title')
+    return jsonify({'window': window, 'books': top})
+
+
+@library.route('/analytics/category_trend')
+def analytics_category_trend():
+    """
+    Returns the daily borrows, renewals and returns of one category as JSON, oldest day first.
+    Usage: /analytics/category_trend?category=<name>&days=<n>
+    """
+    category = request.args.get('category', '')
+    if not category:
+        return jsonify({'error': 'category is required.'}), 400
+    days = max(1, min(request.args.get('days', 30, type=int), ANALYTICS_TREND_MAX_DAYS))
+    return jsonify({'category': category, 'days': analytics.get_category_trend(category, days)})
+
+
+@library.route('/book/<string:book_id>')
 def book_detail(book_id):
     """
     Displays the details of a single book. 
     Includes logic to determine if the book is currently borrowed by the user.
     """
 
-    # Fetch book details from MongoDB
-    selected_book = book_model.get_book_by_id(book_id)
-
-    if selected_book is None:
+    # Only the revision is read here so that a 304 needs no full document
+    book_revision = book_model.get_book_revision(book_id)
+    if book_revision is None:
         return abort(404)
     
-    # Determine author(s) for display
-    authors = selected_book.get('authors')
-    if authors and isinstance(authors, list):
-        display_author = ", ".join(authors) # Join all authors for detail page
-    else:
-        display_author = selected_book.get('author', 'Unknown')
-    
     # LOGIC FOR Q3(c): Check loan status for the currently logged-in user
     user_id = session.get('user_id')
     # Use the corrected helper function
     has_active_loan = check_active_loan(book_id, user_id) 
     # END NEW LOGIC
 
-    all_paragraphs = [p.strip() + "." for p in selected_book.get('description', '').split('.') if p.strip()]
+    # The waitlist only matters while no copy is available (one aggregation)
+    hold = None
+    if user_id and not has_active_loan and book_revision['available'] <= 0:
+        hold = hold_model.get_queue_status(book_id, user_id)
+        hold['estimated_ready_formatted'] = hold['estimated_ready'].strftime('%d %b %Y') if hold['estimated_ready'] else None
+        hold['expires_at_formatted'] = hold['expires_at'].strftime('%d %b %Y') if hold['expires_at'] else None
+
+    hold_state = hold and [hold[key] for key in ('status', 'position', 'queue_length', 'estimated_ready_formatted', 'expires_at_formatted')]
+    # Recommendations are left out so a 304 costs no read of them; a client holding
+    # a cached copy sees recomputed ones after the book next changes
+    etag = build_etag('detail', book_id, book_revision['revision'], has_active_loan, hold_state,
+                      session_fingerprint())
+    last_modified = as_http_date(book_revision['updated_at'])
+    not_modified = not_modified_response(etag, last_modified)
+    if not_modified:
+        return not_modified
+
+    # "Borrowers also borrowed", precomputed by recommendations.py (one lookup by _id)
+    related = recommender.get_related(book_id)
+
+    # Fetch book details from MongoDB (a cached copy only if it is at the revision in the ETag)
+    selected_book = book_model.get_book_by_id(book_id, revision=book_revision['revision'])
+
+    if selected_book is None:
+        return abort(404)
 
     display_data = {
         'id': book_id, # Add book ID to display data for button links
         'title': selected_book['title'],
-        'author': display_author,
+        'author': selected_book.get('authors_text', 'Unknown'), # All authors joined for detail page
         'category': selected_book.get('category', 'General'),
-        'genres': selected_book.get('genres', []),
+        'genres': selected_book.get('genres_text', ''),
         'pages': selected_book.get('pages'),
         'image_file': selected_book['image_file'],
-        'description_paragraphs': all_paragraphs,
+        'description_paragraphs': selected_book.get('description_paragraphs', []),
         'copies': selected_book.get('copies', 1),
-        'available': selected_book.get('available', 1)
+        'available': book_revision['available'] # Read with the revision, never from the cache
     }
 
-    return render_template('book_detail.html', 
+    page = render_template('book_detail.html', 
                              book=display_data, 
                              active_page='detail',
-                             has_active_loan=has_active_loan # Pass status to template
+                             has_active_loan=has_active_loan, # Pass status to template
+                             hold=hold,
+                             related_books=related.get('neighbors', [])
                           )
+    return add_validators(make_response(page), etag, last_modified)
 
 
 def login_required(f):
@@ -163,7 +522,7 @@ def login_required(f):
     def decorated_function(*args, **kwargs):
         if 'user_id' not in session:
             flash('Please log in to access this page.', 'warning')
-            return redirect(url_for('login'))
+            return redirect(url_for('library.login'))
         return f(*args, **kwargs)
     return decorated_function
 
@@ -174,13 +533,60 @@ def admin_required(f):
     def decorated_function(*args, **kwargs):
         if not session.get('is_admin'):
             flash('Access denied. Only administrators can use this function.', 'danger')
-            return redirect(url_for('books_titles'))
+            return redirect(url_for('library.books_titles'))
         return f(*args, **kwargs)
     return decorated_function
 
 
+@library.route('/admin/cache_stats')
+@login_required
+@admin_required
+def cache_stats():
+    """Returns the hit/miss counters of this worker's catalog cache as JSON."""
+    return jsonify(book_model.cache.stats())
+
+
+@library.route('/admin/loan_stats')
+@login_required
+@admin_required
+def loan_stats():
+    """Returns the loan totals, daily counts and most borrowed books from the loan counters as JSON."""
+    stats = loan_counters.get_stats()
+    books = {book['id']: book for book in book_model.get_books_by_ids(
+        [entry['book_id'] for entry in stats['top_books']], projection={'title': 1}
+    )}
+    for entry in stats['top_books']:
+        entry['title'] = books.get(str(entry['book_id']), {}).get('title', 'Unknown Title')
+    return jsonify(stats)
+
+
+@library.route('/admin/overdue')
+@login_required
+@admin_required
+def overdue_report():
+    """Lists the active overdue loans with their borrowers, and the totals kept by the overdue scanner."""
+    overdue_loans = loan_model.get_overdue_loans(limit=OVERDUE_REPORT_LIMIT)
+    users = user_model.get_users_by_ids([loan['user_id'] for loan in overdue_loans])
+
+    now = datetime.now()
+    for loan in overdue_loans:
+        user_doc = users.get(str(loan['user_id']), {})
+        loan['user_name'] = user_doc.get('name', 'Unknown User')
+        loan['user_email'] = user_doc.get('email', '')
+        loan['due_date_formatted'] = loan['due_date'].strftime('%d %b %Y')
+        loan['days_overdue'] = (now - loan['due_date']).days
+
+    return render_template(
+        'overdue_report.html',
+        active_page='overdue_report',
+        loans=overdue_loans,
+        limit=OVERDUE_REPORT_LIMIT,
+        summary=overdue_scanner.get_summary()
+    )
+
+
 # --- Q3(c) Borrowing a book (FIX APPLIED HERE) ---
-@app.route('/make_loan/<string:book_id>')
+@library.route('/make_loan/<string:book_id>')
 @login_required 
 def make_loan(book_id):
     """
@@ -196,17 +602,37 @@ def make_loan(book_id):
     
     # Pass the calculated date to create_loan so models.py doesn't default to today
     success, message = loan_model.create_loan(book_id, user_id, borrow_date=borrow_date_in_past)
+    forget_active_loans()
 
     if success:
         flash(message, 'success')
     else:
         flash(f"Loan failed: {message}", 'danger') 
         
-    return redirect(url_for('book_detail', book_id=book_id))
+    return redirect(url_for('library.book_detail', book_id=book_id))
+
+
+# --- Holds: queueing for a book with no copy available ---
+@library.route('/place_hold/<string:book_id>', methods=['POST'])
+@login_required
+def place_hold(book_id):
+    """Adds the current user to the book's waitlist."""
+    success, message = hold_model.place_hold(book_id, session.get('user_id'))
+    flash(message if success else f"Hold failed: {message}", 'success' if success else 'danger')
+    return redirect(url_for('library.book_detail', book_id=book_id))
+
+
+@library.route('/cancel_hold/<string:book_id>', methods=['POST'])
+@login_required
+def cancel_hold(book_id):
+    """Removes the current user from the book's waitlist (a reserved copy goes to the next in line)."""
+    success, message = hold_model.cancel_hold(book_id, session.get('user_id'))
+    flash(message if success else f"Cancel failed: {message}", 'success' if success else 'danger')
+    return redirect(url_for('library.book_detail', book_id=book_id))
 
 
 # --- Q3(c) Returning a book (ROUTE ACCEPTS POST) ---
-@app.route('/return_loan/<string:loan_id>', methods=['POST'])
+@library.route('/return_loan/<string:loan_id>', methods=['POST'])
 @login_required 
 def return_loan(loan_id):
     """
@@ -214,6 +640,7 @@ def return_loan(loan_id):
     Uses the loan_id from the my_loans page.
     """
     success, message = loan_model.return_loan(loan_id)
+    forget_active_loans()
 
     if success:
         flash(message, 'success')
@@ -222,22 +649,31 @@ def return_loan(loan_id):
         print(f"DEBUG: loan_model.return_loan('{loan_id}') failed. Message: {message}")
         flash(f"Return failed: {message}", 'danger') 
         
-    return redirect(url_for('my_loans'))
+    return redirect(url_for('library.my_loans'))
 
 
 # --- Q3(c) Loan-related Functions for non-admin users (my_loans) ---
 
-@app.route('/my_loans')
+@library.route('/my_loans')
 @login_required
 def my_loans():
     """
-    Retrieves and displays all loans (active and returned) for the current user.
-    Includes date formatting fix from previous steps.
+    Retrieves and displays the loans (active and returned) of the current user,
+    MY_LOANS_PAGE_SIZE at a time. Includes date formatting fix from previous steps.
     """
     user_id = session.get('user_id')
+    cursor = request.args.get('cursor')
     
-    # Retrieve all loans for the user
-    all_loans = loan_model.get_user_loans(user_id)
+    # Retrieve one page of the user's loans (one extra tells whether an older page exists).
+    # Old returned loans may live in the archive; get_user_loans merges both.
+    all_loans = loan_model.get_user_loans(user_id, limit=MY_LOANS_PAGE_SIZE + 1, cursor=cursor)
+    next_cursor = None
+    if len(all_loans) > MY_LOANS_PAGE_SIZE:
+        all_loans = all_loans[:MY_LOANS_PAGE_SIZE]
+        next_cursor = loan_model.loan_page_cursor(all_loans[-1])
+
+    # Per-loan results of the bulk action that redirected here, shown once
+    outcomes = session.pop('loan_outcomes', {})
     
     # Format dates and determine status for template display
     for loan in all_loans:
@@ -245,6 +681,8 @@ def my_loans():
         # Ensure that old or corrupted loan records have a default renew_count of 0.
         if 'renew_count' not in loan:
             loan['renew_count'] = 0
+
+        loan['book_image_url'] = url_for('static', filename='images/' + loan['book_image'])
         
         try:
             # Ensure the key exists before attempting to access/format it
@@ -266,20 +704,63 @@ def my_loans():
 
         # Standard status checks
         loan['is_active'] = loan.get('return_date') is None
-        loan['is_overdue'] = loan['is_active'] and loan.get('due_date') and loan['due_date'] < datetime.now()
-        loan['can_renew'] = loan['is_active'] and loan.get('renew_count', 0) < 2
+        # Read from the due date rather than the scanner's flag, which lags behind returns and renewals
+        loan['is_overdue'] = loan['is_active'] and bool(loan.get('due_date') and loan['due_date'] < datetime.now())
+        loan['can_renew'] = loan['is_active'] and loan.get('renew_count', 0) < 2 and not (REFUSE_OVERDUE_RENEWALS and loan['is_overdue'])
         loan['can_return'] = loan['is_active'] 
         # --- FIX: Only allow deletion if the loan is NOT active (i.e., it has been returned) ---
         loan['can_delete'] = not loan['is_active']
+        loan['outcome'] = outcomes.get(loan['id'])
 
 
     return render_template('my_loans.html', 
                             loans=all_loans, 
+                            first_page_url=url_for('library.my_loans') if cursor else None,
+                            next_page_url=url_for('library.my_loans', cursor=next_cursor) if next_cursor else None, 
                             active_page='my_loans', 
                             user_name=session.get('name'))
 
 
-@app.route('/renew_loan/<string:loan_id>')
+# --- Bulk renew / return from the My Loans page ---
+@library.route('/my_loans/bulk', methods=['POST'])
+@login_required
+def bulk_loan_action():
+    """
+    Renews or returns every selected loan of the current user at once
+    (form fields: action = 'renew' or 'return', loan_ids repeated).
+    Redirects to My Loans, which shows the outcome next to each loan;
+    JSON clients get {loan_id: {'success', 'message'}} instead.
+    """
+    action = request.form.get('action')
+    loan_ids = request.form.getlist('loan_ids')
+    user_id = session.get('user_id')
+
+    if action not in ('renew', 'return') or not loan_ids:
+        flash("Select at least one loan, then choose Renew or Return.", 'danger')
+        return redirect(url_for('library.my_loans'))
+
+    if action == 'renew':
+        results = loan_model.renew_loans(loan_ids, user_id)
+    else:
+        results = loan_model.return_loans(loan_ids, user_id)
+        forget_active_loans()
+
+    outcomes = {loan_id: {'success': success, 'message': message} for loan_id, (success, message) in results.items()}
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'action': action, 'outcomes': outcomes})
+
+    succeeded = sum(1 for outcome in outcomes.values() if outcome['success'])
+    verb = 'renewed' if action == 'renew' else 'returned'
+    if succeeded:
+        flash(f"{succeeded} of {len(outcomes)} loan(s) {verb}.", 'success')
+    if succeeded < len(outcomes):
+        flash(f"{len(outcomes) - succeeded} loan(s) could not be {verb}; see the notes below.", 'danger')
+
+    session['loan_outcomes'] = outcomes
+    return redirect(url_for('library.my_loans'))
+
+
+@library.route('/renew_loan/<string:loan_id>')
 @login_required
 def renew_loan(loan_id):
     """
@@ -292,11 +773,11 @@ def renew_loan(loan_id):
     else:
         flash(f"Renewal failed: {message}", 'danger')
         
-    return redirect(url_for('my_loans'))
+    return redirect(url_for('library.my_loans'))
 
 
 # --- FIX: Added methods=['POST'] to accept form submission ---
-@app.route('/delete_loan/<string:loan_id>', methods=['POST'])
+@library.route('/delete_loan/<string:loan_id>', methods=['POST'])
 @login_required
 def delete_loan(loan_id):
     """
@@ -312,11 +793,11 @@ def delete_loan(loan_id):
         print(f"DEBUG: loan_model.delete_loan('{loan_id}') failed. Message: {message}")
         flash(f"Deletion failed: {message}", 'danger')
         
-    return redirect(url_for('my_loans'))
+    return redirect(url_for('library.my_loans'))
 
 # --- Q2(c) Authentication Routes (UNCHANGED) ---
 
-@app.route('/register', methods=['GET', 'POST'])
+@library.route('/register', methods=['GET', 'POST'])
 def register():
     """Handles user registration."""
     if request.method == 'POST':
@@ -340,14 +821,14 @@ def register():
             session['is_admin'] = is_admin
             
             flash(f'Registration successful! Welcome, {name}.', 'success')
-            return redirect(url_for('books_titles'))
+            return redirect(url_for('library.books_titles'))
         else:
             flash('Registration failed: Email already in use.', 'error')
 
     return render_template('register.html', active_page='register')
 
 
-@app.route('/login', methods=['GET', 'POST'])
+@library.route('/login', methods=['GET', 'POST'])
 def login():
     """Handles user login."""
     if request.method == 'POST':
@@ -364,82 +845,26 @@ def login():
             session['is_admin'] = is_admin
 
             flash(f'Login successful! Welcome back, {user_doc["name"]}.', 'success')
-            return redirect(url_for('books_titles'))
+            return redirect(url_for('library.books_titles'))
         else:
             flash('Login failed. Check your email and password.', 'error')
 
     return render_template('login.html', active_page='login')
 
 
-@app.route('/logout')
+@library.route('/logout')
 def logout():
     """Logs out the user by clearing the session."""
     session.pop('user_id', None)
     session.pop('name', None)
     session.pop('is_admin', None)
+    forget_active_loans()
     flash('You have been logged out.', 'info')
 
-    return redirect(url_for('books_titles'))
-
-
-GENRE_CHOICES = [
-    ("Animals", "Animals"), ("Business", "Business"), ("Comics", "Comics"),
-    ("Communication", "Communication"), ("Dark Academia", "Dark Academia"),
-    ("Emotion", "Emotion"), ("Fantasy", "Fantasy"), ("Fiction", "Fiction"),
-    ("Friendship", "Friendship"), ("Graphic Novels", "Graphic Novels"),
-    ("Grief", "Grief"), ("Historical Fiction", "Historical Fiction"),
-    ("Indigenous", "Indigenous"), ("Inspirational", "Inspirational"),
-    ("Magic", "Magic"), ("Mental Health", "Mental Health"),
-    ("Nonfiction", "Nonfiction"), ("Personal Development", "Personal Development"),
-    ("Philosophy", "Philosophy"), ("Picture Books", "Picture Books"),
-    ("Poetry", "Poetry"), ("Productivity", "Productivity"),
-    ("Psychology", "Psychology"), ("Romance", "Romance"),
-    ("School", "School"), ("Self Help", "Self Help")
-]
-
-# Create choices list for the Category SelectField
-from books_data import ALL_CATEGORIES # Re-imported to ensure it's available
-CATEGORY_CHOICES = [(c, c) for c in ALL_CATEGORIES]
-
-
-# --- Dynamic Author Form for FieldList ---
-class SimpleAuthorForm(FlaskForm):
-    # This field name must match the one used in the HTML: author_field.author_name
-    author_name = StringField('Author Name', validators=[Optional(), Length(max=100)])
-
+    return redirect(url_for('library.books_titles'))
 
-class NewBookForm(FlaskForm):
-    title = StringField('Title', validators=[DataRequired(), Length(max=255)])
-    
-    # REPLACED: FieldList for dynamic author input (Bonus Implementation)
-    authors_text = FieldList(
-        FormField(SimpleAuthorForm),
-        min_entries=1, # Ensures at least one author field is always displayed
-        label='Book Authors'
-    ) 
-
-    cover_image = StringField('Cover Image Filename (e.g., cover1.jpg)', validators=[DataRequired(), Length(max=255)])
-    isbn = StringField('ISBN', validators=[Optional(), Length(max=20)])
-    publication_year = IntegerField('Publication Year',
-                                     validators=[Optional(), NumberRange(min=1000, max=2025)],
-                                     render_kw={"placeholder": "e.g., 2024"})
-    genres = SelectMultipleField('Genres (Hold Ctrl/Cmd to select multiple)',
-                                     choices=GENRE_CHOICES,
-                                     validators=[Optional()])
-    publisher = StringField('Publisher', validators=[Optional(), Length(max=100)])
-    description = TextAreaField('Description', validators=[DataRequired()])
-    page_count = IntegerField('Page Count', validators=[Optional(), NumberRange(min=1)])
-    
-    # NEW FIELDS FOR Q2(b)
-    category = SelectField('Category', choices=CATEGORY_CHOICES, validators=[DataRequired()])
-    copies = IntegerField('Total Copies', validators=[DataRequired(), NumberRange(min=1)], default=1)
-    available = IntegerField('Available Copies', validators=[DataRequired(), NumberRange(min=0)], default=1)
-    # END NEW FIELDS
-    
-    submit = SubmitField('Submit Book')
 
-
-@app.route('/new_book', methods=['GET', 'POST'])
+@library.route('/new_book', methods=['GET', 'POST'])
 @login_required
 @admin_required
 def new_book():
@@ -489,7 +914,7 @@ def new_book():
         
         if success:
             flash(message, 'success')
-            return redirect(url_for('books_titles'))
+            return redirect(url_for('library.books_titles'))
         else:
             flash(f'Failed to add book: {message}', 'danger')
 
@@ -498,3 +923,51 @@ def new_book():
     # STEP 3: Initial GET request or validation failure
     # ----------------------------------------------------------------------
     return render_template('new_book.html', form=form, active_page='new_book')
+
+
+@library.route('/admin/import', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def import_books():
+    """
+    Bulk import of a CSV/JSONL publisher feed (see bulk_import.py).
+    The upload is streamed through the importer; rejected rows go to an error file
+    (created only if a row is rejected) that can be downloaded from the report.
+    """
+    if request.method == 'GET':
+        return render_template('import_books.html', active_page='import_books', batch_size=IMPORT_BATCH_SIZE)
+
+    feed = request.files.get('feed')
+    if not feed or not feed.filename:
+        flash('Please choose a CSV or JSONL file to import.', 'danger')
+        return redirect(url_for('library.import_books'))
+
+    batch_size = max(1, request.form.get('batch_size', IMPORT_BATCH_SIZE, type=int))
+    os.makedirs(IMPORT_ERRORS_DIR, exist_ok=True)
+    errors_filename = f"import-errors-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.csv"
+
+    with ErrorFile(os.path.join(IMPORT_ERRORS_DIR, errors_filename)) as errors_file:
+        report = run_import(
+            io.TextIOWrapper(feed.stream, encoding='utf-8-sig', newline=''),
+            detect_format(feed.filename),
+            book_model,
+            batch_size=batch_size,
+            ordered='ordered' in request.form,
+            error_writer=errors_file
+        )
+
+    return render_template(
+        'import_books.html',
+        active_page='import_books',
+        batch_size=batch_size,
+        report=report.as_dict(),
+        errors_filename=errors_filename if errors_file.created else None
+    )
+
+
+@library.route('/admin/import/errors/<path:filename>')
+@login_required
+@admin_required
+def import_errors(filename):
+    """Downloads the rejected-row file of an import."""
+    return send_from_directory(os.path.abspath(IMPORT_ERRORS_DIR), filename, as_attachment=True)
@@ -0,0 +1,146 @@
+"""
+Moves returned loans older than LOAN_ARCHIVE_AFTER_DAYS from 'loans' into the
+loans_archive collection, so the hot collection (and its indexes) stays about the
+size of the active loans.
+
+Archived loans are grouped into one document per user and month of borrowing:
+{user_id, month: 'YYYY-MM', loans: [loan documents]}. Loan.get_user_loans reads
+both collections, so the move is invisible to the My Loans page.
+
+Each batch is copied with $addToSet upserts and only then deleted from 'loans'.
+Re-copying a loan is a no-op, so an interrupted run is simply resumed by the next one.
+
+Usage:
+    python archive.py [--older-than-days 180] [--batch-size 1000] [--max-batches N]
+"""
+import argparse
+import json
+import sys
+from datetime import datetime, timedelta
+
+from pymongo import UpdateOne
+
+from config import LOAN_ARCHIVE_COLLECTION_NAME, LOAN_ARCHIVE_AFTER_DAYS, LOAN_ARCHIVE_BATCH_SIZE
+from models import ensure_collection_indexes
+
+
+class LoanArchiver:
+    """Archives returned loans in resumable batches and records its progress in app_meta."""
+
+    # (name, keys, options) for the indexes on the archive collection
+    ARCHIVE_INDEXES = [
+        # One bucket per user and month; a user's history newest month first (Loan.get_user_loans)
+        ('user_month', [('user_id', 1), ('month', -1)], {'unique': True}),
+        # Finding an archived loan by id (Loan.delete_loan)
+        ('loan_id', [('loans._id', 1)], {})
+    ]
+
+    CHECKPOINT_ID = 'loan_archive'
+
+    def __init__(self, connection, older_than_days=LOAN_ARCHIVE_AFTER_DAYS, batch_size=LOAN_ARCHIVE_BATCH_SIZE):
+        self.connection = connection
+        self.older_than_days = older_than_days
+        self.batch_size = batch_size
+
+    @property
+    def loans_collection(self):
+        return self.connection.db['loans']
+
+    @property
+    def archive_collection(self):
+        return self.connection.db[LOAN_ARCHIVE_COLLECTION_NAME]
+
+    @property
+    def meta_collection(self):
+        return self.connection.db['app_meta']
+
+    def ensure_indexes(self):
+        """Creates and verifies the indexes on the archive collection."""
+        return ensure_collection_indexes(self.archive_collection, self.ARCHIVE_INDEXES)
+
+    def archive(self, max_batches=None, now=None):
+        """
+        Archives every returned loan older than older_than_days (or up to max_batches
+        batches of them). Returns the statistics of this run as a dictionary.
+        """
+        # Loan dates are stored as naive local times (see Loan.create_loan)
+        cutoff = (now or datetime.now()) - timedelta(days=self.older_than_days)
+        stats = {'archived': 0, 'batches': 0, 'cutoff': cutoff}
+
+        while max_batches is None or stats['batches'] < max_batches:
+            archived = self._archive_batch(cutoff)
+            if not archived:
+                break
+            stats['archived'] += archived
+            stats['batches'] += 1
+
+            # Progress survives an interruption; the next run continues after the last batch
+            self.meta_collection.update_one(
+                {'_id': self.CHECKPOINT_ID},
+                {'$inc': {'archived_total': archived}, '$set': {'updated_at': datetime.now()}},
+                upsert=True
+            )
+            if archived < self.batch_size:
+                break
+
+        return stats
+
+    def _archive_batch(self, cutoff):
+        """Copies one batch of old returned loans into their buckets, then removes them from 'loans'."""
+        # Only dates compare below cutoff, so active loans (return_date null) never match.
+        # The range is served by the loans index on (return_date, due_date).
+        batch = list(
+            self.loans_collection.find({'return_date': {'$lt': cutoff}})
+            .sort('return_date', 1)
+            .limit(self.batch_size)
+        )
+        if not batch:
+            return 0
+
+        buckets = {}
+        for loan in batch:
+            key = (loan['user_id'], loan['borrow_date'].strftime('%Y-%m'))
+            buckets.setdefault(key, []).append(loan)
+
+        self.archive_collection.bulk_write([
+            UpdateOne(
+                {'user_id': user_id, 'month': month},
+                {'$addToSet': {'loans': {'$each': loans}}},
+                upsert=True
+            )
+            for (user_id, month), loans in buckets.items()
+        ], ordered=False)
+
+        self.loans_collection.delete_many({
+            '_id': {'$in': [loan['_id'] for loan in batch]},
+            'return_date': {'$lt': cutoff}
+        })
+        return len(batch)
+
+    def get_progress(self):
+        """Returns the stored totals of all runs (empty before the first one)."""
+        return self.meta_collection.find_one({'_id': self.CHECKPOINT_ID}, {'_id': 0}) or {}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Move old returned loans into the loan archive.")
+    parser.add_argument('--older-than-days', type=int, default=LOAN_ARCHIVE_AFTER_DAYS, help="Archive loans returned before this many days ago")
+    parser.add_argument('--batch-size', type=int, default=LOAN_ARCHIVE_BATCH_SIZE, help="Loans moved per batch")
+    parser.add_argument('--max-batches', type=int, help="Stop after this many batches (default: until done)")
+    args = parser.parse_args(argv)
+
+    from db import MongoConnection
+
+    connection = MongoConnection.from_config()
+    archiver = LoanArchiver(connection, older_than_days=max(0, args.older_than_days), batch_size=max(1, args.batch_size))
+    try:
+        stats = archiver.archive(max_batches=args.max_batches)
+    finally:
+        connection.close()
+
+    print(json.dumps(stats, default=str))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
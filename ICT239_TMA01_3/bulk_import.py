@@ -0,0 +1,293 @@
+"""
+Streaming bulk import of books from publisher feeds (CSV or JSONL).
+
+Records are read one at a time, validated with the same rules as the New Book
+form, and written in batches with Book.bulk_upsert_books (upsert on ISBN), so
+memory use does not grow with the size of the feed.
+
+Usage:
+    python bulk_import.py FEED [--format csv|jsonl] [--batch-size 1000]
+                               [--ordered] [--errors import_errors.csv]
+
+CSV feeds use one column per field; 'authors' and 'genres' hold several values
+separated by ';'. JSONL feeds hold one JSON object per line, where 'authors' and
+'genres' may also be lists. 'image_file' and 'pages' are accepted as aliases of
+'cover_image' and 'page_count'.
+"""
+import argparse
+import csv
+import json
+import sys
+import time
+
+from werkzeug.datastructures import MultiDict
+
+from config import IMPORT_BATCH_SIZE
+from forms import AuthorFields, BookRecordForm
+
+# Separator for multi-valued CSV columns (authors, genres)
+LIST_SEPARATOR = ';'
+
+# Feed column -> form field, for the names used by the books collection itself
+FIELD_ALIASES = {'image_file': 'cover_image', 'pages': 'page_count'}
+
+# Single-valued BookRecordForm fields read from each record
+SCALAR_FIELDS = (
+    'title', 'cover_image', 'isbn', 'publication_year', 'publisher',
+    'description', 'page_count', 'category', 'copies', 'available'
+)
+
+
+def iter_records(stream, file_format):
+    """
+    Yields (row_number, record, error) for each record in the feed.
+    record is None (and error set) when a line cannot be parsed.
+    """
+    if file_format == 'csv':
+        # Row 1 is the header
+        for row_number, record in enumerate(csv.DictReader(stream), start=2):
+            yield row_number, record, None
+    else:
+        for row_number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield row_number, None, f"Invalid JSON: {e}"
+                continue
+            if not isinstance(record, dict):
+                yield row_number, None, "Each line must be a JSON object."
+                continue
+            yield row_number, record, None
+
+
+def split_values(value):
+    """Returns a list for a multi-valued field given as a list or a ';'-separated string."""
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return [str(item).strip() for item in value if str(item).strip()]
+    return [item.strip() for item in str(value).split(LIST_SEPARATOR) if item.strip()]
+
+
+def validate_record(record):
+    """
+    Validates one feed record with the New Book form rules.
+    Returns (book_kwargs, None) for build_book_document, or (None, error_message).
+    """
+    record = {FIELD_ALIASES.get(key, key): value for key, value in record.items() if key}
+
+    formdata = MultiDict()
+    for field_name in SCALAR_FIELDS:
+        value = record.get(field_name)
+        if value not in (None, ''):
+            formdata.add(field_name, str(value))
+    for genre in split_values(record.get('genres')):
+        formdata.add('genres', genre)
+
+    form = BookRecordForm(formdata)
+    errors = [] if form.validate() else [
+        f"{field}: {message}" for field, messages in form.errors.items() for message in messages
+    ]
+
+    # Same rules as the author entries of the form, plus 'at least one author'
+    authors = split_values(record.get('authors') or record.get('author'))
+    for author in authors:
+        author_form = AuthorFields(MultiDict({'author_name': author}))
+        if not author_form.validate():
+            errors += [f"authors: {message}" for message in author_form.errors['author_name']]
+    if not authors:
+        errors.append("authors: At least one author name is required.")
+
+    if errors:
+        return None, "; ".join(errors)
+
+    return {
+        'title': form.title.data,
+        'authors': authors,
+        'cover_image': form.cover_image.data,
+        'isbn': (form.isbn.data or '').strip(),
+        'publication_year': form.publication_year.data,
+        'genres': form.genres.data,
+        'publisher': form.publisher.data,
+        'description': form.description.data,
+        'page_count': form.page_count.data,
+        'category': form.category.data,
+        'copies': form.copies.data,
+        'available': form.available.data
+    }, None
+
+
+class ImportReport:
+    """Running totals and throughput of an import."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.rows = 0
+        self.inserted = 0
+        self.updated = 0
+        self.invalid = 0 # Rejected by validation or parsing
+        self.duplicates = 0 # Superseded by a later row with the same ISBN, or written concurrently elsewhere
+        self.failed = 0 # Rejected by the database
+        self.batches = 0
+
+    @property
+    def rows_per_second(self):
+        elapsed = time.monotonic() - self.started
+        return self.rows / elapsed if elapsed > 0 else 0.0
+
+    def as_dict(self):
+        return {
+            'rows': self.rows, 'inserted': self.inserted, 'updated': self.updated,
+            'invalid': self.invalid, 'duplicates': self.duplicates, 'failed': self.failed,
+            'batches': self.batches, 'seconds': round(time.monotonic() - self.started, 2),
+            'rows_per_second': round(self.rows_per_second, 1)
+        }
+
+    def progress_line(self):
+        return (f"{self.rows} rows | {self.inserted} inserted, {self.updated} updated, "
+                f"{self.invalid} invalid, {self.duplicates} duplicates, {self.failed} failed | "
+                f"{self.rows_per_second:.0f} rows/s")
+
+
+class ErrorFile:
+    """
+    A csv.writer-like sink for rejected rows that only creates its file with the
+    first row, so an import without errors leaves no file behind.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._writer = None
+
+    @property
+    def created(self):
+        return self._file is not None
+
+    def writerow(self, row):
+        if self._writer is None:
+            self._file = open(self.path, 'w', encoding='utf-8', newline='')
+            self._writer = csv.writer(self._file)
+        self._writer.writerow(row)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def run_import(stream, file_format, book_model, batch_size=IMPORT_BATCH_SIZE, ordered=False,
+               error_writer=None, progress=None):
+    """
+    Imports every record of an open feed. Each rejected row is written to
+    error_writer (a csv.writer or ErrorFile) as (row_number, error, record) if one
+    is given, after a header row written with the first rejection.
+    progress(report) is called after every batch. Returns the ImportReport.
+    """
+    report = ImportReport()
+    rejected_any = False
+
+    def reject(row_number, message, record):
+        nonlocal rejected_any
+        if error_writer:
+            if not rejected_any:
+                error_writer.writerow(['row_number', 'error', 'record'])
+                rejected_any = True
+            error_writer.writerow([row_number, message, json.dumps(record, default=str) if record else ''])
+
+    # Pending rows: (row_number, record, document); ISBN -> position, to dedupe within the batch
+    batch, batch_isbns = [], {}
+
+    def flush():
+        rows = [row for row in batch if row is not None]
+        batch.clear()
+        batch_isbns.clear()
+        if not rows:
+            return
+        result = book_model.bulk_upsert_books([document for _, _, document in rows], ordered=ordered)
+        for index, message in result['errors'] + result['duplicates']:
+            row_number, record, _ = rows[index]
+            reject(row_number, message, record)
+        report.inserted += result['inserted']
+        report.updated += result['updated']
+        report.failed += len(result['errors'])
+        report.duplicates += len(result['duplicates'])
+        report.batches += 1
+        if progress:
+            progress(report)
+
+    for row_number, record, error in iter_records(stream, file_format):
+        report.rows += 1
+        if error is None:
+            book_kwargs, error = validate_record(record)
+        if error:
+            report.invalid += 1
+            reject(row_number, error, record)
+            continue
+
+        document = book_model.build_book_document(**book_kwargs)
+        isbn = document.get('isbn')
+        if isbn and isbn in batch_isbns:
+            # The later row wins; the earlier one is reported as superseded
+            earlier = batch_isbns[isbn]
+            reject(batch[earlier][0], f"Duplicate ISBN {isbn}: superseded by row {row_number}.", batch[earlier][1])
+            batch[earlier] = None
+            report.duplicates += 1
+        if isbn:
+            batch_isbns[isbn] = len(batch)
+        batch.append((row_number, record, document))
+
+        if len(batch) >= batch_size:
+            flush()
+
+    flush()
+    return report
+
+
+def detect_format(filename):
+    """Guesses the feed format from a file name ('jsonl' for .jsonl/.json, otherwise 'csv')."""
+    return 'jsonl' if filename.lower().endswith(('.jsonl', '.json', '.ndjson')) else 'csv'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import books from a CSV or JSONL feed.")
+    parser.add_argument('feed', help="Path to the CSV or JSONL file")
+    parser.add_argument('--format', choices=['csv', 'jsonl'], help="Feed format (default: from the file extension)")
+    parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE, help="Records per bulk_write")
+    parser.add_argument('--ordered', action='store_true', help="Stop each batch at its first database error")
+    parser.add_argument('--errors', default='import_errors.csv', help="Where to write the rejected rows")
+    args = parser.parse_args(argv)
+
+    from db import MongoConnection
+    from models import create_models
+
+    connection = MongoConnection.from_config()
+    book_model = create_models(connection)['book_model']
+
+    file_format = args.format or detect_format(args.feed)
+    with open(args.feed, encoding='utf-8-sig', newline='') as feed, ErrorFile(args.errors) as errors_file:
+        report = run_import(
+            feed, file_format, book_model,
+            batch_size=max(1, args.batch_size),
+            ordered=args.ordered,
+            error_writer=errors_file,
+            progress=lambda report: print(report.progress_line(), file=sys.stderr)
+        )
+
+    connection.close()
+
+    print(json.dumps(report.as_dict()))
+    if errors_file.created:
+        print(f"Rejected rows were written to {args.errors}", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
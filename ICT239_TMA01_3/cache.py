@@ -0,0 +1,102 @@
+from collections import OrderedDict
+import threading
+import time
+
+# Sentinel returned by CatalogCache.get when a key is not cached (None is a valid value)
+MISSING = object()
+
+
+class CatalogCache:
+    """
+    A small in-process cache used by the Book model to avoid a MongoDB round trip
+    for catalog reads that have not changed since the last request.
+
+    - Entries are evicted least-recently-used once max_entries is reached.
+    - Entries expire after ttl_seconds, which also bounds how stale another worker
+      process can be (invalidation only reaches the process that made the write).
+    - Every invalidation bumps the cache generation. A value read from the database
+      before an invalidation is not stored afterwards (see set()).
+    - A value can be stored with the catalog revision it was read at. get() with a
+      different revision treats it as missing, so a page whose ETag comes from the
+      current revision is never rendered from an entry another worker's write made stale.
+    """
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.generation = 0
+        self._entries = OrderedDict() # key -> (value, expires_at, revision)
+        self._lock = threading.Lock()
+
+        # Counters exposed through stats()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.stale = 0
+
+    def get(self, key, revision=None):
+        """
+        Returns the cached value for key, or MISSING if absent or expired. If revision
+        is given, a value stored with another revision is also MISSING.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            stale = entry is not None and revision is not None and entry[2] != revision
+            if entry is None or entry[1] <= time.monotonic() or stale:
+                if entry is not None:
+                    del self._entries[key]
+                self.stale += stale
+                self.misses += 1
+                return MISSING
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, generation=None, revision=None):
+        """
+        Stores value under key. Pass the generation read before querying the database
+        so that a value fetched before a concurrent invalidation is discarded, and the
+        revision the caller read before querying (if any) for get() to check.
+        """
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+
+            self._entries[key] = (value, time.monotonic() + self.ttl_seconds, revision)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate_where(self, predicate):
+        """Removes every entry for which predicate(key, value) is true."""
+        with self._lock:
+            self.generation += 1
+            stale_keys = [key for key, (value, _, _) in self._entries.items() if predicate(key, value)]
+            for key in stale_keys:
+                del self._entries[key]
+            self.invalidations += len(stale_keys)
+            return len(stale_keys)
+
+    def clear(self):
+        """Removes every entry."""
+        return self.invalidate_where(lambda key, value: True)
+
+    def stats(self):
+        """Returns the hit/miss counters and current size as a dictionary."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl_seconds,
+                'generation': self.generation,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'stale': self.stale
+            }
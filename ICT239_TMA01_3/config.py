@@ -1,6 +1,87 @@
-MONGODB_URI = "mongodb://localhost:27017/"
-DATABASE_NAME = "suss_library_db"
+import os
+
+MONGODB_URI = os.environ.get("MONGODB_URI", "mongodb://localhost:27017/")
+DATABASE_NAME = os.environ.get("DATABASE_NAME", "suss_library_db")
 COLLECTION_NAME = "books"
 
 # --- NEW REQUIRED VARIABLE FOR Q2(c) ---
 USER_COLLECTION_NAME = "users"
+
+# Returned loans moved out of 'loans' by archive.py, in (user, month) buckets
+LOAN_ARCHIVE_COLLECTION_NAME = "loans_archive"
+
+# Waitlist of users queueing for books with no copy available (see Hold in models.py)
+HOLD_COLLECTION_NAME = "holds"
+
+# Secret key is REQUIRED for Flask sessions to work.
+SECRET_KEY = os.environ.get("SECRET_KEY", "your_hard-to-guess_secret_key_for_suss_library")
+
+# --- MongoDB connection pool, per worker process (see db.py); each can be set from the environment ---
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", 50)) # Connections per worker; workers x this must fit the server's limit
+MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", 0)) # Connections kept open while idle
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", 5000)) # Fail a request instead of queueing forever for a connection
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000)) # Fail fast when MongoDB is unreachable
+
+# --- Catalog pagination ---
+CATALOG_PAGE_SIZE = 20 # Default number of titles per page on the Book Titles page
+CATALOG_MAX_PAGE_SIZE = 100 # Upper bound for the page_size query parameter
+
+# --- In-process catalog cache (see cache.py) ---
+CATALOG_CACHE_MAX_ENTRIES = 1024 # Least recently used entries are evicted beyond this size
+CATALOG_CACHE_TTL_SECONDS = 60 # Upper bound on staleness for writes made by other worker processes
+
+# --- Rendered book card cache (see render_book_cards in app.py) ---
+CARD_CACHE_MAX_ENTRIES = 5000 # Roughly the number of distinct cards kept per worker
+CARD_CACHE_TTL_SECONDS = 3600 # Cards are keyed by content version, so a long TTL is safe
+AVAILABILITY_MAX_IDS = 100 # Largest batch accepted by /api/availability
+ACTIVE_LOANS_SESSION_TTL_SECONDS = 300 # How long the session keeps the user's on-loan book ids (borrowing or returning refreshes them at once)
+
+# --- Full-text search (see search.py) ---
+SEARCH_SYNC_INTERVAL_SECONDS = 30 # How often a worker picks up books added by other workers
+SUGGEST_MAX_RESULTS = 10 # Largest number of autocomplete suggestions returned by /suggest
+
+# --- Bulk catalog import (see bulk_import.py) ---
+IMPORT_BATCH_SIZE = 1000 # Records written per bulk_write
+IMPORT_ERRORS_DIR = os.path.join(os.path.dirname(__file__), "import_errors") # Where the upload route keeps the rejected-row files
+
+# --- Overdue loan scanner (see overdue.py) ---
+OVERDUE_SCAN_INTERVAL_SECONDS = int(os.environ.get("OVERDUE_SCAN_INTERVAL_SECONDS", 300)) # Time between scans
+OVERDUE_SCAN_BATCH_SIZE = 500 # Loans flagged per batch
+OVERDUE_SCAN_MAX_BATCHES = 20 # Bounds the work of one scan; the rest is picked up by the next one
+OVERDUE_SCAN_IN_APP = os.environ.get("OVERDUE_SCAN_IN_APP", "0") == "1" # Run the scanner on a thread in each web worker (one scans at a time)
+OVERDUE_REPORT_LIMIT = 200 # Loans listed on the admin overdue report
+REFUSE_OVERDUE_RENEWALS = os.environ.get("REFUSE_OVERDUE_RENEWALS", "0") == "1" # Overdue loans must be returned, not renewed (off while make_loan backdates new loans)
+
+# --- Loan history archive (see archive.py) ---
+LOAN_ARCHIVE_AFTER_DAYS = int(os.environ.get("LOAN_ARCHIVE_AFTER_DAYS", 180)) # Returned loans older than this leave the 'loans' collection
+LOAN_ARCHIVE_BATCH_SIZE = 1000 # Loans moved per batch
+MY_LOANS_PAGE_SIZE = 50 # Loans shown per page on My Loans (active and archived history together)
+
+# --- Holds / waitlist (see Hold in models.py) ---
+HOLD_PICKUP_DAYS = int(os.environ.get("HOLD_PICKUP_DAYS", 3)) # How long a returned copy stays reserved for the user at the head of the queue
+HOLD_EXPIRY_BATCH_SIZE = 200 # Uncollected ready holds expired per overdue scan
+
+# --- Inventory reconciliation (see reconcile.py) ---
+RECONCILE_BATCH_SIZE = 500 # Books checked per aggregation (and per bulk_write of fixes)
+RECONCILE_SETTLE_SECONDS = 60 # Books changed more recently are left to the next run (a borrow or return may be in flight)
+
+# --- Loan event outbox and counters (see counters.py) ---
+LOAN_EVENTS_COLLECTION_NAME = "loan_events" # Outbox written by the Loan model
+LOAN_COUNTERS_COLLECTION_NAME = "loan_counters" # Counter documents per user, per book and per day
+LOAN_EVENT_BATCH_SIZE = 1000 # Events folded per bulk_write
+LOAN_EVENT_LAG_SECONDS = 5 # Events younger than this are left for the next pass (writes still in flight)
+LOAN_EVENT_RETENTION_DAYS = 90 # Consumed events are kept this long for the analytics jobs, then expire
+LOAN_EVENT_INTERVAL_SECONDS = int(os.environ.get("LOAN_EVENT_INTERVAL_SECONDS", 10)) # Time between consumer passes
+LOAN_EVENT_CONSUMER_IN_APP = os.environ.get("LOAN_EVENT_CONSUMER_IN_APP", "0") == "1" # Run the consumer on a thread in each web worker (one consumes at a time)
+
+# --- Popularity and trend analytics (see analytics.py) ---
+ANALYTICS_POPULARITY_DAYS = 30 # Borrows in this many days make up a book's popularity (sort by popularity)
+ANALYTICS_TOP_MAX = 50 # Longest precomputed top list; /analytics/top serves up to this many books
+ANALYTICS_TREND_MAX_DAYS = 90 # Longest category trend served by /analytics/category_trend
+
+# --- "Borrowers also borrowed" recommendations (see recommendations.py) ---
+RECOMMENDATIONS_COLLECTION_NAME = "book_recommendations" # Precomputed related books, one document per book
+RECOMMEND_TOP_K = 6 # Related books kept per book (and shown on the detail page)
+RECOMMEND_MIN_TOGETHER = 2 # Borrowers two books must share before one is recommended for the other
+RECOMMEND_BLOCK_SIZE = 256 # Books whose similarities are computed together (bounds the block x books arrays)
+RECOMMEND_CHUNK_PAIRS = 1000000 # Co-borrowed (book, book) pairs expanded at once when counting a block (bounds memory)
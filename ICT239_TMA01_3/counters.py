@@ -0,0 +1,262 @@
+"""
+Folds the loan_events outbox into small counter documents.
+
+The Loan model appends one event per borrow, renewal, return and deletion to
+loan_events: {type, loan_id, user_id, book_id, at}. This consumer reads them in
+_id order, LOAN_EVENT_BATCH_SIZE at a time, and applies each batch to the
+loan_counters collection with one bulk_write of $inc upserts:
+
+    user:<user_id>      active_loans, borrows
+    book:<book_id>      active_loans, borrows, renewals
+    day:<YYYY-MM-DD>    borrows, renewals, returns (UTC days)
+    totals              active_loans, borrows, renewals, returns
+
+so a page that needs one of these numbers reads one small document instead of
+counting loans. The position in the outbox is kept in the same collection and
+written by the same bulk_write; on a replica set it runs in a transaction, so a
+batch is counted exactly once. Elsewhere a crash in the middle of a bulk_write
+can count part of one batch twice.
+
+A lease in app_meta makes sure only one process consumes at a time, so the
+consumer can run in every web worker (LOAN_EVENT_CONSUMER_IN_APP) or on its own:
+
+    python counters.py           # consume every LOAN_EVENT_INTERVAL_SECONDS until stopped
+    python counters.py --once    # consume the pending events, then exit
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+from datetime import datetime, timedelta, timezone
+
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+
+from config import (
+    LOAN_COUNTERS_COLLECTION_NAME, LOAN_EVENTS_COLLECTION_NAME, LOAN_EVENT_BATCH_SIZE,
+    LOAN_EVENT_LAG_SECONDS, LOAN_EVENT_RETENTION_DAYS, LOAN_EVENT_INTERVAL_SECONDS
+)
+from models import (
+    acquire_lease, ensure_collection_indexes,
+    LOAN_BORROWED, LOAN_RENEWED, LOAN_RETURNED
+)
+
+# Event type -> ($inc on the user, $inc on the book, $inc on the day and the totals)
+EVENT_INCREMENTS = {
+    LOAN_BORROWED: ({'active_loans': 1, 'borrows': 1}, {'active_loans': 1, 'borrows': 1}, {'borrows': 1}),
+    LOAN_RENEWED: ({}, {'renewals': 1}, {'renewals': 1}),
+    LOAN_RETURNED: ({'active_loans': -1}, {'active_loans': -1}, {'returns': 1})
+    # Deleting a returned loan record does not undo its borrow
+}
+
+
+class LoanCounters:
+    """Consumes the loan_events outbox into per-user, per-book and per-day counters, and reads them."""
+
+    # (name, keys, options) for the indexes on loan_counters
+    COUNTER_INDEXES = [
+        # Most borrowed books (top_books)
+        ('kind_borrows', [('kind', 1), ('borrows', -1)], {})
+    ]
+
+    # (name, keys, options) for the indexes on loan_events
+    EVENT_INDEXES = [
+        # Events expire once every consumer (counters, analytics) has long read them
+        ('at_ttl', [('at', 1)], {'expireAfterSeconds': LOAN_EVENT_RETENTION_DAYS * 24 * 60 * 60})
+    ]
+
+    LEASE_ID = 'loan_counters_lease'
+    CHECKPOINT_ID = 'checkpoint'
+    TOTALS_ID = 'totals'
+
+    def __init__(self, connection, batch_size=LOAN_EVENT_BATCH_SIZE, lag_seconds=LOAN_EVENT_LAG_SECONDS,
+                 interval_seconds=LOAN_EVENT_INTERVAL_SECONDS):
+        self.connection = connection
+        self.batch_size = batch_size
+        self.lag_seconds = lag_seconds
+        self.interval_seconds = interval_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{id(self)}"
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def events_collection(self):
+        return self.connection.db[LOAN_EVENTS_COLLECTION_NAME]
+
+    @property
+    def collection(self):
+        return self.connection.db[LOAN_COUNTERS_COLLECTION_NAME]
+
+    @property
+    def meta_collection(self):
+        return self.connection.db['app_meta']
+
+    def ensure_indexes(self):
+        """Creates and verifies the indexes on loan_counters and loan_events."""
+        return (ensure_collection_indexes(self.collection, self.COUNTER_INDEXES)
+                + ensure_collection_indexes(self.events_collection, self.EVENT_INDEXES))
+
+    # --- Consuming ---
+
+    def consume(self, max_batches=None, now=None):
+        """
+        Folds the events written since the checkpoint into the counters, in batches.
+        Events younger than lag_seconds are left for the next pass: their _id was taken
+        when they were written, and an older one may still be in an open transaction.
+        Returns the statistics of this pass as a dictionary.
+        """
+        now = now or datetime.now(timezone.utc)
+        horizon = ObjectId.from_datetime(now - timedelta(seconds=self.lag_seconds))
+        checkpoint = self.collection.find_one({'_id': self.CHECKPOINT_ID}) or {}
+        last_event_id = checkpoint.get('last_event_id')
+        stats = {'events': 0, 'batches': 0}
+
+        while max_batches is None or stats['batches'] < max_batches:
+            query = {'_id': {'$lt': horizon}}
+            if last_event_id is not None:
+                query['_id']['$gt'] = last_event_id
+            batch = list(self.events_collection.find(query).sort('_id', 1).limit(self.batch_size))
+            if not batch:
+                break
+
+            last_event_id = batch[-1]['_id']
+            self._apply(batch, last_event_id)
+            stats['events'] += len(batch)
+            stats['batches'] += 1
+            if len(batch) < self.batch_size:
+                break
+
+        stats['checkpoint'] = last_event_id
+        return stats
+
+    def _apply(self, events, last_event_id):
+        """Adds up the increments of a batch per counter document and writes them with the checkpoint."""
+        increments = {} # counter _id -> ($setOnInsert fields, {field: increment})
+        def add(counter_id, identity, fields):
+            if fields:
+                counter = increments.setdefault(counter_id, (identity, {}))[1]
+                for field, amount in fields.items():
+                    counter[field] = counter.get(field, 0) + amount
+
+        for event in events:
+            user_fields, book_fields, day_fields = EVENT_INCREMENTS.get(event['type'], ({}, {}, {}))
+            day = event['at'].strftime('%Y-%m-%d')
+            add(f"user:{event['user_id']}", {'kind': 'user', 'user_id': event['user_id']}, user_fields)
+            add(f"book:{event['book_id']}", {'kind': 'book', 'book_id': event['book_id']}, book_fields)
+            add(f"day:{day}", {'kind': 'day', 'day': day}, day_fields)
+            add(self.TOTALS_ID, {'kind': 'totals'}, dict(user_fields, **day_fields))
+
+        now = datetime.now(timezone.utc)
+        operations = [
+            UpdateOne({'_id': counter_id}, {'$inc': fields, '$set': {'updated_at': now}, '$setOnInsert': identity}, upsert=True)
+            for counter_id, (identity, fields) in increments.items()
+        ]
+        operations.append(UpdateOne(
+            {'_id': self.CHECKPOINT_ID},
+            {'$set': {'last_event_id': last_event_id, 'updated_at': now}},
+            upsert=True
+        ))
+
+        if self.connection.supports_transactions:
+            with self.connection.client.start_session() as session:
+                session.with_transaction(lambda s: self.collection.bulk_write(operations, ordered=False, session=s))
+        else:
+            self.collection.bulk_write(operations, ordered=False)
+
+    # --- Reading ---
+
+    def get_user_counters(self, user_id):
+        """Returns {'active_loans', 'borrows'} of a user (zeros before their first event)."""
+        counters = self.collection.find_one({'_id': f"user:{user_id}"}) or {}
+        return {'active_loans': counters.get('active_loans', 0), 'borrows': counters.get('borrows', 0)}
+
+    def get_book_counters(self, book_id):
+        """Returns {'active_loans', 'borrows', 'renewals'} of a book."""
+        counters = self.collection.find_one({'_id': f"book:{book_id}"}) or {}
+        return {field: counters.get(field, 0) for field in ('active_loans', 'borrows', 'renewals')}
+
+    def get_daily_counts(self, days=14, today=None):
+        """Returns [{'day', 'borrows', 'renewals', 'returns'}] for the last days UTC days, oldest first."""
+        today = (today or datetime.now(timezone.utc)).date()
+        keys = [(today - timedelta(days=offset)).strftime('%Y-%m-%d') for offset in range(days - 1, -1, -1)]
+        found = {doc['day']: doc for doc in self.collection.find({'_id': {'$in': [f"day:{key}" for key in keys]}})}
+        return [
+            {'day': key, **{field: found.get(key, {}).get(field, 0) for field in ('borrows', 'renewals', 'returns')}}
+            for key in keys
+        ]
+
+    def top_books(self, limit=10):
+        """Returns [{'book_id', 'borrows'}] for the most borrowed books of all time (kind_borrows index)."""
+        return list(self.collection.find({'kind': 'book'}, {'_id': 0, 'book_id': 1, 'borrows': 1})
+                    .sort('borrows', -1).limit(limit))
+
+    def get_stats(self):
+        """Returns the library totals, the last two weeks, the top books and the consumer checkpoint."""
+        totals = self.collection.find_one({'_id': self.TOTALS_ID}, {'_id': 0, 'kind': 0}) or {}
+        checkpoint = self.collection.find_one({'_id': self.CHECKPOINT_ID}, {'_id': 0}) or {}
+        if checkpoint.get('last_event_id'):
+            checkpoint['last_event_id'] = str(checkpoint['last_event_id'])
+        return {
+            'totals': totals,
+            'daily': self.get_daily_counts(),
+            'top_books': self.top_books(),
+            'checkpoint': checkpoint
+        }
+
+    # --- Scheduling ---
+
+    def run_once(self):
+        """Consumes if this process holds the lease. Returns the statistics, or None."""
+        # The lease outlives the interval a little so a slow pass is not started twice
+        if not acquire_lease(self.meta_collection, self.LEASE_ID, self.owner, self.interval_seconds * 2):
+            return None
+        return self.consume()
+
+    def run_forever(self):
+        """Consumes every interval_seconds until stop() is called."""
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Loan event consumer failed: {e}")
+            self._stop.wait(self.interval_seconds)
+
+    def start(self):
+        """Starts run_forever on a daemon thread (once per process)."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run_forever, name='loan-counters', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fold the loan event outbox into the loan counters.")
+    parser.add_argument('--once', action='store_true', help="Consume the pending events and exit")
+    parser.add_argument('--interval', type=int, default=LOAN_EVENT_INTERVAL_SECONDS, help="Seconds between passes")
+    parser.add_argument('--batch-size', type=int, default=LOAN_EVENT_BATCH_SIZE, help="Events folded per batch")
+    args = parser.parse_args(argv)
+
+    from db import MongoConnection
+
+    connection = MongoConnection.from_config()
+    counters = LoanCounters(connection, batch_size=max(1, args.batch_size), interval_seconds=max(1, args.interval))
+
+    try:
+        if args.once:
+            print(json.dumps(counters.consume(), default=str))
+        else:
+            counters.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        connection.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,98 @@
+import os
+import threading
+
+from pymongo import MongoClient
+
+import config
+
+# Setting name (config.py / app.config) -> MongoClient keyword argument
+POOL_SETTINGS = {
+    'MONGO_MAX_POOL_SIZE': 'maxPoolSize',
+    'MONGO_MIN_POOL_SIZE': 'minPoolSize',
+    'MONGO_WAIT_QUEUE_TIMEOUT_MS': 'waitQueueTimeoutMS',
+    'MONGO_SERVER_SELECTION_TIMEOUT_MS': 'serverSelectionTimeoutMS'
+}
+
+
+class MongoConnection:
+    """
+    Holds the MongoClient of the current process, created on first use.
+
+    - Nothing connects at import time or in create_app, so a pre-fork server
+      (e.g. gunicorn) never hands a client with open sockets and monitor threads
+      to its workers.
+    - If the process id changes (the connection object was inherited through fork),
+      a new client is created for the child; the parent's client is left alone.
+    - The models are given this object rather than a client, so they always use
+      the client of the process they run in.
+    """
+
+    def __init__(self, uri, database_name, **client_options):
+        self.uri = uri
+        self.database_name = database_name
+        self.client_options = client_options
+        self._client = None
+        self._pid = None
+        self._supports_transactions = None
+        self._lock = threading.Lock()
+        if hasattr(os, 'register_at_fork'):
+            # A lock held by another thread at fork time would stay locked in the child
+            os.register_at_fork(after_in_child=self._reset_lock)
+
+    @classmethod
+    def from_config(cls, settings=None):
+        """
+        Builds a connection from a mapping such as app.config. Settings missing
+        from the mapping fall back to config.py.
+        """
+        settings = settings or {}
+
+        def setting(name):
+            return settings.get(name, getattr(config, name))
+
+        client_options = {option: setting(name) for name, option in POOL_SETTINGS.items()}
+        return cls(setting('MONGODB_URI'), setting('DATABASE_NAME'), **client_options)
+
+    def _reset_lock(self):
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        """The MongoClient of the current process."""
+        pid = os.getpid()
+        if self._client is None or self._pid != pid:
+            with self._lock:
+                if self._client is None or self._pid != pid:
+                    self._client = MongoClient(self.uri, **self.client_options)
+                    self._pid = pid
+                    self._supports_transactions = None
+        return self._client
+
+    @property
+    def db(self):
+        """The application database on the current process's client."""
+        return self.client[self.database_name]
+
+    @property
+    def supports_transactions(self):
+        """
+        True if the server is a replica set member or a mongos, the deployments that
+        support multi-document transactions. Asked once per client.
+        """
+        client = self.client
+        if self._supports_transactions is None:
+            try:
+                hello = client.admin.command('hello')
+                self._supports_transactions = bool(hello.get('setName')) or hello.get('msg') == 'isdbgrid'
+            except Exception as e:
+                print(f"Could not detect transaction support, assuming none: {e}")
+                self._supports_transactions = False
+        return self._supports_transactions
+
+    def close(self):
+        """Closes the client if this process created one."""
+        with self._lock:
+            if self._client is not None and self._pid == os.getpid():
+                self._client.close()
+            self._client = None
+            self._pid = None
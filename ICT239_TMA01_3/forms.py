@@ -0,0 +1,73 @@
+from flask_wtf import FlaskForm
+from wtforms import (
+    Form, StringField, TextAreaField, IntegerField, SelectMultipleField, SubmitField,
+    FieldList, FormField, SelectField
+)
+from wtforms.validators import DataRequired, NumberRange, Optional, Length
+# This import is necessary for the CATEGORY_CHOICES in BookRecordForm
+from books_data import ALL_CATEGORIES
+
+
+GENRE_CHOICES = [
+    ("Animals", "Animals"), ("Business", "Business"), ("Comics", "Comics"),
+    ("Communication", "Communication"), ("Dark Academia", "Dark Academia"),
+    ("Emotion", "Emotion"), ("Fantasy", "Fantasy"), ("Fiction", "Fiction"),
+    ("Friendship", "Friendship"), ("Graphic Novels", "Graphic Novels"),
+    ("Grief", "Grief"), ("Historical Fiction", "Historical Fiction"),
+    ("Indigenous", "Indigenous"), ("Inspirational", "Inspirational"),
+    ("Magic", "Magic"), ("Mental Health", "Mental Health"),
+    ("Nonfiction", "Nonfiction"), ("Personal Development", "Personal Development"),
+    ("Philosophy", "Philosophy"), ("Picture Books", "Picture Books"),
+    ("Poetry", "Poetry"), ("Productivity", "Productivity"),
+    ("Psychology", "Psychology"), ("Romance", "Romance"),
+    ("School", "School"), ("Self Help", "Self Help")
+]
+
+# Create choices list for the Category SelectField
+CATEGORY_CHOICES = [(c, c) for c in ALL_CATEGORIES]
+
+
+# --- Shared Validation Rules ---
+# Plain wtforms.Form classes (no CSRF, no request needed), so the same rules can
+# validate records outside a request, e.g. in bulk_import.py.
+
+class AuthorFields(Form):
+    # This field name must match the one used in the HTML: author_field.author_name
+    author_name = StringField('Author Name', validators=[Optional(), Length(max=100)])
+
+
+class BookRecordForm(Form):
+    title = StringField('Title', validators=[DataRequired(), Length(max=255)])
+    cover_image = StringField('Cover Image Filename (e.g., cover1.jpg)', validators=[DataRequired(), Length(max=255)])
+    isbn = StringField('ISBN', validators=[Optional(), Length(max=20)])
+    publication_year = IntegerField('Publication Year',
+                                     validators=[Optional(), NumberRange(min=1000, max=2025)],
+                                     render_kw={"placeholder": "e.g., 2024"})
+    genres = SelectMultipleField('Genres (Hold Ctrl/Cmd to select multiple)',
+                                     choices=GENRE_CHOICES,
+                                     validators=[Optional()])
+    publisher = StringField('Publisher', validators=[Optional(), Length(max=100)])
+    description = TextAreaField('Description', validators=[DataRequired()])
+    page_count = IntegerField('Page Count', validators=[Optional(), NumberRange(min=1)])
+    
+    # NEW FIELDS FOR Q2(b)
+    category = SelectField('Category', choices=CATEGORY_CHOICES, validators=[DataRequired()])
+    copies = IntegerField('Total Copies', validators=[DataRequired(), NumberRange(min=1)], default=1)
+    available = IntegerField('Available Copies', validators=[DataRequired(), NumberRange(min=0)], default=1)
+    # END NEW FIELDS
+
+
+# --- Dynamic Author Form for FieldList ---
+class SimpleAuthorForm(FlaskForm, AuthorFields):
+    pass
+
+
+class NewBookForm(FlaskForm, BookRecordForm):
+    # REPLACED: FieldList for dynamic author input (Bonus Implementation)
+    authors_text = FieldList(
+        FormField(SimpleAuthorForm),
+        min_entries=1, # Ensures at least one author field is always displayed
+        label='Book Authors'
+    ) 
+    
+    submit = SubmitField('Submit Book')
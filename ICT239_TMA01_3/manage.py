@@ -0,0 +1,92 @@
+"""
+Database management commands. Run once per deployment, before starting the web workers:
+
+    python manage.py init       # migrate, then seed
+    python manage.py migrate    # create/verify indexes, backfill derived fields, record the schema version
+    python manage.py seed       # upsert the seed books and the required users
+    python manage.py version    # print the recorded and the expected schema version
+
+Importing models does no database I/O; everything here used to run as a side
+effect of importing it in every worker process.
+"""
+import argparse
+import sys
+
+from books_data import BOOKS # Used for initial data seeding
+from db import MongoConnection
+from overdue import OverdueScanner
+from archive import LoanArchiver
+from counters import LoanCounters
+from analytics import LoanAnalytics
+from models import (
+    create_models, ensure_all_indexes,
+    get_schema_version, record_schema_version, SCHEMA_VERSION
+)
+
+# No connection is opened until a command runs
+connection = MongoConnection.from_config()
+models = create_models(connection)
+
+# The admin and non-admin users required by Q2(c)
+SEED_USERS = [
+    {'email': 'admin@lib.sg', 'password': '12345', 'name': 'Admin'},
+    {'email': 'poh@lib.sg', 'password': '12345', 'name': 'Peter Oh'}
+]
+
+
+def migrate():
+    """Creates and verifies every index, backfills derived fields and records the schema version."""
+    for collection_name, index_names in ensure_all_indexes(models).items():
+        print(f"Indexes on '{collection_name}': {', '.join(index_names)}")
+    print(f"Indexes on 'overdue_events': {', '.join(OverdueScanner(connection).ensure_indexes())}")
+    print(f"Indexes on the loan archive: {', '.join(LoanArchiver(connection).ensure_indexes())}")
+    print(f"Indexes on the loan counters and events: {', '.join(LoanCounters(connection).ensure_indexes())}")
+    print(f"Indexes on the analytics rollups: {', '.join(LoanAnalytics(connection, models['book_model']).ensure_indexes())}")
+
+    refreshed = models['book_model'].refresh_stale_display_fields()
+    print(f"Refreshed derived display fields of {refreshed} books.")
+    backfilled = models['book_model'].backfill_popularity()
+    print(f"Set the initial popularity of {backfilled} books.")
+    backfilled = models['book_model'].backfill_content_updated_at()
+    print(f"Set the content timestamp of {backfilled} books.")
+
+    record_schema_version(connection)
+    print(f"Schema version is now {SCHEMA_VERSION}.")
+
+
+def seed():
+    """Upserts the seed books and required users; existing documents are left as they are."""
+    inserted = models['book_model'].seed_books(BOOKS)
+    print(f"Seeded {inserted} new books ({len(BOOKS) - inserted} already present).")
+
+    for email in models['user_model'].seed_users(SEED_USERS):
+        print(f"Seeded user: {email}")
+
+
+def version():
+    """Prints the recorded and expected schema versions."""
+    print(f"Recorded schema version: {get_schema_version(connection)} (expected {SCHEMA_VERSION})")
+
+
+COMMANDS = {
+    'init': lambda: (migrate(), seed()),
+    'migrate': migrate,
+    'seed': seed,
+    'version': version
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SG Library database management.")
+    parser.add_argument('command', choices=sorted(COMMANDS), help="What to run")
+    args = parser.parse_args(argv)
+
+    try:
+        COMMANDS[args.command]()
+    finally:
+        connection.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
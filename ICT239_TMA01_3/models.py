@@ -1,18 +1,28 @@
-from pymongo import MongoClient
+from pymongo import InsertOne, UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from bson.objectid import ObjectId
 from werkzeug.security import generate_password_hash, check_password_hash
-from books_data import BOOKS # Used for initial data seeding
-from config import MONGODB_URI, DATABASE_NAME, COLLECTION_NAME, USER_COLLECTION_NAME
-from bson.objectid import ObjectId
-from datetime import datetime, timedelta
+from config import (
+    COLLECTION_NAME, USER_COLLECTION_NAME, LOAN_ARCHIVE_COLLECTION_NAME, HOLD_COLLECTION_NAME,
+    LOAN_EVENTS_COLLECTION_NAME,
+    HOLD_PICKUP_DAYS, HOLD_EXPIRY_BATCH_SIZE, REFUSE_OVERDUE_RENEWALS,
+    CATALOG_PAGE_SIZE, CATALOG_CACHE_MAX_ENTRIES, CATALOG_CACHE_TTL_SECONDS
+)
+from cache import CatalogCache, MISSING
+from datetime import datetime, timedelta, timezone
+import base64
+import hashlib
+import json
 import random
 
-# --- Common MongoDB Client Setup ---
-client = MongoClient(MONGODB_URI)
-db = client[DATABASE_NAME]
+# Server error code of a unique index violation (DuplicateKeyError), as reported per write by bulk_write
+DUPLICATE_KEY_ERROR_CODE = 11000
 
 # --- Q4(c) NEW HELPER FUNCTION: Capped Random Date Generation ---
 
+# Upper bound on the simulated delay between a loan event and its update
+MAX_DELAY_DAYS = 3
+
 def get_capped_new_loan_date(original_date):
     """
     Calculates a new date for renewal or return. The date is a random time 
@@ -25,8 +35,6 @@ def get_capped_new_loan_date(original_date):
     :param original_date: The starting datetime object (e.g., borrow_date).
     :return: A capped, randomized datetime object.
     """
-    MAX_DELAY_DAYS = 3
-    
     # 1. Calculate the maximum potential date (original date + 3 days)
     max_potential_date = original_date + timedelta(days=MAX_DELAY_DAYS)
 
@@ -50,6 +58,185 @@ def get_capped_new_loan_date(original_date):
     # 6. Convert the random timestamp back to a datetime object.
     return datetime.fromtimestamp(random_timestamp)
 
+
+def capped_new_loan_date_expression(field):
+    """
+    Aggregation expression computing get_capped_new_loan_date from a stored date field,
+    for pipeline updates that change a loan in one round trip without reading it first.
+    The random fraction and the cap (now) are chosen here; the server does the arithmetic.
+    """
+    cap_date = datetime.now()
+    latest_allowed_date = {'$min': [{'$add': [field, MAX_DELAY_DAYS * 24 * 60 * 60 * 1000]}, cap_date]}
+    return {'$let': {
+        'vars': {'latest': latest_allowed_date},
+        'in': {'$cond': [
+            {'$lte': ['$$latest', field]},
+            cap_date,
+            # Adding milliseconds to a date gives a date
+            {'$add': [field, {'$multiply': [random.random(), {'$subtract': ['$$latest', field]}]}]}
+        ]}
+    }}
+
+# --- Index Bootstrap Helpers ---
+
+def ensure_collection_indexes(collection, index_specs, retired=()):
+    """
+    Creates every index in index_specs on the collection and verifies that they exist.
+    Each spec is a (name, keys, options) tuple. create_index is a no-op for existing indexes.
+    Indexes named in retired (replaced by a later version) are dropped if present.
+    """
+    if retired:
+        existing = collection.index_information()
+        for name in retired:
+            if name in existing:
+                collection.drop_index(name)
+
+    for name, keys, options in index_specs:
+        collection.create_index(keys, name=name, **options)
+
+    existing = collection.index_information()
+    missing = [name for name, _, _ in index_specs if name not in existing]
+    if missing:
+        raise RuntimeError(f"Missing indexes on '{collection.name}': {', '.join(missing)}")
+    return [name for name, _, _ in index_specs]
+
+
+# --- Background Job Leases ---
+
+def acquire_lease(meta_collection, lease_id, owner, seconds):
+    """
+    Takes (or renews) the lease document lease_id in app_meta for owner, for seconds.
+    Returns False while another owner holds an unexpired lease. Background jobs that
+    may run in several processes (overdue.py, counters.py) scan only while they hold it.
+    """
+    now = datetime.now()
+    try:
+        meta_collection.find_one_and_update(
+            {'_id': lease_id, '$or': [{'expires_at': {'$lte': now}}, {'owner': owner}]},
+            {'$set': {'owner': owner, 'expires_at': now + timedelta(seconds=seconds)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # The lease document exists and belongs to someone else
+        return False
+
+
+def normalize_category(category):
+    """Returns the key used to match categories by equality (trimmed and lower-cased)."""
+    return (category or '').strip().lower()
+
+# --- Precomputed Display Fields ---
+
+# Bump this whenever build_display_fields changes so stored documents get re-derived
+DISPLAY_FIELDS_VERSION = 3
+
+# Only the fields the book card on the Book Titles page actually uses
+LIST_PROJECTION = {
+    'title': 1, 'primary_author': 1, 'category': 1, 'genres_text': 1, 'pages': 1,
+    'first_para': 1, 'last_para': 1, 'image_file': 1, 'copies': 1, 'available': 1,
+    'content_version': 1
+}
+
+# Only the book fields the My Loans page shows next to each loan
+LOAN_BOOK_PROJECTION = {'title': 1, 'primary_author': 1, 'image_file': 1}
+
+# Fields shown on a book card apart from the live Copies/Available numbers
+CARD_CONTENT_FIELDS = (
+    'title', 'primary_author', 'category', 'genres_text', 'pages',
+    'first_para', 'last_para', 'image_file'
+)
+
+def split_description(description):
+    """Splits a description into its non-empty sentences, each ending with a period."""
+    return [p.strip() + "." for p in (description or '').split('.') if p.strip()]
+
+
+def build_display_fields(book_doc):
+    """
+    Derives the display data for a book document (sentence list, first/last
+    paragraph, author and genre strings) so pages do not recompute it per request,
+    plus the normalized category key used for filtering.
+    These fields are stored alongside the document whenever it is written.
+    """
+    paragraphs = split_description(book_doc.get('description', ''))
+
+    first_paragraph = paragraphs[0] if paragraphs else ""
+    last_paragraph = ""
+    if len(paragraphs) > 1 and first_paragraph != paragraphs[-1]:
+        last_paragraph = paragraphs[-1]
+
+    # Handling both the 'authors' list and the older single 'author' string
+    authors = book_doc.get('authors')
+    if authors and isinstance(authors, list):
+        primary_author = authors[0]
+        authors_text = ", ".join(authors)
+    else:
+        primary_author = book_doc.get('author') or 'N/A'
+        authors_text = primary_author
+
+    display_fields = {
+        'description_paragraphs': paragraphs,
+        'first_para': first_paragraph,
+        'last_para': last_paragraph,
+        'primary_author': primary_author,
+        'authors_text': authors_text,
+        'genres_text': ", ".join(book_doc.get('genres') or []),
+        'category_key': normalize_category(book_doc.get('category')),
+        'display_version': DISPLAY_FIELDS_VERSION
+    }
+
+    # Short hash of the card content; rendered card fragments are cached under it
+    card_content = {**book_doc, **display_fields}
+    raw = json.dumps([card_content.get(field) for field in CARD_CONTENT_FIELDS], default=str)
+    display_fields['content_version'] = hashlib.sha1(raw.encode('utf-8')).hexdigest()[:16]
+
+    return display_fields
+
+# --- Catalog Facets ---
+
+# Page-count ranges offered as a facet: (key, label, lower bound, upper bound or None)
+PAGE_RANGES = [
+    ('under-200', 'Under 200 pages', 0, 200),
+    ('200-399', '200-399 pages', 200, 400),
+    ('400-plus', '400+ pages', 400, None)
+]
+
+def normalize_filters(genres=None, pages=None, available=False):
+    """
+    Returns the facet filters as a hashable tuple (genres, pages, available),
+    which is also used as part of the catalog cache keys. Unknown page ranges are ignored.
+    """
+    valid_pages = pages if pages in {key for key, _, _, _ in PAGE_RANGES} else None
+    return (tuple(sorted(set(genres or []))), valid_pages, bool(available))
+
+
+NO_FILTERS = normalize_filters()
+
+# --- Keyset Pagination Cursor Helpers ---
+
+def encode_page_cursor(title, object_id):
+    """
+    Encodes the (title, _id) of the last book on a page into an opaque,
+    URL-safe cursor string used to request the following page.
+    Also used for popularity-sorted pages and My Loans pages, with the popularity or
+    the borrow date (ISO format) in place of the title.
+    """
+    raw = json.dumps([title, str(object_id)]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_page_cursor(cursor):
+    """
+    Decodes a cursor produced by encode_page_cursor.
+    Returns a (title, ObjectId) tuple, or None if the cursor is malformed.
+    """
+    try:
+        title, object_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return title, ObjectId(object_id)
+    except Exception:
+        return None
+
 # --- Q2(b) Book Model ---
 
 class Book:
@@ -57,78 +244,458 @@ class Book:
     Represents the Book document structure and handles interaction with 
     the MongoDB 'books' collection.
     """
+
+    # (name, keys, options) for every index the Book queries rely on
+    INDEXES = [
+        # Category filter by equality, then title order (with _id as the keyset tie-breaker)
+        ('category_key_title', [('category_key', 1), ('title', 1), ('_id', 1)], {}),
+        # Unfiltered catalog listing in title order
+        ('title_id', [('title', 1), ('_id', 1)], {}),
+        # Books written since a point in time (inventory reconciliation)
+        ('updated_at', [('updated_at', 1)], {}),
+        # Books whose searchable text changed since a point in time (incremental search and suggestion sync)
+        ('content_updated_at', [('content_updated_at', 1)], {}),
+        # Genre facet filter (multikey), then title order
+        ('genres_title', [('genres', 1), ('title', 1), ('_id', 1)], {}),
+        # At most one book per ISBN: bulk import upserts on it, and two imports (or an import
+        # and /new_book) writing the same ISBN at once get a duplicate key error instead of
+        # two books. Books without an ISBN are left out.
+        ('isbn_unique', [('isbn', 1)], {'unique': True, 'partialFilterExpression': {'isbn': {'$gt': ''}}}),
+        # Catalog listing by popularity (sort='popular'), unfiltered and by category
+        ('popularity_id', [('popularity', -1), ('_id', 1)], {}),
+        ('category_key_popularity', [('category_key', 1), ('popularity', -1), ('_id', 1)], {})
+    ]
+
+    # Indexes created by earlier versions and since replaced by the ones above
+    RETIRED_INDEXES = ['isbn']
+
+    # Orders offered by get_books_page: name -> (sort field, direction)
+    SORT_ORDERS = {'title': ('title', 1), 'popular': ('popularity', -1)}
     
-    def __init__(self):
-        self.collection = db[COLLECTION_NAME] # This is the 'books' collection
-        self.loans_collection = db['loans'] # Collection for tracking loans (though now primarily managed by Loan class)
-        self._seed_data_if_empty()
+    # Key of the catalog_meta document that tracks changes to the whole catalog
+    ALL_CATALOG_KEY = '_all'
+
+    def __init__(self, connection):
+        # A db.MongoConnection; collections are looked up through it on every use so
+        # that each worker process talks to MongoDB through its own client
+        self.connection = connection
+        # In-process cache for catalog reads, invalidated by the write methods below.
+        # Keys: ('page', category_key, page_size, cursor, sort, filters), ('count', category_key, filters),
+        # ('facets', category_key, filters) and ('book', book_id); category_key is None for 'All'.
+        self.cache = CatalogCache(CATALOG_CACHE_MAX_ENTRIES, CATALOG_CACHE_TTL_SECONDS)
+        # Callables notified with each newly inserted book document (e.g. the search index)
+        self.insert_listeners = []
+
+    @property
+    def collection(self):
+        return self.connection.db[COLLECTION_NAME] # This is the 'books' collection
+
+    @property
+    def meta_collection(self):
+        # One {revision, updated_at} document per category_key (and ALL_CATALOG_KEY),
+        # used by the routes to answer conditional GETs without reading any books
+        return self.connection.db['catalog_meta']
+
+    @property
+    def loans_collection(self):
+        return self.connection.db['loans'] # Collection for tracking loans (though now primarily managed by Loan class)
 
-    def _seed_data_if_empty(self):
+    # --- Seeding and Migrations (run by manage.py, never at import time) ---
+
+    def seed_books(self, books):
         """
-        Reads initial data from BOOKS if the collection is empty and populates MongoDB.
+        Upserts the seed books in one bulk_write keyed on their title (the natural key
+        of the seed data). Existing books are left untouched, so this is safe to re-run.
+        Returns the number of books inserted.
         """
-        if self.collection.count_documents({}) == 0:
-            print("Book collection is empty. Seeding initial data...")
+        operations = []
+        category_keys = set()
+        for book in books:
+            book_doc = {key: value for key, value in book.items() if key != 'id'} # 'id' is the data file's own numbering
+            book_doc['author'] = book_doc['authors'][0] if book_doc.get('authors') else book_doc.get('author', 'Unknown')
             
-            # Prepare books for insertion, ensuring we use correct fields
-            books_to_insert = []
-            for book in BOOKS:
-                book_doc = book.copy()
-                book_doc['author'] = book_doc['authors'][0] if book_doc.get('authors') else 'Unknown'
-                
-                # Ensure new book documents have default copies/available counts
-                book_doc['copies'] = book_doc.get('copies', 1) 
-                book_doc['available'] = book_doc.get('available', 1)
-                
-                books_to_insert.append(book_doc)
-                
-            self.collection.insert_many(books_to_insert)
-            print(f"Seeded {len(books_to_insert)} books.")
-
-    def get_all_books(self, category='All'):
-        """
-        Retrieves all books, optionally filtered by category, sorted by title.
+            # Ensure new book documents have default copies/available counts
+            book_doc['copies'] = book_doc.get('copies', 1) 
+            book_doc['available'] = book_doc.get('available', 1)
+            book_doc['popularity'] = 0
+
+            book_doc.update(build_display_fields(book_doc))
+            book_doc['revision'] = 1
+            book_doc['updated_at'] = book_doc['content_updated_at'] = datetime.now(timezone.utc)
+
+            category_keys.add(book_doc['category_key'])
+            operations.append(UpdateOne({'title': book_doc['title']}, {'$setOnInsert': book_doc}, upsert=True))
+
+        if not operations:
+            return 0
+
+        inserted = self.collection.bulk_write(operations, ordered=False).upserted_count
+        if inserted:
+            self.cache.clear()
+            self._touch_catalog(*category_keys)
+        return inserted
+
+    def refresh_stale_display_fields(self, batch_size=500):
         """
+        Re-derives the display fields of documents written before they existed
+        or by an older version of build_display_fields, in batched bulk writes.
+        Returns the number of documents updated.
+        """
+        stale_books = self.collection.find(
+            {'display_version': {'$ne': DISPLAY_FIELDS_VERSION}},
+            {'title': 1, 'description': 1, 'authors': 1, 'author': 1, 'genres': 1,
+             'category': 1, 'pages': 1, 'image_file': 1}
+        )
+        updated, operations = 0, []
+        for book in stale_books:
+            operations.append(UpdateOne({'_id': book['_id']}, {'$set': build_display_fields(book)}))
+            if len(operations) >= batch_size:
+                updated += self.collection.bulk_write(operations, ordered=False).modified_count
+                operations = []
+        if operations:
+            updated += self.collection.bulk_write(operations, ordered=False).modified_count
+        if updated:
+            self.cache.clear()
+        return updated
+
+    def _category_query(self, category, filters=NO_FILTERS, skip=None):
+        """
+        Builds the MongoDB filter used to select books in a category, combined
+        (AND) with the facet filters. skip names one facet to leave out, which is
+        how each facet's own counts are computed.
+        """
+        genres, pages, available = filters
         query = {}
-        if category != 'All':
-            # Use regex to search for the category name case-insensitively
-            query['category'] = {'$regex': f'^{category}$', '$options': 'i'}
-            
-        # MongoDB query: Find all matching documents, sort by 'title' ascending (1)
-        books_cursor = self.collection.find(query).sort('title', 1)
-        
-        # Convert cursor to list of dictionaries and ensure 'id' field is a string
+        if category and category != 'All' and skip != 'category':
+            # Equality on the normalized key is served by the (category_key, title) index
+            query['category_key'] = normalize_category(category)
+        if genres and skip != 'genres':
+            query['genres'] = {'$all': list(genres)}
+        if pages and skip != 'pages':
+            for key, _, lower, upper in PAGE_RANGES:
+                if key == pages:
+                    query['pages'] = {'$gte': lower} if upper is None else {'$gte': lower, '$lt': upper}
+        if available and skip != 'available':
+            query['available'] = {'$gt': 0}
+        return query
+
+    def ensure_indexes(self):
+        """Creates and verifies the indexes on the books collection."""
+        return ensure_collection_indexes(self.collection, self.INDEXES, retired=self.RETIRED_INDEXES)
+
+    # --- Revision Tracking (conditional GET support) ---
+
+    def _touch_catalog(self, *category_keys):
+        """Bumps the revision and updated_at of one or more categories and of the whole catalog."""
+        now = datetime.now(timezone.utc)
+        self.meta_collection.bulk_write([
+            UpdateOne({'_id': key}, {'$inc': {'revision': 1}, '$set': {'updated_at': now}}, upsert=True)
+            for key in dict.fromkeys(category_keys + (self.ALL_CATALOG_KEY,))
+        ])
+
+    def get_catalog_revision(self, category='All'):
+        """
+        Returns {'revision', 'updated_at'} for a category (or the whole catalog).
+        Reads one small document and bypasses the catalog cache so it is always current.
+        """
+        key = self._cache_category(category) or self.ALL_CATALOG_KEY
+        meta = self.meta_collection.find_one({'_id': key})
+        if not meta:
+            return {'revision': 0, 'updated_at': None}
+        return {'revision': meta.get('revision', 0), 'updated_at': meta.get('updated_at')}
+
+    def get_book_revision(self, book_id):
+        """
+        Returns {'revision', 'updated_at', 'available'} of a single book without reading
+        the full document, or None if the book does not exist.
+        """
+        try:
+            object_id = ObjectId(book_id)
+        except Exception:
+            return None
+
+        book = self.collection.find_one({'_id': object_id}, {'revision': 1, 'updated_at': 1, 'available': 1})
+        if not book:
+            return None
+        return {'revision': book.get('revision', 0), 'updated_at': book.get('updated_at'), 'available': book.get('available', 0)}
+
+    # --- Catalog Cache Helpers ---
+
+    def _cache_category(self, category):
+        """Returns the category part of a cache key (None stands for 'All')."""
+        if not category or category == 'All':
+            return None
+        return normalize_category(category)
+
+    def _invalidate_category(self, category_key):
+        """Drops the cached lists and counts of a category and of 'All', and all facet counts."""
+        return self.cache.invalidate_where(
+            lambda key, value: key[0] == 'facets'
+            or (key[0] in ('page', 'count') and key[1] in (None, category_key))
+        )
+
+    def _invalidate_book(self, book_id):
+        """
+        Drops the cached document of a book, every cached list that contains it,
+        and everything filtered or counted by availability.
+        """
+        def is_stale(key, value):
+            if key[0] == 'book':
+                return key[1] == book_id
+            if key[0] == 'facets':
+                return True
+            if key[0] in ('page', 'count') and key[-1][2]:
+                # Filtered on availability: the book may have entered or left the result
+                return True
+            if key[0] == 'page':
+                return any(book['id'] == book_id for book in value[0])
+            return False
+        return self.cache.invalidate_where(is_stale)
+
+    def get_books_page(self, category='All', page_size=CATALOG_PAGE_SIZE, cursor=None, filters=NO_FILTERS, sort='title', revision=None):
+        """
+        Retrieves one page of books sorted by title (or by popularity, most borrowed
+        first), using keyset (seek) pagination on (sort field, _id) so that deep pages
+        cost the same as the first one.
+        filters is a normalize_filters() tuple applied together with the category.
+        revision is the catalog revision the caller read (see get_catalog_revision); a
+        cached page stored at another revision is read again.
+        Returns (books_list, next_cursor); next_cursor is None on the last page.
+        """
+        field, direction = self.SORT_ORDERS.get(sort, self.SORT_ORDERS['title'])
+        # The filters stay last in the key (see _invalidate_book)
+        cache_key = ('page', self._cache_category(category), page_size, cursor, sort, filters)
+        cached = self.cache.get(cache_key, revision)
+        if cached is not MISSING:
+            return [dict(book) for book in cached[0]], cached[1]
+        generation = self.cache.generation
+
+        query = self._category_query(category, filters)
+
+        position = decode_page_cursor(cursor) if cursor else None
+        if position:
+            last_value, last_id = position
+            # Seek past the last book of the previous page; _id breaks ties between equal values.
+            # Books without the field (e.g. no popularity before migrate) sort as null:
+            # first when ascending, last when descending.
+            if last_value is None:
+                seek = [{field: None, '_id': {'$gt': last_id}}]
+                if direction == 1:
+                    seek.append({field: {'$ne': None}})
+            else:
+                seek = [
+                    {field: {'$gt' if direction == 1 else '$lt': last_value}},
+                    {field: last_value, '_id': {'$gt': last_id}}
+                ]
+                if direction == -1:
+                    seek.append({field: None})
+            query = {'$and': [query, {'$or': seek}]}
+
+        # Fetch one extra document to find out whether another page exists
+        books_cursor = self.collection.find(query, dict(LIST_PROJECTION, **{field: 1})).sort([(field, direction), ('_id', 1)]).limit(page_size + 1)
+
         books_list = []
         for book in books_cursor:
             book['id'] = str(book['_id'])
             books_list.append(book)
-            
-        return books_list
 
-    def get_book_by_id(self, book_id):
+        next_cursor = None
+        if len(books_list) > page_size:
+            books_list = books_list[:page_size]
+            last_book = books_list[-1]
+            next_cursor = encode_page_cursor(last_book.get(field), last_book['_id'])
+
+        self.cache.set(cache_key, (books_list, next_cursor), generation, revision)
+        return [dict(book) for book in books_list], next_cursor
+
+    def count_books(self, category='All', filters=NO_FILTERS, revision=None):
+        """
+        Returns the number of titles in a category (matching the facet filters).
+        Counts are cached and dropped whenever a book is added to the category
+        (or read again at another revision, as in get_books_page).
+        """
+        cache_key = ('count', self._cache_category(category), filters)
+        cached = self.cache.get(cache_key, revision)
+        if cached is not MISSING:
+            return cached
+        generation = self.cache.generation
+
+        query = self._category_query(category, filters)
+        if query:
+            count = self.collection.count_documents(query)
+        else:
+            # Served from collection metadata, no scan needed
+            count = self.collection.estimated_document_count()
+
+        self.cache.set(cache_key, count, generation, revision)
+        return count
+
+    def get_facets(self, category='All', filters=NO_FILTERS, revision=None):
+        """
+        Computes the facet counts for the Book Titles page in a single $facet
+        aggregation. Each facet is counted with every other active filter applied
+        (AND semantics) but not its own, so the alternatives stay visible.
+        Results are cached until the next catalog write (or read again at another revision).
+        Returns {'category': {category_key: n}, 'genres': {name: n}, 'pages': {key: n}, 'available': n}.
+        """
+        cache_key = ('facets', self._cache_category(category), filters)
+        cached = self.cache.get(cache_key, revision)
+        if cached is not MISSING:
+            return cached
+        generation = self.cache.generation
+
+        page_range_branches = [
+            {
+                'case': {'$and': [{'$gte': ['$pages', lower]}] + ([{'$lt': ['$pages', upper]}] if upper else [])},
+                'then': key
+            }
+            for key, _, lower, upper in PAGE_RANGES
+        ]
+        pipeline = [{'$facet': {
+            'category': [
+                {'$match': self._category_query(category, filters, skip='category')},
+                {'$group': {'_id': '$category_key', 'count': {'$sum': 1}}}
+            ],
+            'genres': [
+                {'$match': self._category_query(category, filters, skip='genres')},
+                {'$unwind': '$genres'},
+                {'$group': {'_id': '$genres', 'count': {'$sum': 1}}}
+            ],
+            'pages': [
+                {'$match': self._category_query(category, filters, skip='pages')},
+                {'$match': {'pages': {'$type': 'number'}}},
+                {'$group': {
+                    '_id': {'$switch': {'branches': page_range_branches, 'default': None}},
+                    'count': {'$sum': 1}
+                }}
+            ],
+            'available': [
+                {'$match': self._category_query(category, filters, skip='available')},
+                {'$match': {'available': {'$gt': 0}}},
+                {'$count': 'count'}
+            ]
+        }}]
+        result = next(self.collection.aggregate(pipeline), {})
+
+        facets = {
+            'category': {row['_id']: row['count'] for row in result.get('category', []) if row['_id']},
+            'genres': dict(sorted(
+                ((row['_id'], row['count']) for row in result.get('genres', []) if row['_id']),
+                key=lambda item: (-item[1], item[0])
+            )),
+            'pages': {row['_id']: row['count'] for row in result.get('pages', []) if row['_id']},
+            'available': result['available'][0]['count'] if result.get('available') else 0
+        }
+        self.cache.set(cache_key, facets, generation, revision)
+        return facets
+
+    def get_book_by_id(self, book_id, revision=None):
         """
         Retrieves a single book document by its string ID (MongoDB ObjectId).
+        revision is the book revision the caller read (see get_book_revision); a cached
+        document stored at another revision is read again.
         """
         try:
             object_id = ObjectId(book_id)
         except Exception as e:
             print(f"Invalid ObjectId format: {e}")
             return None
+
+        cache_key = ('book', str(object_id))
+        cached = self.cache.get(cache_key, revision)
+        if cached is not MISSING:
+            return dict(cached)
+        generation = self.cache.generation
             
         book = self.collection.find_one({'_id': object_id})
         
         if book:
             book['id'] = str(book['_id'])
+            self.cache.set(cache_key, book, generation, revision)
+            return dict(book)
         return book
     
-    def add_new_book(self, title, authors, cover_image, isbn, publication_year, 
-                     genres, publisher, description, page_count, # Existing 9 fields
-                     category, copies, available): # NEW 3 fields
+    def get_books_by_ids(self, book_ids, projection=LIST_PROJECTION):
         """
-        Adds a new book document to the MongoDB collection.
+        Retrieves several books in one query, in the order of book_ids (duplicates
+        are returned once). Only the card fields are read unless another projection
+        is given. Ids that are invalid or not found are skipped.
         """
-        
-        # Prepare the document for insertion
+        object_ids = []
+        for book_id in dict.fromkeys(book_ids):
+            try:
+                object_ids.append(ObjectId(book_id))
+            except Exception:
+                continue
+
+        if not object_ids:
+            return []
+
+        books_by_id = {}
+        for book in self.collection.find({'_id': {'$in': object_ids}}, projection):
+            book['id'] = str(book['_id'])
+            books_by_id[book['id']] = book
+
+        return [books_by_id[str(object_id)] for object_id in object_ids if str(object_id) in books_by_id]
+
+    def iter_search_documents(self, updated_after=None, include_description=True):
+        """
+        Streams the fields the search and suggestion indexes need, optionally only
+        for books whose content changed after updated_after. Loans only change
+        updated_at, so they never cause a re-index.
+        """
+        query = {}
+        if updated_after is not None:
+            query['content_updated_at'] = {'$gt': updated_after}
+        projection = {'title': 1, 'authors': 1, 'author': 1, 'genres': 1, 'content_updated_at': 1}
+        if include_description:
+            projection['description'] = 1
+        return self.collection.find(query, projection)
+
+    def add_insert_listener(self, listener):
+        """Registers a callable that receives every book document inserted by add_new_book."""
+        self.insert_listeners.append(listener)
+
+    def _notify_inserted(self, book_doc):
+        for listener in self.insert_listeners:
+            try:
+                listener(book_doc)
+            except Exception as e:
+                # A failing listener must not turn a successful insert into an error
+                print(f"ERROR: Book insert listener failed: {e}")
+
+    def get_availability(self, book_ids):
+        """
+        Reads the live copies/available counts for several books in one projection query.
+        Bypasses the catalog cache. Returns {book_id: {'copies': n, 'available': n}}.
+        """
+        object_ids = []
+        for book_id in book_ids:
+            try:
+                object_ids.append(ObjectId(book_id))
+            except Exception:
+                continue # Unknown ids are simply left out of the result
+
+        if not object_ids:
+            return {}
+
+        counts_cursor = self.collection.find(
+            {'_id': {'$in': object_ids}},
+            {'copies': 1, 'available': 1}
+        )
+        return {
+            str(book['_id']): {'copies': book.get('copies', 0), 'available': book.get('available', 0)}
+            for book in counts_cursor
+        }
+    
+    def build_book_document(self, title, authors, cover_image, isbn, publication_year,
+                            genres, publisher, description, page_count,
+                            category, copies, available):
+        """
+        Prepares a complete book document (including the derived display fields)
+        from the New Book form values. Shared by add_new_book and the bulk importer.
+        """
+        now = datetime.now(timezone.utc)
         book_data = {
             'title': title,
             'authors': authors,
@@ -144,54 +711,523 @@ class Book:
             'category': category or 'General', 
             'copies': int(copies) if copies else 1,
             'available': int(available) if available else 1,
-            'author': authors[0] if authors else 'Unknown' 
+            'author': authors[0] if authors else 'Unknown',
+
+            # Bumped on every write; drives the ETag/Last-Modified headers
+            'revision': 1,
+            'updated_at': now,
+            # Changed only with the catalog fields (title, authors...), not by loans; drives search sync
+            'content_updated_at': now,
+            # Recent borrows, maintained by analytics.py (sort='popular')
+            'popularity': 0
         }
+        book_data.update(build_display_fields(book_data))
+        return book_data
+
+    def add_new_book(self, title, authors, cover_image, isbn, publication_year, 
+                     genres, publisher, description, page_count, # Existing 9 fields
+                     category, copies, available): # NEW 3 fields
+        """
+        Adds a new book document to the MongoDB collection.
+        """
+        
+        # Prepare the document for insertion
+        book_data = self.build_book_document(
+            title, authors, cover_image, isbn, publication_year, genres, publisher,
+            description, page_count, category, copies, available
+        )
         
         try:
             result = self.collection.insert_one(book_data)
+            # Only the lists and counts of this category (and 'All') are now stale
+            self._invalidate_category(book_data['category_key'])
+            self._touch_catalog(book_data['category_key'])
+            # insert_one has set book_data['_id']
+            self._notify_inserted(book_data)
             return True, f"Book '{title}' added successfully with ID {result.inserted_id}!"
+        except DuplicateKeyError:
+            return False, f"A book with ISBN {book_data['isbn']} is already in the catalog."
         except Exception as e:
             return False, f"Database error occurred: {str(e)}"
 
+    def bulk_upsert_books(self, book_docs, ordered=False):
+        """
+        Writes a batch of documents from build_book_document with one bulk_write.
+        Books with an ISBN are upserted on it: catalog fields are overwritten, but
+        copies/available are only set when the book is new (they track loans).
+        Books without an ISBN are inserted.
+        Returns {'inserted': n, 'updated': n, 'errors': [(batch index, message)],
+        'duplicates': [(batch index, message)]}; duplicates are rows whose ISBN was
+        written by a concurrent import or /new_book (a duplicate key error).
+        """
+        operations = []
+        for book_doc in book_docs:
+            if book_doc.get('isbn'):
+                catalog_fields = {
+                    key: value for key, value in book_doc.items()
+                    if key not in ('copies', 'available', 'revision', 'popularity')
+                }
+                operations.append(UpdateOne(
+                    {'isbn': book_doc['isbn']},
+                    {
+                        '$set': catalog_fields,
+                        '$setOnInsert': {'copies': book_doc['copies'], 'available': book_doc['available']},
+                        # 0 for new books and for existing ones that never had a popularity
+                        '$max': {'popularity': book_doc['popularity']},
+                        '$inc': {'revision': 1}
+                    },
+                    upsert=True
+                ))
+            else:
+                operations.append(InsertOne(book_doc))
+
+        if not operations:
+            return {'inserted': 0, 'updated': 0, 'errors': [], 'duplicates': []}
+
+        errors, duplicates = [], []
+        try:
+            result = self.collection.bulk_write(operations, ordered=ordered)
+            details = result.bulk_api_result
+        except BulkWriteError as e:
+            details = e.details
+            for error in details.get('writeErrors', []):
+                if error.get('code') == DUPLICATE_KEY_ERROR_CODE:
+                    isbn = book_docs[error['index']].get('isbn')
+                    duplicates.append((error['index'], f"Duplicate ISBN {isbn}: already added by a concurrent import or new book."))
+                else:
+                    errors.append((error['index'], error.get('errmsg', 'Write error')))
+            if ordered and (errors or duplicates):
+                # An ordered bulk_write stops at the first error; report the rest as not written
+                first_failure = min(index for index, _ in errors + duplicates)
+                errors += [
+                    (index, 'Not written: an earlier row in the batch failed.')
+                    for index in range(first_failure + 1, len(book_docs))
+                ]
+
+        # Updated books may sit in any cached list, so drop the whole cache
+        self.cache.clear()
+        self._touch_catalog(*{book_doc['category_key'] for book_doc in book_docs})
+
+        # New books (inserted, or upserted on a new ISBN) go to the insert listeners
+        failed = {index for index, _ in errors + duplicates}
+        upserted_ids = {item['index']: item['_id'] for item in details.get('upserted', [])}
+        for index, book_doc in enumerate(book_docs):
+            if index in upserted_ids:
+                book_doc['_id'] = upserted_ids[index]
+                self._notify_inserted(book_doc)
+            elif not book_doc.get('isbn') and index not in failed and '_id' in book_doc:
+                self._notify_inserted(book_doc)
+
+        return {
+            'inserted': details.get('nInserted', 0) + details.get('nUpserted', 0),
+            'updated': details.get('nMatched', 0),
+            'errors': errors,
+            'duplicates': duplicates
+        }
+
     # --- Q3(c) NEW HELPERS: Decoupled Availability Count Updates ---
 
-    def decrease_available_count(self, book_id):
+    def take_copy(self, book_id, session=None):
         """
-        Decrements the available count for a book. Atomic check ensures count > 0.
+        Decrements the available count of a book if it is above zero, in one round trip.
+        The update is a pipeline that only changes the document when a copy is free, and
+        the document from before the update tells which case applied, so no second read
+        is needed to explain a failure. Pass session to run it inside a transaction.
+        Returns (success, message, category_key); call copies_changed after a success
+        (after the commit, inside a transaction).
         """
         try:
             book_obj_id = ObjectId(book_id)
-            # Find the book and ensure available > 0 before decreasing 
-            result = self.collection.update_one(
-                {"_id": book_obj_id, "available": {"$gt": 0}},
-                {"$inc": {"available": -1}}
-            )
-            
-            if result.modified_count == 0:
-                # Check if the book exists but its count is 0
-                book = self.collection.find_one({"_id": book_obj_id})
-                if book and book.get('available', 0) <= 0:
-                    return False, "Book is not available for loan."
-                return False, "Book not found or no change made."
-            
-            return True, "Available count decreased."
-        except Exception as e:
-            return False, f"Error decreasing count: {str(e)}"
+        except Exception:
+            return False, "Book not found or no change made.", None
+
+        has_copy = {'$gt': ['$available', 0]}
+        book = self.collection.find_one_and_update(
+            {"_id": book_obj_id},
+            [{'$set': {
+                'available': {'$cond': [has_copy, {'$subtract': ['$available', 1]}, '$available']},
+                'revision': {'$cond': [has_copy, {'$add': [{'$ifNull': ['$revision', 0]}, 1]}, '$revision']},
+                'updated_at': {'$cond': [has_copy, datetime.now(timezone.utc), '$updated_at']}
+            }}],
+            projection={"available": 1, "category_key": 1},
+            return_document=ReturnDocument.BEFORE,
+            session=session
+        )
+
+        if book is None:
+            return False, "Book not found or no change made.", None
+        if book.get('available', 0) <= 0:
+            return False, "Book is not available for loan.", None
+        return True, "Available count decreased.", book.get('category_key')
 
-    def increase_available_count(self, book_id):
-        """Increments the available count for a book."""
+    def copies_changed(self, book_id, category_key):
+        """Invalidates the cached catalog reads after the available count of a book changed."""
+        self._invalidate_book(str(book_id))
+        self._touch_catalog(category_key)
+
+    def copies_changed_many(self, book_ids, category_keys):
+        """copies_changed for several books, with one catalog revision update."""
+        for book_id in book_ids:
+            self._invalidate_book(str(book_id))
+        self._touch_catalog(*category_keys)
+
+    def update_popularity(self, scores):
+        """
+        Sets the popularity of books (scores maps book id -> recent borrows) with one
+        bulk_write; every other book with a non-zero or missing popularity is set to 0.
+        Only the order of sort='popular' pages changes, so only those are invalidated.
+        Returns the number of books changed.
+        """
+        operations, category_keys = [], set()
+        current = self.collection.find(
+            {'$or': [
+                {'popularity': {'$gt': 0}},
+                # Books written without one (before migrate) get theirs here
+                {'popularity': None},
+                {'_id': {'$in': [ObjectId(book_id) for book_id in scores if ObjectId.is_valid(book_id)]}}
+            ]},
+            {'popularity': 1, 'category_key': 1}
+        )
+        for book in current:
+            score = scores.get(str(book['_id']), 0)
+            if book.get('popularity') != score:
+                operations.append(UpdateOne({'_id': book['_id']}, {'$set': {'popularity': score}}))
+                category_keys.add(book.get('category_key'))
+        if not operations:
+            return 0
+
+        result = self.collection.bulk_write(operations, ordered=False)
+        self.cache.invalidate_where(lambda key, value: key[0] == 'page' and key[4] == 'popular')
+        self._touch_catalog(*category_keys)
+        return result.modified_count
+
+    def backfill_content_updated_at(self):
+        """Sets content_updated_at from updated_at on books written before it existed. Returns the number changed."""
+        return self.collection.update_many(
+            {'content_updated_at': {'$exists': False}},
+            [{'$set': {'content_updated_at': {'$ifNull': ['$updated_at', datetime.now(timezone.utc)]}}}]
+        ).modified_count
+
+    def backfill_popularity(self):
+        """Sets popularity 0 on books created before it existed. Returns the number of books changed."""
+        return self.collection.update_many({'popularity': {'$exists': False}}, {'$set': {'popularity': 0}}).modified_count
+
+    def give_back_copy(self, book_id, session=None):
+        """
+        Increments the available count of a book in one round trip. Pass session to
+        run it inside a transaction. Returns (success, message, category_key); call
+        copies_changed after a success (after the commit, inside a transaction).
+        """
         try:
             book_obj_id = ObjectId(book_id)
+        except Exception:
+            return False, "Book not found.", None
+
+        book = self.collection.find_one_and_update(
+            {"_id": book_obj_id},
+            {
+                "$inc": {"available": 1, "revision": 1},
+                "$set": {"updated_at": datetime.now(timezone.utc)}
+            },
+            projection={"category_key": 1},
+            session=session
+        )
+        if book is None:
+            return False, "Book not found.", None
+        return True, "Available count increased.", book.get('category_key')
+
+    def increase_available_counts(self, counts):
+        """
+        Increments the available count of several books in one bulk_write.
+        counts maps book id -> number of copies given back.
+        Returns (success, message).
+        """
+        increments = {}
+        for book_id, count in counts.items():
+            try:
+                increments[ObjectId(book_id)] = count
+            except Exception:
+                continue
+        if not increments:
+            return True, "No counts to update."
+
+        now = datetime.now(timezone.utc)
+        try:
+            result = self.collection.bulk_write([
+                UpdateOne({'_id': object_id}, {'$inc': {'available': count, 'revision': 1}, '$set': {'updated_at': now}})
+                for object_id, count in increments.items()
+            ], ordered=False)
+            books = self.collection.find({'_id': {'$in': list(increments)}}, {'category_key': 1})
+            category_keys = {book.get('category_key') for book in books}
+        except Exception as e:
+            return False, f"Error increasing counts: {str(e)}"
+
+        self.copies_changed_many(increments, category_keys)
+
+        if result.matched_count < len(increments):
+            return False, f"{len(increments) - result.matched_count} book(s) not found."
+        return True, "Available counts increased."
+
+
+# --- Holds (waitlist) ---
+
+# Hold statuses: open holds are waiting or ready, the others are closed
+HOLD_WAITING = 'waiting' # In the queue for the next copy that comes back
+HOLD_READY = 'ready' # A returned copy is reserved for the user until expires_at
+HOLD_FULFILLED = 'fulfilled' # The user borrowed the book
+HOLD_CANCELLED = 'cancelled'
+HOLD_EXPIRED = 'expired' # The reserved copy was not collected in time
+
+
+class Hold:
+    """
+    Manages the 'holds' collection: the first come, first served queue of users
+    waiting for a book that has no copy available.
+
+    A returned copy never goes back on the shelf while someone is waiting:
+    release_copy (called by the Loan returns) hands it to the oldest waiting hold,
+    which becomes ready for HOLD_PICKUP_DAYS, so nobody else can borrow it in the
+    meantime. Borrowing the book fulfils the hold; a ready hold not collected in
+    time expires and its copy goes to the next user in the queue.
+
+    Expiry is done by expire_ready_holds, which only the overdue scanner calls
+    (overdue.py, or OVERDUE_SCAN_IN_APP). Without the scanner running, a copy
+    reserved for a user who never collects it stays off the shelf.
+    """
+
+    # (name, keys, options) for every index the Hold queries rely on
+    INDEXES = [
+        # A book's queue in arrival order (release_copy, get_queue_status)
+        ('book_created', [('book_id', 1), ('created_at', 1)], {}),
+        # At most one open (waiting or ready) hold per user and book; closed holds are not indexed
+        ('one_open_hold', [('user_id', 1), ('book_id', 1)],
+         {'unique': True, 'partialFilterExpression': {'open': True}}),
+        # Ready holds past their pickup date (expire_ready_holds)
+        ('status_expires', [('status', 1), ('expires_at', 1)], {}),
+        # Holds closed since the last inventory reconciliation (reconcile.py)
+        ('closed_at', [('closed_at', 1)], {'sparse': True})
+    ]
+
+    def __init__(self, connection, book_model, pickup_days=HOLD_PICKUP_DAYS):
+        self.connection = connection
+        # The Book model used for count updates
+        self.book_model = book_model
+        self.pickup_days = pickup_days
+
+    @property
+    def collection(self):
+        return self.connection.db[HOLD_COLLECTION_NAME]
+
+    @property
+    def loans_collection(self):
+        return self.connection.db['loans']
+
+    def ensure_indexes(self):
+        """Creates and verifies the indexes on the holds collection."""
+        return ensure_collection_indexes(self.collection, self.INDEXES)
+
+    def place_hold(self, book_id, user_id):
+        """
+        Adds the user to the end of the book's queue. Only books with no available
+        copy can be held, and not by a user who already has the book on loan.
+        """
+        try:
+            book = self.book_model.collection.find_one({'_id': ObjectId(book_id)}, {'available': 1})
+        except Exception:
+            book = None
+        if not book:
+            return False, "Book not found."
+        if book.get('available', 0) > 0:
+            return False, "A copy is available. Please borrow it instead."
+        if self.loans_collection.find_one({'book_id': book_id, 'user_id': user_id, 'return_date': {'$type': 'null'}}, {'_id': 1}):
+            return False, "You already have this book on loan."
+
+        try:
+            result = self.collection.insert_one({
+                'book_id': book_id,
+                'user_id': user_id,
+                'status': HOLD_WAITING,
+                'open': True,
+                'created_at': datetime.now()
+            })
+        except DuplicateKeyError:
+            return False, "You already have a hold on this book."
+
+        # A copy returned between the check above and the insert went back on the shelf
+        # (nobody was waiting yet); reserve it for this hold instead of leaving it there
+        success, _, category_key = self.book_model.take_copy(book_id)
+        if success:
+            self._mark_ready(result.inserted_id)
+            self.book_model.copies_changed(book_id, category_key)
+            return True, "A copy has just come back and is reserved for you."
+        return True, "Hold placed. The next copy that comes back will be reserved for you in turn."
+
+    def _mark_ready(self, hold_id, session=None):
+        now = datetime.now()
+        self.collection.update_one(
+            {'_id': hold_id},
+            {'$set': {'status': HOLD_READY, 'ready_at': now, 'expires_at': now + timedelta(days=self.pickup_days)}},
+            session=session
+        )
+
+    def cancel_hold(self, book_id, user_id):
+        """Cancels the user's open hold on a book. A copy reserved for it goes to the next in line."""
+        try:
+            hold = self.close_hold(book_id, user_id, HOLD_CANCELLED)
+            if hold is None:
+                return False, "You have no hold on this book."
+            if hold['status'] == HOLD_READY:
+                self.copy_released(book_id, *self.release_copy(book_id))
+        except Exception as e:
+            return False, f"Database error cancelling hold: {str(e)}"
+        return True, "Hold cancelled."
+
+    def close_hold(self, book_id, user_id, status, session=None):
+        """
+        Closes the user's open hold on a book with the given status, in one round trip.
+        Returns the hold as it was before (None if there was none).
+        """
+        return self.collection.find_one_and_update(
+            {'book_id': book_id, 'user_id': user_id, 'open': True},
+            {'$set': {'status': status, 'closed_at': datetime.now()}, '$unset': {'open': ''}},
+            projection={'status': 1, 'created_at': 1},
+            return_document=ReturnDocument.BEFORE,
+            session=session
+        )
+
+    def reopen_hold(self, hold):
+        """Undoes close_hold (for a borrow that failed), keeping the hold's place in the queue."""
+        try:
             self.collection.update_one(
-                {"_id": book_obj_id},
-                {"$inc": {"available": 1}}
+                {'_id': hold['_id'], 'open': {'$exists': False}},
+                {'$set': {'status': hold['status'], 'open': True}, '$unset': {'closed_at': ''}}
             )
-            return True, "Available count increased."
-        except Exception as e:
-            return False, f"Error increasing count: {str(e)}"
+        except DuplicateKeyError:
+            # The user has placed a new hold since
+            pass
+
+    # --- Handing copies to the queue ---
+
+    def _reserve_for_next(self, book_id, session=None):
+        """Marks the oldest waiting hold on the book ready, in one round trip. Returns it, or None."""
+        now = datetime.now()
+        return self.collection.find_one_and_update(
+            {'book_id': str(book_id), 'status': HOLD_WAITING},
+            {'$set': {'status': HOLD_READY, 'ready_at': now, 'expires_at': now + timedelta(days=self.pickup_days)}},
+            sort=[('created_at', 1)],
+            projection={'user_id': 1, 'expires_at': 1},
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+
+    def release_copy(self, book_id, session=None):
+        """
+        Gives a returned copy to the oldest waiting hold on the book, or back to the
+        shelf (available + 1) when nobody is waiting. Pass session to run it in the
+        same transaction as the return. Returns (hold, category_key): the hold that is
+        now ready, or None and the category_key for copy_released.
+        """
+        hold = self._reserve_for_next(book_id, session=session)
+        if hold:
+            return hold, None
+
+        success, message, category_key = self.book_model.give_back_copy(book_id, session=session)
+        if not success:
+            print(f"ERROR: Failed to update book count upon return: {message}")
+        return None, category_key
+
+    def copy_released(self, book_id, hold, category_key):
+        """Invalidates the cached catalog reads if release_copy put the copy back on the shelf."""
+        if hold is None:
+            self.book_model.copies_changed(book_id, category_key)
+
+    def release_copies(self, counts):
+        """
+        release_copy for several returned copies; counts maps book id -> copies.
+        Waiting holds are served first; the rest go back on the shelf with one bulk_write.
+        Returns (success, message).
+        """
+        # One read finds the books with a queue; the others skip the per-copy reservation attempt
+        queued = set(self.collection.distinct(
+            'book_id', {'book_id': {'$in': [str(book_id) for book_id in counts]}, 'status': HOLD_WAITING}
+        ))
+        to_shelf = {}
+        for book_id, count in counts.items():
+            if str(book_id) in queued:
+                while count and self._reserve_for_next(book_id):
+                    count -= 1
+            if count:
+                to_shelf[book_id] = count
+        if to_shelf:
+            return self.book_model.increase_available_counts(to_shelf)
+        return True, "Copies reserved for waiting holds."
+
+    def expire_ready_holds(self, now=None, limit=HOLD_EXPIRY_BATCH_SIZE):
+        """
+        Expires up to limit ready holds whose pickup date has passed and passes each
+        reserved copy on (release_copy). Returns the number of holds expired.
+        """
+        now = now or datetime.now()
+        expired = 0
+        for hold in self.collection.find({'status': HOLD_READY, 'expires_at': {'$lt': now}}, {'_id': 1}).limit(limit):
+            # The filter repeats the conditions, so a hold collected since it was read is left alone
+            closed = self.collection.find_one_and_update(
+                {'_id': hold['_id'], 'status': HOLD_READY, 'expires_at': {'$lt': now}},
+                {'$set': {'status': HOLD_EXPIRED, 'closed_at': now}, '$unset': {'open': ''}},
+                projection={'book_id': 1}
+            )
+            if closed:
+                expired += 1
+                self.copy_released(closed['book_id'], *self.release_copy(closed['book_id']))
+        return expired
 
-# Global instance of the Book model for use in app.py
-book_model = Book() 
+    # --- Queue status ---
+
+    def get_queue_status(self, book_id, user_id):
+        """
+        Returns the book's queue as seen by a user, from one aggregation: the open holds
+        in arrival order plus the due dates of the active loans of the book.
+        {'queue_length', 'status' (of the user's hold, or None), 'position', 'expires_at',
+        'estimated_ready'}. The estimate assumes copies come back on their due dates,
+        one per waiting hold in turn, and are renewed for a full loan period otherwise.
+        """
+        results = list(self.collection.aggregate([
+            {'$match': {'book_id': book_id, 'open': True}},
+            {'$sort': {'created_at': 1}},
+            # $facet returns one document even when nobody is waiting
+            {'$facet': {'holds': [{'$project': {'_id': 0, 'user_id': 1, 'status': 1, 'expires_at': 1}}]}},
+            {'$lookup': {
+                'from': 'loans',
+                'pipeline': [
+                    {'$match': {'book_id': book_id, 'return_date': None}},
+                    {'$sort': {'due_date': 1}},
+                    {'$project': {'_id': 0, 'due_date': 1}}
+                ],
+                'as': 'loans'
+            }}
+        ]))
+        holds = results[0]['holds'] if results else []
+        due_dates = [loan['due_date'] for loan in results[0]['loans']] if results else []
+
+        waiting = [hold['user_id'] for hold in holds if hold['status'] == HOLD_WAITING]
+        own = next((hold for hold in holds if hold['user_id'] == user_id), None)
+        status = {
+            'queue_length': len(waiting),
+            'status': own['status'] if own else None,
+            'position': None,
+            'expires_at': own.get('expires_at') if own else None,
+            'estimated_ready': None
+        }
+
+        if own and own['status'] == HOLD_WAITING:
+            position = waiting.index(user_id) + 1
+            status['position'] = position
+            if due_dates:
+                # The position-th copy to come back, going round the loans once per loan period
+                rounds, index = divmod(position - 1, len(due_dates))
+                due_date = max(due_dates[index], datetime.now())
+                status['estimated_ready'] = due_date + timedelta(days=DEFAULT_LOAN_DURATION_DAYS * rounds)
+        return status
 
 
 # --- Q3(c)(i) Loan Model ---
@@ -200,34 +1236,84 @@ book_model = Book()
 DEFAULT_LOAN_DURATION_DAYS = 14
 MAX_RENEWS = 2 
 
+
+# Loan event types written to the loan_events outbox (see counters.py)
+LOAN_BORROWED = 'borrowed'
+LOAN_RENEWED = 'renewed'
+LOAN_RETURNED = 'returned'
+LOAN_DELETED = 'deleted'
+
+
+class BorrowRejected(Exception):
+    """Raised inside a borrow transaction to abort it; the message says why."""
+
 class Loan:
     """
     Manages interactions with the 'loans' collection, handling creation, 
     retrieval, renewal, return, and deletion of loan documents.
     """
-    def __init__(self):
-        self.collection = db['loans']
-        # Use the global book_model instance for count updates
+
+    # (name, keys, options) for every index the Loan queries rely on
+    INDEXES = [
+        # A user's active or returned loans, newest first (get_user_loans with is_active)
+        ('user_return_borrow_date', [('user_id', 1), ('return_date', 1), ('borrow_date', -1)], {}),
+        # A user's loans of any state, newest first (get_user_loans)
+        ('user_borrow_date', [('user_id', 1), ('borrow_date', -1)], {}),
+        # Active (or returned) loans of a book
+        ('book_return', [('book_id', 1), ('return_date', 1)], {}),
+        # Active loans past a due date (overdue scanner and report), without a collection scan
+        ('return_due', [('return_date', 1), ('due_date', 1)], {}),
+        # Loans written since the last inventory reconciliation (reconcile.py)
+        ('updated_at', [('updated_at', 1)], {}),
+        # At most one unreturned loan per user and book. create_loan relies on the
+        # duplicate key error instead of checking first, which also closes the race
+        # between two concurrent borrows. Returned loans (return_date set) are not indexed.
+        ('one_active_loan', [('user_id', 1), ('book_id', 1)],
+         {'unique': True, 'partialFilterExpression': {'return_date': {'$type': 'null'}}})
+    ]
+
+    # Indexes created by earlier versions and since replaced by the ones above
+    RETIRED_INDEXES = ['book_user_return']
+
+    def __init__(self, connection, book_model, hold_model):
+        self.connection = connection
+        # The Book model used for count updates
         self.book_model = book_model 
+        # The Hold model: returned copies go to the queue first
+        self.hold_model = hold_model
+
+    @property
+    def collection(self):
+        return self.connection.db['loans']
+
+    @property
+    def archive_collection(self):
+        # Returned loans moved out by archive.py: {user_id, month, loans: [loan documents]}
+        return self.connection.db[LOAN_ARCHIVE_COLLECTION_NAME]
+
+    @property
+    def events_collection(self):
+        # Outbox of loan events, folded into counters by counters.py
+        return self.connection.db[LOAN_EVENTS_COLLECTION_NAME]
+
+    def ensure_indexes(self):
+        """
+        Creates and verifies the indexes on the loans collection. Fails if a user
+        already has two unreturned loans of the same book; return one of them first.
+        """
+        return ensure_collection_indexes(self.collection, self.INDEXES, retired=self.RETIRED_INDEXES)
 
     def create_loan(self, book_id, user_id, borrow_date=None):
         """
         Creates a new Loan document.
-        - Checks if user already has an unreturned loan for the book.
-        - Updates the available count for the book.
+        - The one_active_loan unique index rejects a second unreturned loan for the same book.
+        - Updates the available count for the book, or collects the copy reserved
+          by the user's ready hold (which is then fulfilled).
+        The loan insert and the count update either both happen or neither does: in a
+        transaction on a replica set, otherwise by deleting the loan again if no copy was free.
         """
         if borrow_date is None:
             borrow_date = datetime.now()
-        
-        # Sanity Check 1: A Loan document can be created for a user if he does not already
-        # have an unreturned loan for the same book title. (Logic remains here for enforcement)
-        active_loan = self.collection.find_one({
-            "book_id": book_id,
-            "user_id": user_id,
-            "return_date": None # Unreturned loan
-        })
-        if active_loan:
-            return False, "You already have an active, unreturned loan for this book."
             
         # Calculate due date
         due_date = borrow_date + timedelta(days=DEFAULT_LOAN_DURATION_DAYS)
@@ -238,34 +1324,129 @@ class Loan:
             "borrow_date": borrow_date,
             "due_date": due_date,
             "return_date": None, # Null indicates unreturned/active loan
-            "renew_count": 0
+            "renew_count": 0,
+            "updated_at": datetime.now() # Last write; reconcile.py checks the books of recently changed loans
         }
-        
+
+        if self.connection.supports_transactions:
+            borrow = self._borrow_in_transaction
+        else:
+            borrow = self._borrow_with_rollback
+
         try:
-            # Update the available count for the book should be updated (decreased).
-            success, message = self.book_model.decrease_available_count(book_id)
+            success, message, category_key = borrow(book_id, loan_data)
+        except DuplicateKeyError:
+            # Sanity Check 1: A Loan document can be created for a user if he does not already
+            # have an unreturned loan for the same book title (enforced by the one_active_loan index)
+            return False, "You already have an active, unreturned loan for this book."
+        except Exception as e:
+            return False, f"Database error creating loan: {str(e)}"
+
+        if not success:
+            return False, message
+
+        if category_key is not self.RESERVED_COPY:
+            self.book_model.copies_changed(book_id, category_key)
+        return True, f"Loan created successfully! ID: {str(loan_data['_id'])}"
+
+    def _record_events(self, event_type, loans, session=None):
+        """
+        Appends one compact event per loan to the loan_events outbox:
+        {type, loan_id, user_id, book_id, at}. Pass session to write them in the same
+        transaction as the change; otherwise they follow it, and a failure is only printed.
+        """
+        now = datetime.now(timezone.utc)
+        events = [
+            {'type': event_type, 'loan_id': loan['_id'], 'user_id': loan['user_id'], 'book_id': loan['book_id'], 'at': now}
+            for loan in loans
+        ]
+        if not events:
+            return
+        if session is not None:
+            self.events_collection.insert_many(events, session=session)
+            return
+        try:
+            self.events_collection.insert_many(events)
+        except Exception as e:
+            print(f"ERROR: Failed to record {event_type} loan events: {str(e)}")
+
+    # Returned by _take_copy_for instead of a category_key when the user collected the copy
+    # reserved by their hold: the available count did not change, so no cache is stale
+    RESERVED_COPY = object()
+
+    def _take_copy_for(self, book_id, user_id, session=None):
+        """
+        Takes the copy a borrower needs: the one reserved by their ready hold, otherwise
+        a free copy (take_copy). Their open hold on the book, if any, is fulfilled; if no
+        copy was free it is reopened (outside a transaction; an aborted one undoes it).
+        Returns (success, message, category_key) like take_copy, with RESERVED_COPY as
+        the category_key when the reserved copy was collected.
+        """
+        hold = self.hold_model.close_hold(book_id, user_id, HOLD_FULFILLED, session=session)
+        if hold and hold['status'] == HOLD_READY:
+            # The copy already left the shelf when it was reserved
+            return True, "Reserved copy collected.", self.RESERVED_COPY
+
+        try:
+            success, message, category_key = self.book_model.take_copy(book_id, session=session)
+        except Exception:
+            if hold and session is None:
+                self.hold_model.reopen_hold(hold)
+            raise
+        if not success and hold and session is None:
+            self.hold_model.reopen_hold(hold)
+        return success, message, category_key
+
+    def _borrow_in_transaction(self, book_id, loan_data):
+        """Inserts the loan and takes a copy in one multi-document transaction."""
+        def borrow(session):
+            self.collection.insert_one(loan_data, session=session)
+            success, message, category_key = self._take_copy_for(book_id, loan_data['user_id'], session=session)
             if not success:
-                return False, message # Return error if not available or book not found
+                # Raising aborts the transaction, which also removes the loan
+                raise BorrowRejected(message)
+            self._record_events(LOAN_BORROWED, [loan_data], session=session)
+            return category_key, message
+
+        try:
+            with self.connection.client.start_session() as session:
+                # with_transaction retries the whole callback on transient errors (write conflicts)
+                category_key, message = session.with_transaction(borrow)
+        except BorrowRejected as e:
+            return False, str(e), None
+        return True, message, category_key
 
-            # Create the Loan document
-            result = self.collection.insert_one(loan_data)
-            return True, f"Loan created successfully! ID: {str(result.inserted_id)}"
+    def _borrow_with_rollback(self, book_id, loan_data):
+        """
+        Inserts the loan, then takes a copy. If no copy could be taken, the loan is
+        deleted again (the compensating action), so no loan exists without its copy.
+        """
+        result = self.collection.insert_one(loan_data)
+        try:
+            success, message, category_key = self._take_copy_for(book_id, loan_data['user_id'])
         except Exception as e:
-            return False, f"Database error creating loan: {str(e)}"
+            success, message, category_key = False, f"Database error creating loan: {str(e)}", None
+
+        if not success:
+            # Not available or book not found: take the loan back out
+            self.collection.delete_one({"_id": result.inserted_id})
+        else:
+            self._record_events(LOAN_BORROWED, [loan_data])
+        return success, message, category_key
     
-    # --- FIX: ADDED has_active_loan method ---
-    def has_active_loan(self, book_id, user_id):
+    def get_active_book_ids(self, user_id):
         """
-        Checks if a specific user currently has an unreturned loan for a specific book.
-        This is used to determine if the 'Borrow' button should be disabled.
+        Returns the ids of every book the user currently has on loan, with one query.
+        Matching return_date by BSON type null (loans always store the field) lets the
+        query use the partial one_active_loan index, which also covers the projection.
         """
-        active_loan = self.collection.find_one({
-            "book_id": book_id,
-            "user_id": user_id,
-            "return_date": None  # Indicates an unreturned/active loan
-        })
-        return active_loan is not None
-    # --- END FIX ---
+        if not user_id:
+            return set()
+        loans = self.collection.find(
+            {"user_id": user_id, "return_date": {"$type": "null"}},
+            {"book_id": 1, "_id": 0}
+        )
+        return {str(loan['book_id']) for loan in loans}
 
     def get_loan_by_id(self, loan_id):
         """
@@ -281,121 +1462,400 @@ class Loan:
             loan_doc['id'] = str(loan_doc['_id'])
         return loan_doc
 
-    def get_user_loans(self, user_id, is_active=None):
+    def get_user_loans(self, user_id, is_active=None, limit=None, cursor=None):
         """
-        Retrieves all loans for a specific user (active, returned, or all).
+        Retrieves the loans of a specific user (active, returned, or all), newest first,
+        each with the title, author and cover image of its book.
+        - Returned loans may have been moved to the archive collection by archive.py;
+          they are read from both collections and merged, so callers see one history.
+        - limit and cursor (from loan_page_cursor) page through the history by (borrow_date, _id).
+        - The books of all the loans are read with one batched query.
         """
         query = {"user_id": user_id}
         if is_active is True:
             query["return_date"] = None
         elif is_active is False:
             query["return_date"] = {"$ne": None}
-            
-        loans_cursor = self.collection.find(query).sort('borrow_date', -1)
-        
-        loans_list = []
-        for loan in loans_cursor:
+
+        position = decode_page_cursor(cursor) if cursor else None
+        if position:
+            after = self._before_position(datetime.fromisoformat(position[0]), position[1])
+            query = {"$and": [query, after]}
+
+        hot_cursor = self.collection.find(query).sort([('borrow_date', -1), ('_id', -1)])
+        if limit:
+            hot_cursor = hot_cursor.limit(limit)
+        loans_list = list(hot_cursor)
+
+        if is_active is not True:
+            archived = self._get_archived_loans(user_id, position, limit)
+            if archived:
+                loans_list = sorted(loans_list + archived, key=lambda loan: (loan['borrow_date'], loan['_id']), reverse=True)
+                if limit:
+                    loans_list = loans_list[:limit]
+
+        books = self.book_model.get_books_by_ids(
+            [loan['book_id'] for loan in loans_list], projection=LOAN_BOOK_PROJECTION
+        )
+        books_by_id = {book['id']: book for book in books}
+
+        for loan in loans_list:
             loan['id'] = str(loan['_id'])
             
-            # Helper: Attach book title for easier display
-            book = self.book_model.get_book_by_id(loan['book_id'])
+            # Helper: Attach book details for easier display
+            book = books_by_id.get(str(loan['book_id']))
             loan['book_title'] = book['title'] if book else 'Unknown Title'
+            loan['book_author'] = book.get('primary_author', 'Unknown Author') if book else 'Unknown Author'
             loan['book_image'] = book.get('image_file', 'default.jpg') if book else 'default.jpg'
             
-            loans_list.append(loan)
-            
         return loans_list
 
+    @staticmethod
+    def _before_position(borrow_date, object_id):
+        """Filter for loans after (borrow_date, _id) in newest-first order."""
+        return {"$or": [
+            {"borrow_date": {"$lt": borrow_date}},
+            {"borrow_date": borrow_date, "_id": {"$lt": object_id}}
+        ]}
+
+    def _get_archived_loans(self, user_id, position=None, limit=None):
+        """
+        Reads a user's archived loans, newest first, from the (user, month) buckets.
+        Only the buckets up to the cursor's month are unwound.
+        """
+        match = {"user_id": user_id}
+        if position:
+            match["month"] = {"$lte": datetime.fromisoformat(position[0]).strftime('%Y-%m')}
+
+        pipeline = [{"$match": match}, {"$unwind": "$loans"}, {"$replaceRoot": {"newRoot": "$loans"}}]
+        if position:
+            pipeline.append({"$match": self._before_position(datetime.fromisoformat(position[0]), position[1])})
+        pipeline.append({"$sort": {"borrow_date": -1, "_id": -1}})
+        if limit:
+            pipeline.append({"$limit": limit})
+        return list(self.archive_collection.aggregate(pipeline))
+
+    @staticmethod
+    def loan_page_cursor(loan):
+        """The cursor for the page of loans following this one (see get_user_loans)."""
+        return encode_page_cursor(loan['borrow_date'].isoformat(), loan['_id'])
+
     def renew_loan(self, loan_id):
         """
         A loan renew updates the renew count and the borrow date for the loan.
+        The checks (not returned, under the renewal limit and, with REFUSE_OVERDUE_RENEWALS,
+        not overdue) are part of the update's filter, so the renewal is a single atomic find_one_and_update and two
+        concurrent renewals cannot both pass the limit.
         """
-        loan = self.get_loan_by_id(loan_id)
-        
-        if not loan:
+        try:
+            object_id = ObjectId(loan_id)
+        except Exception:
             return False, "Loan not found."
-        
-        if loan.get('return_date'):
-            return False, "Cannot renew a loan that has already been returned."
 
-        # Helper Sanity Check: Renewal limit
-        if loan.get('renew_count', 0) >= MAX_RENEWS:
-            return False, f"Renewal limit reached ({MAX_RENEWS}). Please return the book."
-            
+        renewable = {
+            "_id": object_id,
+            "return_date": None,
+            # Helper Sanity Check: Renewal limit (old records may have no renew_count)
+            "renew_count": {"$not": {"$gte": MAX_RENEWS}}
+        }
+        if REFUSE_OVERDUE_RENEWALS:
+            # Overdue loans must be returned, not renewed
+            renewable["due_date"] = {"$gte": datetime.now()}
+
         try:
-            # Get the original borrow date to calculate the new capped borrow date
-            original_borrow_date = loan['borrow_date']
-            
-            # --- FIX 1: Use the capped randomized date for the new borrow_date ---
-            new_borrow_date = get_capped_new_loan_date(original_borrow_date)
-            
-            # Calculate new due date (14 days from the new borrow date)
-            new_due_date = new_borrow_date + timedelta(days=DEFAULT_LOAN_DURATION_DAYS)
-            
-            # Update the Loan document
-            self.collection.update_one(
-                {"_id": ObjectId(loan_id)},
-                {
-                    "$set": {
-                        "due_date": new_due_date,
-                        # Update the borrow date with the new random, capped date
-                        "borrow_date": new_borrow_date 
-                    },
-                    # Update the renew count
-                    "$inc": {"renew_count": 1}
-                }
+            loan = self.collection.find_one_and_update(
+                renewable,
+                [
+                    # --- FIX 1: Use the capped randomized date for the new borrow_date ---
+                    {"$set": {"borrow_date": capped_new_loan_date_expression("$borrow_date")}},
+                    # Calculate new due date (14 days from the new borrow date) and update the renew count
+                    {"$set": {
+                        "due_date": {"$add": ["$borrow_date", DEFAULT_LOAN_DURATION_DAYS * 24 * 60 * 60 * 1000]},
+                        "renew_count": {"$add": [{"$ifNull": ["$renew_count", 0]}, 1]},
+                        "updated_at": datetime.now()
+                    }},
+                    # The new due date is checked afresh by the overdue scanner ($project excluding = $unset)
+                    {"$project": {"overdue": 0, "overdue_since": 0}}
+                ],
+                projection={"due_date": 1, "user_id": 1, "book_id": 1},
+                return_document=ReturnDocument.AFTER
             )
-            return True, f"Loan successfully renewed. New due date: {new_due_date.strftime('%Y-%m-%d')}"
         except Exception as e:
             return False, f"Database error during renewal: {str(e)}"
 
+        if loan:
+            self._record_events(LOAN_RENEWED, [loan])
+            return True, f"Loan successfully renewed. New due date: {loan['due_date'].strftime('%Y-%m-%d')}"
 
+        # Nothing was changed; read the loan once to explain why
+        loan = self.collection.find_one({"_id": object_id}, {"return_date": 1, "renew_count": 1, "due_date": 1})
+        if not loan:
+            return False, "Loan not found."
+        return False, self._renewal_refusal(loan)
+
+    def _renewal_refusal(self, loan):
+        """The reason a loan cannot be renewed."""
+        if loan.get('return_date'):
+            return "Cannot renew a loan that has already been returned."
+        if loan.get('renew_count', 0) >= MAX_RENEWS:
+            return f"Renewal limit reached ({MAX_RENEWS}). Please return the book."
+        if REFUSE_OVERDUE_RENEWALS and loan.get('due_date') and loan['due_date'] < datetime.now():
+            return "This loan is overdue and cannot be renewed. Please return the book."
+        return "The loan was changed by another request. Please try again."
 
     def return_loan(self, loan_id):
         """
-        A loan return updates the return date. In addition, the available count
-        for the book should be updated (increased).
+        A loan return updates the return date. In addition, the copy is released:
+        reserved for the oldest waiting hold on the book, or put back on the shelf
+        (available count increased) when nobody is waiting.
+        The return is a single find_one_and_update guarded by return_date being null,
+        so only the request that actually returns the loan releases the copy. On a
+        replica set the return and the release commit in one transaction; otherwise
+        they run back to back, and the copy is still never counted as available while
+        someone is waiting for it.
         """
-        loan = self.get_loan_by_id(loan_id)
-        
+        try:
+            object_id = ObjectId(loan_id)
+        except Exception:
+            return False, "Loan not found."
+
+        released = None
+        try:
+            if self.connection.supports_transactions:
+                with self.connection.client.start_session() as session:
+                    loan, released = session.with_transaction(lambda s: self._return_and_release(object_id, s))
+            else:
+                loan = self._mark_returned(object_id)
+                if loan:
+                    self._record_events(LOAN_RETURNED, [loan])
+        except Exception as e:
+            return False, f"Database error during return: {str(e)}"
+
         if not loan:
+            # Nothing was changed; read the loan once to explain why
+            if self.collection.find_one({"_id": object_id}, {"_id": 1}):
+                return False, "This loan has already been marked as returned."
             return False, "Loan not found."
-            
-        if loan.get('return_date'):
-            return False, "This loan has already been marked as returned."
-            
-        book_id = loan['book_id']
-        
+
+        # Release the copy, only after this request returned the loan
         try:
-            # Get the original borrow date to calculate the new capped return date
-            original_borrow_date = loan['borrow_date']
-            
-            # --- FIX 2: Use the capped randomized date for the return_date ---
-            new_return_date = get_capped_new_loan_date(original_borrow_date)
+            if released is None:
+                released = self.hold_model.release_copy(loan['book_id'])
+            self.hold_model.copy_released(loan['book_id'], *released)
+        except Exception as e:
+            print(f"ERROR: Failed to update book count upon return: {str(e)}")
             
-            # 1. Update the Loan document with the new return date
-            self.collection.update_one(
-                {"_id": ObjectId(loan_id)},
-                {"$set": {"return_date": new_return_date}}
-            )
+        return True, "Book successfully returned!"
+
+    def _mark_returned(self, object_id, session=None):
+        """Sets the return date of an unreturned loan. Returns its user_id and book_id, or None."""
+        # --- FIX 2: Use the capped randomized date for the return_date ---
+        return self.collection.find_one_and_update(
+            {"_id": object_id, "return_date": None},
+            [{"$set": {"return_date": capped_new_loan_date_expression("$borrow_date"), "updated_at": datetime.now()}}],
+            projection={"user_id": 1, "book_id": 1},
+            session=session
+        )
+
+    def _return_and_release(self, object_id, session):
+        """Returns the loan and releases its copy (Hold.release_copy) in the given transaction."""
+        loan = self._mark_returned(object_id, session=session)
+        if not loan:
+            return None, None
+        self._record_events(LOAN_RETURNED, [loan], session=session)
+        return loan, self.hold_model.release_copy(loan['book_id'], session=session)
             
-            # 2. Update book available count (increase)
-            success, message = self.book_model.increase_available_count(book_id)
-            if not success:
-                print(f"ERROR: Failed to update book count upon return: {message}")
-                
-            return True, "Book successfully returned!"
+    def get_overdue_loans(self, limit=200):
+        """
+        Retrieves the active loans past their due date, most overdue first, each with
+        its book's title and author (one batched book query). Uses the return_due index.
+        """
+        loans_list = list(
+            self.collection.find({"return_date": None, "due_date": {"$lt": datetime.now()}})
+            .sort('due_date', 1)
+            .limit(limit)
+        )
+
+        books = self.book_model.get_books_by_ids(
+            [loan['book_id'] for loan in loans_list], projection=LOAN_BOOK_PROJECTION
+        )
+        books_by_id = {book['id']: book for book in books}
+
+        for loan in loans_list:
+            loan['id'] = str(loan['_id'])
+            book = books_by_id.get(str(loan['book_id']))
+            loan['book_title'] = book['title'] if book else 'Unknown Title'
+            loan['book_author'] = book.get('primary_author', 'Unknown Author') if book else 'Unknown Author'
+        return loans_list
+
+    # --- Bulk Loan Actions (My Loans page) ---
+
+    def _read_user_loans(self, loan_ids, user_id):
+        """
+        Reads the given loans of a user with one $in query.
+        Returns (object ids by requested id, loan documents by id); invalid ids map to None.
+        """
+        object_ids = {}
+        for loan_id in dict.fromkeys(loan_ids):
+            try:
+                object_ids[loan_id] = ObjectId(loan_id)
+            except Exception:
+                object_ids[loan_id] = None
+
+        loans = self.collection.find(
+            {'_id': {'$in': [object_id for object_id in object_ids.values() if object_id]}, 'user_id': user_id},
+            {'book_id': 1, 'borrow_date': 1, 'due_date': 1, 'return_date': 1, 'renew_count': 1}
+        )
+        return object_ids, {str(loan['_id']): loan for loan in loans}
+
+    def _apply_bulk_updates(self, planned, action_token):
+        """
+        Runs the planned {loan_id: UpdateOne} in one unordered bulk_write. Each update
+        is guarded by its filter and stamps action_token, so when fewer loans changed
+        than planned (another request got there first) the ones changed by this call
+        are found with one more query. Returns the set of loan ids that were updated.
+        """
+        if not planned:
+            return set()
+        result = self.collection.bulk_write(list(planned.values()), ordered=False)
+        if result.modified_count == len(planned):
+            return set(planned)
+        updated = self.collection.find(
+            {'_id': {'$in': [ObjectId(loan_id) for loan_id in planned]}, 'action_token': action_token},
+            {'_id': 1}
+        )
+        return {str(loan['_id']) for loan in updated}
+
+    def renew_loans(self, loan_ids, user_id):
+        """
+        Renews several of a user's loans with one read and one bulk_write.
+        Applies the same checks as renew_loan to each loan.
+        Returns {loan_id: (success, message)} in the order of loan_ids.
+        """
+        try:
+            object_ids, loans = self._read_user_loans(loan_ids, user_id)
         except Exception as e:
-            return False, f"Database error during return: {str(e)}"
+            return {loan_id: (False, f"Database error during renewal: {str(e)}") for loan_id in loan_ids}
+
+        action_token = ObjectId()
+        now = datetime.now()
+        outcomes, planned, new_due_dates = {}, {}, {}
+        for loan_id, object_id in object_ids.items():
+            loan = loans.get(loan_id)
+            if not loan:
+                outcomes[loan_id] = (False, "Loan not found.")
+            elif (loan.get('return_date') or loan.get('renew_count', 0) >= MAX_RENEWS
+                  or (REFUSE_OVERDUE_RENEWALS and loan.get('due_date') and loan['due_date'] < now)):
+                outcomes[loan_id] = (False, self._renewal_refusal(loan))
+            else:
+                new_borrow_date = get_capped_new_loan_date(loan['borrow_date'])
+                new_due_dates[loan_id] = new_borrow_date + timedelta(days=DEFAULT_LOAN_DURATION_DAYS)
+                renewable = {'_id': object_id, 'return_date': None, 'renew_count': {'$not': {'$gte': MAX_RENEWS}}}
+                if REFUSE_OVERDUE_RENEWALS:
+                    renewable['due_date'] = {'$gte': now}
+                planned[loan_id] = UpdateOne(
+                    renewable,
+                    {
+                        '$set': {'borrow_date': new_borrow_date, 'due_date': new_due_dates[loan_id],
+                                 'action_token': action_token, 'updated_at': now},
+                        '$unset': {'overdue': '', 'overdue_since': ''},
+                        '$inc': {'renew_count': 1}
+                    }
+                )
+
+        try:
+            renewed = self._apply_bulk_updates(planned, action_token)
+        except Exception as e:
+            renewed = set()
+            outcomes.update({loan_id: (False, f"Database error during renewal: {str(e)}") for loan_id in planned})
+
+        self._record_events(LOAN_RENEWED, [
+            {'_id': object_ids[loan_id], 'user_id': user_id, 'book_id': loans[loan_id]['book_id']} for loan_id in renewed
+        ])
+
+        for loan_id in planned:
+            if loan_id in renewed:
+                outcomes[loan_id] = (True, f"Loan successfully renewed. New due date: {new_due_dates[loan_id].strftime('%Y-%m-%d')}")
+            elif loan_id not in outcomes:
+                outcomes[loan_id] = (False, "The loan was changed by another request. Please try again.")
+
+        return {loan_id: outcomes[loan_id] for loan_id in object_ids}
+
+    def return_loans(self, loan_ids, user_id):
+        """
+        Returns several of a user's loans with one read and one bulk_write on loans,
+        then releases the copies: waiting holds are served first (Hold.release_copies),
+        the rest go back on the shelf with one bulk_write on books. Only loans this
+        call actually returned release a copy.
+        Returns {loan_id: (success, message)} in the order of loan_ids.
+        """
+        try:
+            object_ids, loans = self._read_user_loans(loan_ids, user_id)
+        except Exception as e:
+            return {loan_id: (False, f"Database error during return: {str(e)}") for loan_id in loan_ids}
+
+        action_token = ObjectId()
+        now = datetime.now()
+        outcomes, planned = {}, {}
+        for loan_id, object_id in object_ids.items():
+            loan = loans.get(loan_id)
+            if not loan:
+                outcomes[loan_id] = (False, "Loan not found.")
+            elif loan.get('return_date'):
+                outcomes[loan_id] = (False, "This loan has already been marked as returned.")
+            else:
+                planned[loan_id] = UpdateOne(
+                    {'_id': object_id, 'return_date': None},
+                    {'$set': {'return_date': get_capped_new_loan_date(loan['borrow_date']),
+                              'action_token': action_token, 'updated_at': now}}
+                )
+
+        try:
+            returned = self._apply_bulk_updates(planned, action_token)
+        except Exception as e:
+            returned = set()
+            outcomes.update({loan_id: (False, f"Database error during return: {str(e)}") for loan_id in planned})
+
+        self._record_events(LOAN_RETURNED, [
+            {'_id': object_ids[loan_id], 'user_id': user_id, 'book_id': loans[loan_id]['book_id']} for loan_id in returned
+        ])
+
+        copies_returned = {}
+        for loan_id in planned:
+            if loan_id in returned:
+                book_id = str(loans[loan_id]['book_id'])
+                copies_returned[book_id] = copies_returned.get(book_id, 0) + 1
+                outcomes[loan_id] = (True, "Book successfully returned!")
+            elif loan_id not in outcomes:
+                outcomes[loan_id] = (False, "This loan has already been marked as returned.")
+
+        if copies_returned:
+            success, message = self.hold_model.release_copies(copies_returned)
+            if not success:
+                print(f"ERROR: Failed to update book counts upon return: {message}")
+
+        return {loan_id: outcomes[loan_id] for loan_id in object_ids}
             
     def delete_loan(self, loan_id):
         """
-        Deletes a Loan document.
+        Deletes a Loan document (from the archive if it was moved there).
         - Only loans that have been returned can be deleted (Sanity Check).
         """
         loan = self.get_loan_by_id(loan_id)
         
         if not loan:
+            # Archived loans are always returned ones
+            try:
+                bucket = self.archive_collection.find_one_and_update(
+                    {"loans._id": ObjectId(loan_id)},
+                    {"$pull": {"loans": {"_id": ObjectId(loan_id)}}},
+                    projection={"user_id": 1, "loans": {"$elemMatch": {"_id": ObjectId(loan_id)}}}
+                )
+            except Exception as e:
+                return False, f"Database error during deletion: {str(e)}"
+            if bucket:
+                self._record_events(LOAN_DELETED, bucket['loans'])
+                return True, "Loan record successfully deleted."
             return False, "Loan not found."
 
         # Sanity Check: Only loans that have been returned can be deleted
@@ -403,13 +1863,12 @@ class Loan:
             return False, "Cannot delete an active (unreturned) loan."
             
         try:
-            self.collection.delete_one({"_id": ObjectId(loan_id)})
+            if self.collection.delete_one({"_id": ObjectId(loan_id), "return_date": {"$ne": None}}).deleted_count:
+                self._record_events(LOAN_DELETED, [loan])
             return True, "Loan record successfully deleted."
         except Exception as e:
             return False, f"Database error during deletion: {str(e)}"
 
-# Global instance of the Loan model for use in app.py
-loan_model = Loan() 
 
 # --- Q2(c) User Model ---
 
@@ -418,36 +1877,49 @@ class User:
     Represents the User document structure and handles interaction with 
     the MongoDB 'users' collection.
     """
+
+    # (name, keys, options) for every index the User queries rely on
+    INDEXES = [
+        # Fast lookup by email, which must also be unique (default name, as created by earlier versions)
+        ('email_1', [('email', 1)], {'unique': True})
+    ]
     
-    def __init__(self):
-        """Initializes connection to the Users collection."""
-        self.collection = db[USER_COLLECTION_NAME]
-        
-        # Ensure an index on 'email' for fast lookup and uniqueness
-        self.collection.create_index("email", unique=True)
-        
-        # Seed required users for Q2(c)
-        self._seed_required_users()
+    def __init__(self, connection):
+        """Keeps the connection used to reach the Users collection."""
+        self.connection = connection
 
-    def _seed_required_users(self):
+    @property
+    def collection(self):
+        return self.connection.db[USER_COLLECTION_NAME]
+
+    def seed_users(self, users):
         """
-        Registers the admin and non-admin users required by Q2(c) if they 
-        haven't been created yet.
+        Creates the given users ({'email', 'password', 'name'}) if they do not exist yet,
+        with one lookup and one bulk_write keyed on email. Passwords are only hashed
+        for users that are actually missing. Returns the emails that were created.
         """
-        users_to_seed = [
-            {'email': 'admin@lib.sg', 'password': '12345', 'name': 'Admin'},
-            {'email': 'poh@lib.sg', 'password': '12345', 'name': 'Peter Oh'}
+        emails = [user_data['email'] for user_data in users]
+        existing = {user_doc['email'] for user_doc in self.collection.find({'email': {'$in': emails}}, {'email': 1})}
+
+        operations = [
+            UpdateOne(
+                {'email': user_data['email']},
+                {'$setOnInsert': {
+                    'email': user_data['email'],
+                    'password': generate_password_hash(user_data['password']),
+                    'name': user_data['name']
+                }},
+                upsert=True
+            )
+            for user_data in users if user_data['email'] not in existing
         ]
-        
-        for user_data in users_to_seed:
-            # Check if user already exists
-            if self.collection.find_one({'email': user_data['email']}) is None:
-                print(f"Seeding user: {user_data['email']}...")
-                self.register_user(
-                    email=user_data['email'], 
-                    password=user_data['password'], 
-                    name=user_data['name']
-                )
+        if operations:
+            self.collection.bulk_write(operations, ordered=False)
+        return [user_data['email'] for user_data in users if user_data['email'] not in existing]
+
+    def ensure_indexes(self):
+        """Creates and verifies the indexes on the users collection."""
+        return ensure_collection_indexes(self.collection, self.INDEXES)
     
     def register_user(self, email, password, name):
         """
@@ -489,6 +1961,19 @@ class User:
             return check_password_hash(user_doc['password'], password)
         return False
     
+    def get_users_by_ids(self, user_ids):
+        """Retrieves the name and email of several users in one query, keyed by string id."""
+        object_ids = []
+        for user_id in dict.fromkeys(user_ids):
+            try:
+                object_ids.append(ObjectId(user_id))
+            except Exception:
+                continue
+        if not object_ids:
+            return {}
+        users = self.collection.find({'_id': {'$in': object_ids}}, {'name': 1, 'email': 1})
+        return {str(user_doc['_id']): user_doc for user_doc in users}
+
     def get_user_by_id(self, user_id):
         """Retrieves a user document by its string ID (MongoDB ObjectId)."""
         try:
@@ -501,6 +1986,51 @@ class User:
             user_doc['id'] = str(user_doc['_id'])
         return user_doc
 
-# Global instance of the User model for use in app.py
-user_model = User()
 
+
+# --- Model Wiring ---
+
+def create_models(connection):
+    """
+    Creates the Book, Hold, Loan and User models on one db.MongoConnection.
+    Returns them as {'book_model', 'hold_model', 'loan_model', 'user_model'}.
+    """
+    book_model = Book(connection)
+    hold_model = Hold(connection, book_model)
+    return {
+        'book_model': book_model,
+        'hold_model': hold_model,
+        'loan_model': Loan(connection, book_model, hold_model),
+        'user_model': User(connection)
+    }
+
+
+def ensure_all_indexes(models):
+    """
+    Creates and verifies every index the Book, Hold, Loan and User models rely on.
+    Raises RuntimeError if an index could not be created.
+    """
+    created = {}
+    for model in models.values():
+        created[model.collection.name] = model.ensure_indexes()
+    return created
+
+
+# --- Schema Version ---
+
+# Bump when a deployment needs `python manage.py migrate` (new indexes or backfills)
+SCHEMA_VERSION = 7
+
+def get_schema_version(connection):
+    """Returns the schema version recorded by the last migration, or 0 if none ran."""
+    meta = connection.db['app_meta'].find_one({'_id': 'schema'})
+    return meta.get('version', 0) if meta else 0
+
+
+def record_schema_version(connection, version=SCHEMA_VERSION):
+    """Records the schema version after a successful migration."""
+    connection.db['app_meta'].update_one(
+        {'_id': 'schema'},
+        {'$set': {'version': version, 'applied_at': datetime.now(timezone.utc)}},
+        upsert=True
+    )
@@ -0,0 +1,235 @@
+"""
+Background scanner that marks overdue loans.
+
+Active loans whose due date has passed are found through the loans index on
+(return_date, due_date) in batches of OVERDUE_SCAN_BATCH_SIZE. Each one gets
+overdue: True and overdue_since, and one event in the overdue_events collection
+for the notifier to pick up. Renewing a loan clears its flag, so a loan that
+misses its new due date is flagged again with a new event. The totals are kept in app_meta for the admin report.
+Each scan also expires the ready holds whose copy was not collected in time
+(Hold.expire_ready_holds), so that copy goes to the next user in the queue.
+
+A lease in app_meta makes sure only one process scans at a time, so the scanner
+can run in every web worker (OVERDUE_SCAN_IN_APP) or as a separate worker:
+
+    python overdue.py            # scan every OVERDUE_SCAN_INTERVAL_SECONDS until stopped
+    python overdue.py --once     # one scan, then exit (e.g. from cron)
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+from datetime import datetime
+
+from pymongo.errors import BulkWriteError
+
+from config import OVERDUE_SCAN_BATCH_SIZE, OVERDUE_SCAN_MAX_BATCHES, OVERDUE_SCAN_INTERVAL_SECONDS
+from models import acquire_lease, ensure_collection_indexes
+
+
+class OverdueScanner:
+    """Flags overdue loans, records one overdue event per missed due date and keeps the overdue totals."""
+
+    # (name, keys, options) for the indexes on overdue_events
+    EVENT_INDEXES = [
+        # One event per missed due date: renewing an overdue loan clears its flag, and
+        # missing the new due date raises a new event
+        ('loan_due_date', [('loan_id', 1), ('due_date', 1)], {'unique': True}),
+        # Events not yet sent, oldest first (the notifier's queue)
+        ('notified_created', [('notified_at', 1), ('created_at', 1)], {})
+    ]
+    # Replaced by loan_due_date
+    RETIRED_EVENT_INDEXES = ['loan_id']
+
+    LEASE_ID = 'overdue_scan_lease'
+    SUMMARY_ID = 'overdue_summary'
+
+    def __init__(self, connection, hold_model=None, batch_size=OVERDUE_SCAN_BATCH_SIZE,
+                 max_batches=OVERDUE_SCAN_MAX_BATCHES, interval_seconds=OVERDUE_SCAN_INTERVAL_SECONDS):
+        self.connection = connection
+        # The Hold model whose uncollected ready holds are expired on each scan (optional)
+        self.hold_model = hold_model
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.interval_seconds = interval_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{id(self)}"
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def loans_collection(self):
+        return self.connection.db['loans']
+
+    @property
+    def events_collection(self):
+        return self.connection.db['overdue_events']
+
+    @property
+    def meta_collection(self):
+        return self.connection.db['app_meta']
+
+    def ensure_indexes(self):
+        """Creates and verifies the indexes on the overdue_events collection."""
+        return ensure_collection_indexes(self.events_collection, self.EVENT_INDEXES, retired=self.RETIRED_EVENT_INDEXES)
+
+    # --- Lease ---
+
+    def acquire_lease(self, seconds):
+        """
+        Takes (or renews) the scan lease for seconds. Returns False while another
+        process holds an unexpired lease.
+        """
+        return acquire_lease(self.meta_collection, self.LEASE_ID, self.owner, seconds)
+
+    # --- Scanning ---
+
+    def scan(self, now=None):
+        """
+        Flags every active loan that is past due and not yet flagged, in batches, then
+        refreshes the overdue totals. Returns the statistics of this scan as a dictionary.
+        """
+        # Loan dates are stored as naive local times (see Loan.create_loan). MongoDB keeps
+        # milliseconds, so now is truncated to match the stored overdue_since exactly.
+        now = now or datetime.now()
+        now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+        query = {'return_date': None, 'due_date': {'$lt': now}, 'overdue': {'$ne': True}}
+        stats = {'flagged': 0, 'events': 0, 'batches': 0}
+
+        while stats['batches'] < self.max_batches:
+            batch = list(
+                self.loans_collection.find(query, {'user_id': 1, 'book_id': 1, 'due_date': 1})
+                .sort('due_date', 1)
+                .limit(self.batch_size)
+            )
+            if not batch:
+                break
+            stats['batches'] += 1
+
+            # The filter repeats the conditions, so a loan returned since it was read is left alone
+            batch_ids = [loan['_id'] for loan in batch]
+            result = self.loans_collection.update_many(
+                {'_id': {'$in': batch_ids}, 'return_date': None, 'overdue': {'$ne': True}},
+                {'$set': {'overdue': True, 'overdue_since': now}}
+            )
+            stats['flagged'] += result.modified_count
+            if result.modified_count:
+                # Only the loans this scan flagged get an event, not those returned in between
+                flagged = self.loans_collection.find(
+                    {'_id': {'$in': batch_ids}, 'overdue_since': now},
+                    {'user_id': 1, 'book_id': 1, 'due_date': 1}
+                )
+                stats['events'] += self._record_events(list(flagged), now)
+
+            if len(batch) < self.batch_size:
+                break
+
+        if self.hold_model is not None:
+            stats['expired_holds'] = self.hold_model.expire_ready_holds(now)
+
+        stats.update(self.refresh_summary(now))
+        stats['scanned_at'] = now
+        self.meta_collection.update_one({'_id': self.SUMMARY_ID}, {'$set': {'last_scan': stats}}, upsert=True)
+        return stats
+
+    def _record_events(self, loans, now):
+        """Inserts one overdue event per loan and due date; those already recorded are skipped."""
+        if not loans:
+            return 0
+        events = [{
+            'loan_id': loan['_id'],
+            'user_id': loan['user_id'],
+            'book_id': loan['book_id'],
+            'due_date': loan['due_date'],
+            'created_at': now,
+            'notified_at': None
+        } for loan in loans]
+        try:
+            return len(self.events_collection.insert_many(events, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            # Duplicate (loan_id, due_date): the event was recorded by an earlier (interrupted) scan
+            return e.details.get('nInserted', 0)
+
+    def refresh_summary(self, now=None):
+        """
+        Recounts the active overdue loans and the users holding them (an index range on
+        (return_date, due_date)) and stores the totals. Returns them as a dictionary.
+        """
+        now = now or datetime.now()
+        totals = list(self.loans_collection.aggregate([
+            {'$match': {'return_date': None, 'due_date': {'$lt': now}}},
+            {'$group': {'_id': None, 'loans': {'$sum': 1}, 'users': {'$addToSet': '$user_id'}}},
+            {'$project': {'_id': 0, 'loans': 1, 'users': {'$size': '$users'}}}
+        ]))
+        summary = {
+            'overdue_loans': totals[0]['loans'] if totals else 0,
+            'overdue_users': totals[0]['users'] if totals else 0,
+            'updated_at': now
+        }
+        self.meta_collection.update_one({'_id': self.SUMMARY_ID}, {'$set': summary}, upsert=True)
+        return summary
+
+    def get_summary(self):
+        """Returns the stored overdue totals and last scan statistics (empty before the first scan)."""
+        return self.meta_collection.find_one({'_id': self.SUMMARY_ID}, {'_id': 0}) or {}
+
+    # --- Scheduling ---
+
+    def run_once(self):
+        """Scans if this process holds the lease. Returns the scan statistics, or None."""
+        # The lease outlives the interval a little so a slow scan is not started twice
+        if not self.acquire_lease(self.interval_seconds * 2):
+            return None
+        return self.scan()
+
+    def run_forever(self):
+        """Scans every interval_seconds until stop() is called."""
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Overdue scan failed: {e}")
+            self._stop.wait(self.interval_seconds)
+
+    def start(self):
+        """Starts run_forever on a daemon thread (once per process)."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run_forever, name='overdue-scanner', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Flag overdue loans and record overdue events.")
+    parser.add_argument('--once', action='store_true', help="Run one scan and exit")
+    parser.add_argument('--interval', type=int, default=OVERDUE_SCAN_INTERVAL_SECONDS, help="Seconds between scans")
+    parser.add_argument('--batch-size', type=int, default=OVERDUE_SCAN_BATCH_SIZE, help="Loans flagged per batch")
+    args = parser.parse_args(argv)
+
+    from db import MongoConnection
+    from models import create_models
+
+    connection = MongoConnection.from_config()
+    scanner = OverdueScanner(
+        connection, hold_model=create_models(connection)['hold_model'],
+        batch_size=max(1, args.batch_size), interval_seconds=max(1, args.interval)
+    )
+
+    try:
+        if args.once:
+            print(json.dumps(scanner.scan(), default=str))
+        else:
+            scanner.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        connection.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
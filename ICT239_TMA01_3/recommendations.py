@@ -0,0 +1,294 @@
+"""
+"Borrowers also borrowed" recommendations, precomputed per book.
+
+Every (user, book) pair that appears in the loans (active, returned or archived)
+is one entry of a sparse user x book matrix X. For the books being refreshed,
+this job computes in NumPy
+
+    together[i, j] = number of users who borrowed both i and j   (X^T X)
+    score[i, j]    = together[i, j] / sqrt(borrowers[i] * borrowers[j])   (cosine)
+
+RECOMMEND_BLOCK_SIZE books at a time. together is counted from the sparse pairs
+(each borrower of a block book contributes one to every other book they borrowed),
+at most RECOMMEND_CHUNK_PAIRS at a time, so nothing of size users x books is ever
+made dense. The RECOMMEND_TOP_K books with the highest
+score (shared by at least RECOMMEND_MIN_TOGETHER users) are stored in
+book_recommendations, one document per book, with their titles and covers:
+
+    {_id: book_id, neighbors: [{book_id, title, image_file, score, together}], updated_at}
+
+so the detail page shows them with a single find_one.
+
+Runs are incremental: only the borrows and deletions in the loan_events outbox
+since the last run are read, and only the books whose scores they can change are
+recomputed (every book borrowed by a user who borrowed one of the changed books).
+Titles copied into the documents are refreshed when a book is recomputed; run
+--full after renaming books, or if the job was stopped longer than the outbox
+keeps events (LOAN_EVENT_RETENTION_DAYS).
+
+Usage (e.g. every few minutes from cron):
+    python recommendations.py [--full]
+"""
+import argparse
+import json
+import sys
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from bson.objectid import ObjectId
+from pymongo import DeleteOne, ReplaceOne
+
+from config import (
+    LOAN_ARCHIVE_COLLECTION_NAME, LOAN_EVENTS_COLLECTION_NAME, LOAN_EVENT_LAG_SECONDS,
+    RECOMMENDATIONS_COLLECTION_NAME, RECOMMEND_TOP_K, RECOMMEND_MIN_TOGETHER, RECOMMEND_BLOCK_SIZE,
+    RECOMMEND_CHUNK_PAIRS
+)
+from models import LOAN_BORROWED, LOAN_DELETED
+
+# Event types that add or remove a (user, book) pair; renewals and returns change neither
+PAIR_EVENTS = [LOAN_BORROWED, LOAN_DELETED]
+
+
+class BookRecommender:
+    """Computes the related books of each book from shared borrowers and serves them."""
+
+    CHECKPOINT_ID = 'recommendations'
+
+    def __init__(self, connection, book_model, top_k=RECOMMEND_TOP_K, min_together=RECOMMEND_MIN_TOGETHER,
+                 block_size=RECOMMEND_BLOCK_SIZE, chunk_pairs=RECOMMEND_CHUNK_PAIRS,
+                 lag_seconds=LOAN_EVENT_LAG_SECONDS):
+        self.connection = connection
+        # The Book model, for the titles and covers stored with the neighbors
+        self.book_model = book_model
+        self.top_k = top_k
+        self.min_together = min_together
+        self.block_size = block_size
+        self.chunk_pairs = chunk_pairs
+        self.lag_seconds = lag_seconds
+
+    @property
+    def collection(self):
+        return self.connection.db[RECOMMENDATIONS_COLLECTION_NAME]
+
+    @property
+    def loans_collection(self):
+        return self.connection.db['loans']
+
+    @property
+    def archive_collection(self):
+        return self.connection.db[LOAN_ARCHIVE_COLLECTION_NAME]
+
+    @property
+    def events_collection(self):
+        return self.connection.db[LOAN_EVENTS_COLLECTION_NAME]
+
+    @property
+    def meta_collection(self):
+        return self.connection.db['app_meta']
+
+    # --- Building ---
+
+    def run(self, full=False, now=None):
+        """
+        Recomputes the recommendations changed by the loan events since the last run
+        (every book if full or on the first run). Returns the statistics as a dictionary.
+        """
+        now = now or datetime.now(timezone.utc)
+        # Events younger than the lag may have older ones still in open transactions
+        horizon = ObjectId.from_datetime(now - timedelta(seconds=self.lag_seconds))
+        checkpoint = self.meta_collection.find_one({'_id': self.CHECKPOINT_ID}) or {}
+        last_event_id = checkpoint.get('last_event_id')
+        full = full or last_event_id is None
+
+        query = {'_id': {'$lt': horizon}}
+        if not full:
+            query['_id']['$gt'] = last_event_id
+        last = self.events_collection.find_one(query, {'_id': 1}, sort=[('_id', -1)])
+        if last is None and not full:
+            return {'books': 0, 'full': False}
+
+        matrix = self._load_matrix()
+        if full:
+            targets = np.arange(len(matrix['book_ids']))
+        else:
+            query['type'] = {'$in': PAIR_EVENTS}
+            changed_users, changed_books = set(), set()
+            for event in self.events_collection.find(query, {'user_id': 1, 'book_id': 1}):
+                changed_users.add(str(event['user_id']))
+                changed_books.add(str(event['book_id']))
+            targets = self._affected_books(matrix, changed_users, changed_books)
+            # Changed books with no borrowers left have no row in the matrix
+            gone = changed_books.difference(matrix['book_ids'][targets])
+
+        operations = self._neighbor_documents(matrix, targets, now)
+        if not full:
+            operations += [DeleteOne({'_id': book_id}) for book_id in gone]
+        if operations:
+            self.collection.bulk_write(operations, ordered=False)
+        if full:
+            self.collection.delete_many({'_id': {'$nin': matrix['book_ids'].tolist()}})
+
+        # With no events yet, the next run starts from the horizon (nothing older can still appear)
+        self.meta_collection.update_one(
+            {'_id': self.CHECKPOINT_ID},
+            {'$set': {'last_event_id': last['_id'] if last else horizon, 'updated_at': now}},
+            upsert=True
+        )
+        return {'books': len(targets), 'full': full, 'users': len(matrix['user_ids']), 'pairs': len(matrix['users'])}
+
+    def _load_matrix(self):
+        """
+        Reads every distinct (user, book) pair of the active and archived loans and
+        returns the sparse matrix as index arrays: {'user_ids', 'book_ids' (sorted
+        string ids), 'users', 'books' (one entry per pair), 'borrowers' (per book),
+        'by_user', 'user_counts', 'user_starts' (the books grouped by user)}.
+        """
+        pairs = set()
+        for pair in self.loans_collection.aggregate([
+            {'$group': {'_id': {'user_id': '$user_id', 'book_id': '$book_id'}}}
+        ]):
+            pairs.add((str(pair['_id']['user_id']), str(pair['_id']['book_id'])))
+        for pair in self.archive_collection.aggregate([
+            {'$unwind': '$loans'},
+            {'$group': {'_id': {'user_id': '$user_id', 'book_id': '$loans.book_id'}}}
+        ]):
+            pairs.add((str(pair['_id']['user_id']), str(pair['_id']['book_id'])))
+
+        user_ids, users = np.unique(np.array([user_id for user_id, _ in pairs], dtype=str), return_inverse=True)
+        book_ids, books = np.unique(np.array([book_id for _, book_id in pairs], dtype=str), return_inverse=True)
+        users, books = users.astype(np.int64), books.astype(np.int64)
+        # The books of each user, contiguous: by_user[user_starts[u]:user_starts[u] + user_counts[u]]
+        user_counts = np.bincount(users, minlength=len(user_ids))
+        return {
+            'user_ids': user_ids,
+            'book_ids': book_ids,
+            'users': users,
+            'books': books,
+            'borrowers': np.bincount(books, minlength=len(book_ids)).astype(np.float32),
+            'by_user': books[np.argsort(users, kind='stable')],
+            'user_counts': user_counts,
+            'user_starts': np.cumsum(user_counts) - user_counts
+        }
+
+    def _affected_books(self, matrix, user_ids, book_ids):
+        """
+        Returns the indexes of the books whose neighbors can change when the pairs of
+        user_ids and book_ids change: every book borrowed by those users or by anyone
+        who borrowed one of those books.
+        """
+        changed_users = np.flatnonzero(np.isin(matrix['user_ids'], list(user_ids)))
+        changed_books = np.flatnonzero(np.isin(matrix['book_ids'], list(book_ids)))
+        users = np.union1d(changed_users, matrix['users'][np.isin(matrix['books'], changed_books)])
+        return np.union1d(changed_books, matrix['books'][np.isin(matrix['users'], users)])
+
+    def _neighbor_documents(self, matrix, targets, now):
+        """Computes the top-K neighbors of the target books block by block; returns one write per book."""
+        neighbors = {}
+        for start in range(0, len(targets), self.block_size):
+            block = targets[start:start + self.block_size]
+            neighbors.update(self._top_neighbors(matrix, block))
+
+        neighbor_ids = {book_id for found in neighbors.values() for book_id, _, _ in found}
+        books = {book['id']: book for book in self.book_model.get_books_by_ids(
+            list(neighbor_ids), projection={'title': 1, 'image_file': 1}
+        )}
+
+        operations = []
+        for book_id, found in neighbors.items():
+            entries = [{
+                'book_id': neighbor_id,
+                'title': books[neighbor_id]['title'],
+                'image_file': books[neighbor_id].get('image_file'),
+                'score': round(score, 4),
+                'together': together
+            } for neighbor_id, score, together in found if neighbor_id in books]
+            if entries:
+                operations.append(ReplaceOne({'_id': book_id}, {'neighbors': entries, 'updated_at': now}, upsert=True))
+            else:
+                operations.append(DeleteOne({'_id': book_id}))
+        return operations
+
+    def _top_neighbors(self, matrix, block):
+        """
+        Returns {book_id: [(neighbor_id, score, together)]} for the books of block, best first.
+        """
+        book_count = len(matrix['book_ids'])
+        together = self._count_together(matrix, block)
+        scores = together / np.sqrt(np.outer(matrix['borrowers'][block], matrix['borrowers']))
+        scores[together < self.min_together] = -1
+        scores[np.arange(len(block)), block] = -1 # A book is not its own neighbor
+
+        k = min(self.top_k, book_count)
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+
+        result = {}
+        for row, book in enumerate(block):
+            picked = candidates[row]
+            # Highest score first; more shared borrowers breaks ties
+            picked = picked[np.lexsort((-together[row, picked], -scores[row, picked]))]
+            result[str(matrix['book_ids'][book])] = [
+                (str(matrix['book_ids'][other]), float(scores[row, other]), int(together[row, other]))
+                for other in picked if scores[row, other] >= 0
+            ]
+        return result
+
+    def _count_together(self, matrix, block):
+        """
+        Returns together (X^T X) for the rows of block as a len(block) x books array,
+        counted from the pairs: every (user, block book) pair adds one to each book of
+        that user. The pairs are expanded at most chunk_pairs at a time.
+        """
+        book_count = len(matrix['book_ids'])
+        block_rows = np.full(book_count, -1, dtype=np.int64)
+        block_rows[block] = np.arange(len(block))
+
+        in_block = block_rows[matrix['books']] >= 0
+        rows = block_rows[matrix['books'][in_block]]
+        users = matrix['users'][in_block]
+        lengths = matrix['user_counts'][users]
+
+        together = np.zeros(len(block) * book_count, dtype=np.int64)
+        # Split the block's pairs so each chunk expands to about chunk_pairs pairs (at least one pair per chunk)
+        ends = np.cumsum(lengths)
+        bounds = np.unique(np.searchsorted(ends, np.arange(self.chunk_pairs, ends[-1] if len(ends) else 0,
+                                                           self.chunk_pairs), side='right'))
+        for chunk_rows, chunk_users, chunk_lengths in zip(np.split(rows, bounds), np.split(users, bounds),
+                                                          np.split(lengths, bounds)):
+            total = int(chunk_lengths.sum())
+            if not total:
+                continue
+            # Position of each expanded pair in by_user: the user's start plus its offset within the user
+            offsets = np.arange(total) - np.repeat(np.cumsum(chunk_lengths) - chunk_lengths, chunk_lengths)
+            others = matrix['by_user'][np.repeat(matrix['user_starts'][chunk_users], chunk_lengths) + offsets]
+            together += np.bincount(np.repeat(chunk_rows, chunk_lengths) * book_count + others,
+                                    minlength=len(together))
+        return together.reshape(len(block), book_count)
+
+    # --- Reading ---
+
+    def get_related(self, book_id):
+        """Returns {'neighbors': [...], 'updated_at'} of a book, or an empty dictionary if it has none."""
+        return self.collection.find_one({'_id': str(book_id)}, {'_id': 0}) or {}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recompute the \"borrowers also borrowed\" recommendations.")
+    parser.add_argument('--full', action='store_true', help="Recompute every book, not only those changed by new loan events")
+    args = parser.parse_args(argv)
+
+    from db import MongoConnection
+    from models import create_models
+
+    connection = MongoConnection.from_config()
+    recommender = BookRecommender(connection, create_models(connection)['book_model'])
+    try:
+        stats = recommender.run(full=args.full)
+    finally:
+        connection.close()
+
+    print(json.dumps(stats, default=str))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,228 @@
+"""
+Inventory reconciliation: recomputes the available count of books from the loans.
+
+The available count of a book is a counter kept in step with the loans by the
+borrow and return paths. Outside a transaction a failed write between the two
+(e.g. the count update after a return) leaves it wrong. For each book this job
+recounts
+
+    expected available = copies - active loans - copies reserved for ready holds
+
+with one $group aggregation over the loans of a batch of books, and reports every
+book that differs. With --fix the differences are corrected with one bulk_write
+per batch; each update is guarded by the count that was read, so a concurrent
+borrow or return is never overwritten.
+
+Runs are incremental: only books written since the last run are checked, found
+through the updated_at of books and loans and the closed_at of holds. Books
+changed in the last RECONCILE_SETTLE_SECONDS are left to the next run, so a
+borrow or return still in flight is not mistaken for drift. The checkpoint is
+kept in app_meta as one UTC instant. Books store UTC times and loans and holds
+local times, so the instant is converted to each before comparing.
+
+Usage:
+    python reconcile.py [--fix] [--full] [--batch-size 500]
+"""
+import argparse
+import json
+import sys
+from datetime import datetime, timedelta, timezone
+
+from pymongo import UpdateOne
+
+from config import HOLD_COLLECTION_NAME, RECONCILE_BATCH_SIZE, RECONCILE_SETTLE_SECONDS
+from models import HOLD_READY
+
+
+def stored_times(instant):
+    """
+    Returns an aware instant as the naive datetimes the collections store it as:
+    {'books': UTC (Book writes datetime.now(timezone.utc)), 'loans': local time
+    (loans and holds are written with datetime.now())}.
+    """
+    return {
+        'books': instant.astimezone(timezone.utc).replace(tzinfo=None),
+        'loans': instant.astimezone().replace(tzinfo=None)
+    }
+
+
+class InventoryReconciler:
+    """Compares each book's available count with its loans and holds, and optionally corrects it."""
+
+    CHECKPOINT_ID = 'inventory_reconcile'
+
+    BOOK_PROJECTION = {'title': 1, 'copies': 1, 'available': 1, 'category_key': 1, 'updated_at': 1}
+
+    def __init__(self, connection, book_model, batch_size=RECONCILE_BATCH_SIZE, settle_seconds=RECONCILE_SETTLE_SECONDS):
+        self.connection = connection
+        # The Book model, for the books collection and the cache invalidation after a fix
+        self.book_model = book_model
+        self.batch_size = batch_size
+        self.settle_seconds = settle_seconds
+
+    @property
+    def books_collection(self):
+        return self.book_model.collection
+
+    @property
+    def loans_collection(self):
+        return self.connection.db['loans']
+
+    @property
+    def holds_collection(self):
+        return self.connection.db[HOLD_COLLECTION_NAME]
+
+    @property
+    def meta_collection(self):
+        return self.connection.db['app_meta']
+
+    def reconcile(self, fix=False, full=False, report=None, now=None):
+        """
+        Checks the books written since the last run (every book if full or on the first
+        run), correcting drift if fix. report(drift) is called for each book whose count
+        is wrong. now is an aware datetime (default: the current time).
+        Returns the statistics of this run as a dictionary.
+        """
+        # One UTC instant bounds the run; stored_times() gives it in each collection's own time base
+        checked_until = (now or datetime.now(timezone.utc)) - timedelta(seconds=self.settle_seconds)
+        until = stored_times(checked_until)
+        checkpoint = self.meta_collection.find_one({'_id': self.CHECKPOINT_ID}) or {}
+        since = None if full else checkpoint.get('checked_until')
+        if isinstance(since, dict):
+            # Older checkpoints kept one time per collection; the books one is UTC
+            since = since['books']
+        if since is not None:
+            since = stored_times(since.replace(tzinfo=timezone.utc))
+
+        stats = {'checked': 0, 'drifted': 0, 'fixed': 0, 'over_lent': 0, 'skipped_recent': 0, 'batches': 0,
+                 'since': since, 'until': until}
+        for books in self._book_batches(since):
+            stats['batches'] += 1
+            self._check_batch(books, until, fix, stats, report)
+
+        # Books skipped as recently changed were written after 'until', so the next run sees them
+        self.meta_collection.update_one(
+            {'_id': self.CHECKPOINT_ID},
+            {'$set': {'checked_until': checked_until,
+                      'last_run': dict(stats, fix=fix, finished_at=datetime.now(timezone.utc))}},
+            upsert=True
+        )
+        return stats
+
+    def _book_batches(self, since):
+        """Yields lists of up to batch_size books: all of them, or those written since the checkpoint."""
+        if since is None:
+            cursor = self.books_collection.find({}, self.BOOK_PROJECTION).sort('_id', 1).batch_size(self.batch_size)
+            batch = []
+            for book in cursor:
+                batch.append(book)
+                if len(batch) >= self.batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+            return
+
+        # Served by the updated_at indexes on books and loans and the closed_at index on holds
+        book_ids = {str(book['_id']) for book in self.books_collection.find({'updated_at': {'$gte': since['books']}}, {'_id': 1})}
+        book_ids.update(self.loans_collection.distinct('book_id', {'updated_at': {'$gte': since['loans']}}))
+        book_ids.update(self.holds_collection.distinct('book_id', {'closed_at': {'$gte': since['loans']}}))
+
+        book_ids = sorted(book_ids)
+        for start in range(0, len(book_ids), self.batch_size):
+            yield self.book_model.get_books_by_ids(book_ids[start:start + self.batch_size], projection=self.BOOK_PROJECTION)
+
+    def _check_batch(self, books, until, fix, stats, report):
+        """Recounts the loans and ready holds of one batch of books and compares them with the counters."""
+        book_ids = [str(book['_id']) for book in books]
+
+        # Active loans per book, plus the latest change among them and among loans returned just now
+        loan_counts = {row['_id']: row for row in self.loans_collection.aggregate([
+            {'$match': {'book_id': {'$in': book_ids}, '$or': [{'return_date': None}, {'updated_at': {'$gte': until['loans']}}]}},
+            {'$group': {
+                '_id': '$book_id',
+                'on_loan': {'$sum': {'$cond': [{'$eq': ['$return_date', None]}, 1, 0]}},
+                'last_change': {'$max': '$updated_at'}
+            }}
+        ])}
+        hold_counts = {row['_id']: row for row in self.holds_collection.aggregate([
+            {'$match': {'book_id': {'$in': book_ids}, '$or': [{'status': HOLD_READY}, {'closed_at': {'$gte': until['loans']}}]}},
+            {'$group': {
+                '_id': '$book_id',
+                'reserved': {'$sum': {'$cond': [{'$eq': ['$status', HOLD_READY]}, 1, 0]}},
+                'last_change': {'$max': '$closed_at'}
+            }}
+        ])}
+
+        fixes, fixed_books = [], []
+        for book in books:
+            book_id = str(book['_id'])
+            loans = loan_counts.get(book_id, {})
+            holds = hold_counts.get(book_id, {})
+            if ((book.get('updated_at') and book['updated_at'] >= until['books'])
+                    or (loans.get('last_change') and loans['last_change'] >= until['loans'])
+                    or (holds.get('last_change') and holds['last_change'] >= until['loans'])):
+                stats['skipped_recent'] += 1
+                continue
+
+            stats['checked'] += 1
+            copies = book.get('copies', 1)
+            on_loan = loans.get('on_loan', 0)
+            reserved = holds.get('reserved', 0)
+            expected = copies - on_loan - reserved
+            if expected < 0:
+                # More copies out than exist: copies itself is wrong, which needs a person to look at
+                stats['over_lent'] += 1
+                expected = 0
+            if book.get('available') == expected:
+                continue
+
+            stats['drifted'] += 1
+            if report:
+                report({'book_id': book_id, 'title': book.get('title'), 'copies': copies, 'available': book.get('available'),
+                        'on_loan': on_loan, 'reserved': reserved, 'expected': expected})
+            if fix:
+                fixes.append(UpdateOne(
+                    {'_id': book['_id'], 'available': book.get('available')},
+                    {'$set': {'available': expected, 'updated_at': datetime.now(timezone.utc)}, '$inc': {'revision': 1}}
+                ))
+                fixed_books.append(book)
+
+        if fixes:
+            result = self.books_collection.bulk_write(fixes, ordered=False)
+            stats['fixed'] += result.modified_count
+            self.book_model.copies_changed_many(
+                [book['_id'] for book in fixed_books], {book.get('category_key') for book in fixed_books}
+            )
+
+    def get_last_run(self):
+        """Returns the checkpoint and statistics of the last run (empty before the first one)."""
+        return self.meta_collection.find_one({'_id': self.CHECKPOINT_ID}, {'_id': 0}) or {}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recompute the available count of books from their loans.")
+    parser.add_argument('--fix', action='store_true', help="Correct the drift found (default: only report it)")
+    parser.add_argument('--full', action='store_true', help="Check every book, not only those written since the last run")
+    parser.add_argument('--batch-size', type=int, default=RECONCILE_BATCH_SIZE, help="Books checked per batch")
+    args = parser.parse_args(argv)
+
+    from db import MongoConnection
+    from models import create_models
+
+    connection = MongoConnection.from_config()
+    reconciler = InventoryReconciler(connection, create_models(connection)['book_model'], batch_size=max(1, args.batch_size))
+    try:
+        stats = reconciler.reconcile(
+            fix=args.fix, full=args.full,
+            report=lambda drift: print(json.dumps(drift), file=sys.stderr)
+        )
+    finally:
+        connection.close()
+
+    print(json.dumps(stats, default=str))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
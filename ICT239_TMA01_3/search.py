@@ -0,0 +1,336 @@
+from bisect import bisect_left, insort
+import math
+import re
+from datetime import timezone
+import threading
+import time
+import unicodedata
+
+# Words are runs of letters/digits; everything is case-folded before indexing
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text):
+    """Splits text into lower-cased word tokens."""
+    return TOKEN_PATTERN.findall((text or '').casefold())
+
+
+def search_fields(book):
+    """
+    Returns the searchable text of a book document per field. Handles both the
+    'authors' list and the older single 'author' string.
+    """
+    authors = book.get('authors')
+    if not authors:
+        authors = [book.get('author')] if book.get('author') else []
+    return {
+        'title': book.get('title', ''),
+        'authors': " ".join(authors),
+        'genres': " ".join(book.get('genres') or []),
+        'description': book.get('description', '')
+    }
+
+
+def normalize_suggestion(text):
+    """
+    Normalizes text for prefix matching: accents removed, case-folded,
+    punctuation dropped and whitespace collapsed.
+    """
+    decomposed = unicodedata.normalize('NFKD', text or '')
+    without_accents = "".join(char for char in decomposed if not unicodedata.combining(char))
+    return " ".join(tokenize(without_accents))
+
+
+def naive_utc(value):
+    """Documents read back from MongoDB carry naive UTC datetimes; convert aware ones to match."""
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+class SearchIndex:
+    """
+    In-process inverted index over the books collection, ranked with BM25.
+
+    - Term frequencies are weighted per field (a title hit counts more than a
+      description hit), which is a simple form of BM25F.
+    - Every query word also matches indexed terms that start with it, found with
+      bisect on a sorted term list, so 'harr' finds 'harry'. Exact matches score higher.
+    - The index is built from the collection on the first sync (lazily, so that
+      creating the app does no I/O) and then kept up to date by add_document
+      (hooked into Book.add_new_book) and sync (for writes made by other worker processes).
+    """
+
+    FIELD_WEIGHTS = {'title': 3.0, 'authors': 2.0, 'genres': 1.5, 'description': 1.0}
+    K1 = 1.2
+    B = 0.75
+    PREFIX_PENALTY = 0.7 # Score multiplier for a prefix (not exact) match
+    MAX_PREFIX_EXPANSIONS = 50 # Limits the work done for very short prefixes
+
+    def __init__(self, sync_interval_seconds=30):
+        self.sync_interval_seconds = sync_interval_seconds
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self._postings = {} # term -> {book_id: weighted term frequency}
+        self._doc_terms = {} # book_id -> set of terms (used to remove a document)
+        self._doc_lengths = {} # book_id -> weighted document length
+        self._total_length = 0.0
+        self._sorted_terms = [] # All terms in order, for prefix lookups
+        self.indexed_until = None # Latest content_updated_at seen, for incremental sync
+        self._last_sync = 0.0
+        self.is_built = False
+
+    # --- Building ---
+
+    def build(self, books):
+        """Rebuilds the index from an iterable of book documents."""
+        with self._lock:
+            self._reset()
+            for book in books:
+                self._add(book)
+            self._sorted_terms = sorted(self._postings)
+            self._last_sync = time.monotonic()
+            self.is_built = True
+
+    def add_document(self, book):
+        """Indexes (or re-indexes) a single book document (no-op until built)."""
+        with self._lock:
+            if self.is_built:
+                self._add(book, keep_sorted=True)
+
+    def _add(self, book, keep_sorted=False):
+        book_id = str(book['_id'])
+        if book_id in self._doc_terms:
+            self._remove(book_id)
+
+        frequencies = {}
+        length = 0.0
+        for field, text in search_fields(book).items():
+            weight = self.FIELD_WEIGHTS[field]
+            for term in tokenize(text):
+                frequencies[term] = frequencies.get(term, 0.0) + weight
+                length += weight
+
+        for term, frequency in frequencies.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = {}
+                if keep_sorted:
+                    insort(self._sorted_terms, term)
+            postings[book_id] = frequency
+
+        self._doc_terms[book_id] = set(frequencies)
+        self._doc_lengths[book_id] = length
+        self._total_length += length
+
+        updated_at = naive_utc(book.get('content_updated_at'))
+        if updated_at and (self.indexed_until is None or updated_at > self.indexed_until):
+            self.indexed_until = updated_at
+
+    def _remove(self, book_id):
+        for term in self._doc_terms.pop(book_id, ()):
+            postings = self._postings[term]
+            postings.pop(book_id, None)
+            if not postings:
+                del self._postings[term]
+                position = bisect_left(self._sorted_terms, term)
+                if position < len(self._sorted_terms) and self._sorted_terms[position] == term:
+                    del self._sorted_terms[position]
+        self._total_length -= self._doc_lengths.pop(book_id, 0.0)
+
+    def sync(self, book_model):
+        """
+        Builds the index on first use, then re-indexes books whose content changed since
+        the last sync (e.g. by another worker process) at most once every sync_interval_seconds.
+        """
+        if not self.is_built:
+            with self._lock:
+                if not self.is_built:
+                    self.build(book_model.iter_search_documents())
+            return len(self._doc_lengths)
+        if time.monotonic() - self._last_sync < self.sync_interval_seconds:
+            return 0
+        with self._lock:
+            self._last_sync = time.monotonic()
+            changed = 0
+            for book in book_model.iter_search_documents(updated_after=self.indexed_until):
+                self._add(book, keep_sorted=True)
+                changed += 1
+            return changed
+
+    # --- Querying ---
+
+    def _expand(self, token):
+        """Returns [(term, is_exact)] for the indexed terms matching a query word."""
+        matches = []
+        position = bisect_left(self._sorted_terms, token)
+        while position < len(self._sorted_terms) and len(matches) < self.MAX_PREFIX_EXPANSIONS:
+            term = self._sorted_terms[position]
+            if not term.startswith(token):
+                break
+            matches.append((term, term == token))
+            position += 1
+        return matches
+
+    def search(self, query):
+        """
+        Returns [(book_id, score)] for every book matching any query word,
+        best match first.
+        """
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+
+        with self._lock:
+            num_docs = len(self._doc_lengths)
+            if num_docs == 0:
+                return []
+            average_length = self._total_length / num_docs
+
+            scores = {}
+            for token in dict.fromkeys(tokens): # Unique words, in query order
+                token_scores = {}
+                for term, is_exact in self._expand(token):
+                    postings = self._postings[term]
+                    idf = math.log(1 + (num_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                    multiplier = 1.0 if is_exact else self.PREFIX_PENALTY
+                    for book_id, frequency in postings.items():
+                        length_norm = 1 - self.B + self.B * self._doc_lengths[book_id] / average_length
+                        score = multiplier * idf * frequency * (self.K1 + 1) / (frequency + self.K1 * length_norm)
+                        # A word counts once per book, via its best matching term
+                        if score > token_scores.get(book_id, 0.0):
+                            token_scores[book_id] = score
+
+                for book_id, score in token_scores.items():
+                    scores[book_id] = scores.get(book_id, 0.0) + score
+
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+
+    def stats(self):
+        """Returns the size of the index as a dictionary."""
+        with self._lock:
+            return {
+                'documents': len(self._doc_lengths),
+                'terms': len(self._postings),
+                'indexed_until': self.indexed_until
+            }
+
+
+class SuggestIndex:
+    """
+    Sorted array of normalized titles and author names for autocomplete.
+    A lookup is two bisects plus a short scan, so it never touches MongoDB.
+
+    - Built lazily from the books collection on the first lookup.
+    - add_book (hooked into Book.add_new_book) inserts new entries in place, and
+      sync picks up books whose content other worker processes changed. A book's
+      previous entries are dropped whenever it is indexed again (e.g. retitled).
+    - Titles are also indexed without a leading article ('The Door...' matches 'door').
+    - Entries are kept per book, so books sharing a title are all suggested; an author
+      of several books is suggested once.
+    """
+
+    ARTICLES = ('the ', 'a ', 'an ')
+
+    def __init__(self, sync_interval_seconds=30):
+        self.sync_interval_seconds = sync_interval_seconds
+        self._lock = threading.RLock()
+        self._entries = [] # Sorted (normalized key, kind, display text, book id) tuples
+        self._book_entries = {} # book id -> that book's entries (to drop them when it is re-indexed)
+        self.indexed_until = None
+        self._last_sync = 0.0
+        self.is_built = False
+
+    def _entries_for(self, book):
+        book_id = str(book['_id'])
+        title = book.get('title') or ''
+        key = normalize_suggestion(title)
+        if key:
+            yield key, 'title', title, book_id
+            for article in self.ARTICLES:
+                if key.startswith(article):
+                    yield key[len(article):], 'title', title, book_id
+
+        authors = book.get('authors') or ([book['author']] if book.get('author') else [])
+        for author in authors:
+            key = normalize_suggestion(author)
+            if key:
+                yield key, 'author', author, book_id
+
+    def _add(self, book, keep_sorted):
+        book_id = str(book['_id'])
+        if book_id in self._book_entries:
+            self._remove(book_id)
+
+        entries = sorted(set(self._entries_for(book)))
+        self._book_entries[book_id] = entries
+        for entry in entries:
+            if keep_sorted:
+                insort(self._entries, entry)
+            else:
+                self._entries.append(entry)
+
+        updated_at = naive_utc(book.get('content_updated_at'))
+        if updated_at and (self.indexed_until is None or updated_at > self.indexed_until):
+            self.indexed_until = updated_at
+
+    def _remove(self, book_id):
+        for entry in self._book_entries.pop(book_id, ()):
+            position = bisect_left(self._entries, entry)
+            if position < len(self._entries) and self._entries[position] == entry:
+                del self._entries[position]
+
+    def build(self, books):
+        """Rebuilds the index from an iterable of book documents."""
+        with self._lock:
+            self._entries, self._book_entries, self.indexed_until = [], {}, None
+            for book in books:
+                self._add(book, keep_sorted=False)
+            self._entries.sort()
+            self._last_sync = time.monotonic()
+            self.is_built = True
+
+    def add_book(self, book):
+        """Adds (or replaces) the title and authors of a book (no-op until built)."""
+        with self._lock:
+            if self.is_built:
+                self._add(book, keep_sorted=True)
+
+    def sync(self, book_model):
+        """
+        Builds the index on first use, then re-indexes books whose content changed
+        since the last sync at most once every sync_interval_seconds.
+        """
+        if not self.is_built:
+            with self._lock:
+                if not self.is_built:
+                    self.build(book_model.iter_search_documents(include_description=False))
+            return
+        if time.monotonic() - self._last_sync < self.sync_interval_seconds:
+            return
+        with self._lock:
+            self._last_sync = time.monotonic()
+            for book in book_model.iter_search_documents(updated_after=self.indexed_until, include_description=False):
+                self._add(book, keep_sorted=True)
+
+    def suggest(self, prefix, limit=10):
+        """Returns up to limit {'text', 'type', 'book_id'} suggestions starting with prefix."""
+        key = normalize_suggestion(prefix)
+        if not key:
+            return []
+
+        suggestions = []
+        with self._lock:
+            position = bisect_left(self._entries, (key,))
+            while position < len(self._entries) and len(suggestions) < limit:
+                entry_key, kind, text, book_id = self._entries[position]
+                if not entry_key.startswith(key):
+                    break
+                # An author is one suggestion however many books they wrote
+                suggestion = {'text': text, 'type': kind, 'book_id': book_id if kind == 'title' else None}
+                if suggestion not in suggestions: # A title can match with and without its article
+                    suggestions.append(suggestion)
+                position += 1
+        return suggestions
@@ -0,0 +1,129 @@
+"""
+Fixtures: the app on an in-memory mongomock database seeded like `manage.py init`,
+and a counter of the collection operations (round trips to MongoDB) it makes.
+
+    pip install -r requirements-dev.txt
+    python -m pytest tests
+"""
+import os
+import sys
+
+from datetime import datetime, timedelta
+
+import mongomock
+import mongomock.aggregate
+import mongomock.filtering
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+from app import create_app
+from books_data import BOOKS
+from manage import SEED_USERS
+from models import ensure_all_indexes
+
+# Collection methods that each cost one round trip on a real server
+OPERATIONS = [
+    'find', 'find_one', 'aggregate', 'count_documents', 'estimated_document_count', 'distinct',
+    'find_one_and_update', 'insert_one', 'insert_many', 'update_one', 'update_many',
+    'replace_one', 'delete_one', 'delete_many', 'bulk_write'
+]
+
+MODEL_NAMES = ('book_model', 'hold_model', 'loan_model', 'user_model')
+
+# mongomock up to 4.3 knows {'$type': 'null'} but does not implement it (TYPE_MAP['null'] is None);
+# the active loan queries and the one_active_loan index use it
+MONGOMOCK_VERSION = tuple(int(part) for part in mongomock.__version__.split('.')[:2])
+NEEDS_NULL_TYPE = MONGOMOCK_VERSION <= (4, 3) and mongomock.filtering.TYPE_MAP.get('null', False) is None
+# It also cannot add milliseconds to a date in an aggregation expression, which the
+# pipeline updates of the renewals and returns do (capped_new_loan_date_expression)
+NEEDS_DATE_ARITHMETIC = MONGOMOCK_VERSION <= (4, 3)
+
+
+def add_date_arithmetic(monkeypatch):
+    """Teaches mongomock's $add (date + milliseconds) and $subtract (date - date, in milliseconds)."""
+    parser = mongomock.aggregate._Parser
+    arithmetic = parser._handle_arithmetic_operator
+
+    def handle_arithmetic_operator(self, operator, values):
+        if operator in ('$add', '$subtract'):
+            parsed = list(self.parse_many(values))
+            dates = [value for value in parsed if isinstance(value, datetime)]
+            if operator == '$subtract' and len(dates) == 2:
+                return (parsed[0] - parsed[1]).total_seconds() * 1000
+            if operator == '$add' and len(dates) == 1:
+                return dates[0] + timedelta(milliseconds=sum(value for value in parsed if value is not dates[0]))
+        return arithmetic(self, operator, values)
+
+    monkeypatch.setattr(parser, '_handle_arithmetic_operator', handle_arithmetic_operator)
+
+
+class QueryCounter:
+    """Records (collection name, method) for every collection operation the app calls."""
+
+    def __init__(self):
+        self.calls = []
+        # mongomock implements some methods with others (find_one calls find); only the outer call counts
+        self._depth = 0
+
+    def wrap(self, method_name, method):
+        def counted(collection, *args, **kwargs):
+            if not self._depth:
+                self.calls.append((collection.name, method_name))
+            self._depth += 1
+            try:
+                return method(collection, *args, **kwargs)
+            finally:
+                self._depth -= 1
+        return counted
+
+    def clear(self):
+        self.calls = []
+
+    def __len__(self):
+        return len(self.calls)
+
+
+@pytest.fixture
+def app(monkeypatch):
+    if NEEDS_NULL_TYPE:
+        monkeypatch.setitem(mongomock.filtering.TYPE_MAP, 'null', lambda value: value is None)
+    if NEEDS_DATE_ARITHMETIC:
+        add_date_arithmetic(monkeypatch)
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(db, 'MongoClient', lambda *args, **kwargs: client)
+    app = create_app({'TESTING': True, 'WTF_CSRF_ENABLED': False})
+
+    models = {name: app.extensions['library'][name] for name in MODEL_NAMES}
+    ensure_all_indexes(models)
+    models['book_model'].seed_books(BOOKS)
+    models['user_model'].seed_users(SEED_USERS)
+    return app
+
+
+@pytest.fixture
+def models(app):
+    return {name: app.extensions['library'][name] for name in MODEL_NAMES}
+
+
+@pytest.fixture
+def queries(app, monkeypatch):
+    counter = QueryCounter()
+    for method_name in OPERATIONS:
+        monkeypatch.setattr(mongomock.Collection, method_name,
+                            counter.wrap(method_name, getattr(mongomock.Collection, method_name)))
+    return counter
+
+
+@pytest.fixture
+def client(app, models):
+    """A test client logged in as the seeded non-admin user."""
+    user = models['user_model'].find_user_by_email('poh@lib.sg')
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = str(user['_id'])
+        session['name'] = user.get('name')
+        session['email'] = user['email']
+        session['is_admin'] = False
+    return client
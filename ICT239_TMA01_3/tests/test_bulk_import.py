@@ -0,0 +1,55 @@
+"""Bulk import: New Book form validation, ISBN upserts and dedupe, and the rejected-rows file."""
+import csv
+import io
+import json
+
+from bulk_import import ErrorFile, run_import
+
+HEADER = 'title,authors,cover_image,isbn,publication_year,genres,publisher,description,page_count,category,copies,available\n'
+
+FEED = HEADER + (
+    'Book A,Ann One;Bob Two,a.jpg,111,2001,Fantasy;Magic,P,Desc one.,100,Adult,3,3\n'
+    'Book B,,b.jpg,222,2001,Fantasy,P,Desc.,100,Adult,1,1\n'
+    'Book A2,Ann One,a.jpg,111,2001,Fantasy,P,New desc.,120,Teens,3,3\n'
+    'Book D,Dee,d.jpg,,,Poetry,,Desc.,,Children,2,2\n'
+)
+
+
+def import_feed(models, feed, path):
+    with ErrorFile(str(path)) as errors:
+        report = run_import(io.StringIO(feed), 'csv', models['book_model'], batch_size=10, error_writer=errors)
+    return report, errors.created
+
+
+def test_import_dedupes_isbns_and_writes_the_rejected_rows(models, tmp_path):
+    before = models['book_model'].collection.count_documents({})
+
+    report, created = import_feed(models, FEED, tmp_path / 'errors.csv')
+
+    assert (report.rows, report.inserted, report.updated) == (4, 2, 0)
+    assert (report.invalid, report.duplicates, report.failed) == (1, 1, 0)
+    assert models['book_model'].collection.count_documents({}) == before + 2
+    # The later row with ISBN 111 wins
+    assert models['book_model'].collection.find_one({'isbn': '111'})['title'] == 'Book A2'
+
+    assert created
+    with open(tmp_path / 'errors.csv', newline='') as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == ['row_number', 'error', 'record']
+    rejected = {int(row_number): (error, json.loads(record)['title']) for row_number, error, record in rows[1:]}
+    assert sorted(rejected) == [2, 3]
+    assert rejected[2] == ("Duplicate ISBN 111: superseded by row 4.", 'Book A')
+    # Book B has no author, which the New Book form requires
+    assert rejected[3] == ('authors: At least one author name is required.', 'Book B')
+
+
+def test_reimport_updates_by_isbn_and_creates_no_error_file(models, tmp_path):
+    feed = HEADER + 'Book A,Ann One,a.jpg,111,2001,Fantasy,P,Desc one.,100,Adult,3,3\n'
+    import_feed(models, feed, tmp_path / 'first.csv')
+
+    report, created = import_feed(models, feed.replace('Desc one.', 'Desc two.'), tmp_path / 'second.csv')
+
+    assert (report.inserted, report.updated, report.invalid, report.duplicates) == (0, 1, 0, 0)
+    assert models['book_model'].collection.count_documents({'isbn': '111'}) == 1
+    assert not created
+    assert not (tmp_path / 'second.csv').exists()
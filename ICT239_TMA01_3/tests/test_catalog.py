@@ -0,0 +1,55 @@
+"""Catalog pages: keyset pagination visits every book exactly once, in sort order."""
+from bson.objectid import ObjectId
+
+import pytest
+
+
+def all_pages(models, sort, page_size):
+    books, cursor = models['book_model'].get_books_page('All', page_size, None, sort=sort)
+    while cursor:
+        page, cursor = models['book_model'].get_books_page('All', page_size, cursor, sort=sort)
+        books += page
+    return books
+
+
+@pytest.mark.parametrize('page_size', [1, 2, 3])
+def test_popular_pages_include_books_without_a_popularity(models, page_size):
+    collection = models['book_model'].collection
+    ids = sorted(book['_id'] for book in collection.find({}, {'_id': 1}))
+    # Two scored books, one at 0 and one written before popularity existed
+    for book_id, popularity in zip(ids, [5, 2, 0]):
+        collection.update_one({'_id': book_id}, {'$set': {'popularity': popularity}})
+    collection.update_one({'_id': ids[3]}, {'$unset': {'popularity': ''}})
+    models['book_model'].cache.clear()
+
+    books = all_pages(models, 'popular', page_size)
+    assert [ObjectId(book['id']) for book in books] == ids
+
+
+def test_title_pages_are_in_title_order(models):
+    books = all_pages(models, 'title', 1)
+    titles = [book['title'] for book in books]
+    assert titles == sorted(titles)
+    assert len(titles) == models['book_model'].collection.count_documents({})
+
+
+def test_popularity_refresh_sets_missing_popularity(models):
+    collection = models['book_model'].collection
+    book = collection.find_one()
+    collection.update_one({'_id': book['_id']}, {'$unset': {'popularity': ''}})
+
+    models['book_model'].update_popularity({})
+    assert collection.find_one({'_id': book['_id']})['popularity'] == 0
+
+
+def test_bulk_upsert_keeps_or_sets_popularity(models):
+    book_model = models['book_model']
+    document = book_model.build_book_document('Fresh', ['Ann'], 'f.jpg', '999', 2001, [], 'P', 'Desc.', 10, 'Adult', 1, 1)
+    book_model.bulk_upsert_books([dict(document)])
+    book_model.collection.update_one({'isbn': '999'}, {'$unset': {'popularity': ''}})
+    book_model.bulk_upsert_books([dict(document)])
+    assert book_model.collection.find_one({'isbn': '999'})['popularity'] == 0
+
+    book_model.collection.update_one({'isbn': '999'}, {'$set': {'popularity': 7}})
+    book_model.bulk_upsert_books([dict(document)])
+    assert book_model.collection.find_one({'isbn': '999'})['popularity'] == 7
@@ -0,0 +1,94 @@
+"""
+The hold queue: returned copies go to the oldest waiting hold, stay reserved
+until collected or expired, and only reach the shelf when nobody is waiting.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+from bson.objectid import ObjectId
+
+from models import HOLD_WAITING, HOLD_READY, HOLD_FULFILLED, HOLD_EXPIRED
+
+
+def user_ids(models):
+    """The ids of the seeded users and a third one registered here, in that order."""
+    models['user_model'].register_user('reader@lib.sg', 'pw123456', 'Reader')
+    return [str(models['user_model'].find_user_by_email(email)['_id'])
+            for email in ('admin@lib.sg', 'poh@lib.sg', 'reader@lib.sg')]
+
+
+@pytest.fixture
+def single_copy(models):
+    """Two seed books reduced to a single copy each."""
+    books = [book['id'] for book in models['book_model'].get_books_page('All', 2, None)[0]]
+    models['book_model'].collection.update_many(
+        {'_id': {'$in': [ObjectId(book_id) for book_id in books]}}, {'$set': {'copies': 1, 'available': 1}}
+    )
+    return books
+
+
+def available(models, book_id):
+    return models['book_model'].collection.find_one({'_id': ObjectId(book_id)})['available']
+
+
+def hold_status(models, book_id, user_id):
+    return models['hold_model'].collection.find_one({'book_id': book_id, 'user_id': user_id})['status']
+
+
+def borrow(models, book_id, user_id):
+    success, message = models['loan_model'].create_loan(book_id, user_id)
+    assert success, message
+    return str(models['loan_model'].collection.find_one({'book_id': book_id, 'user_id': user_id, 'return_date': None})['_id'])
+
+
+def test_return_with_a_waiting_hold_reserves_the_copy(models, single_copy):
+    book_id = single_copy[0]
+    lender, first, second = user_ids(models)
+    loan_id = borrow(models, book_id, lender)
+    assert models['hold_model'].place_hold(book_id, first)[0]
+    assert models['hold_model'].place_hold(book_id, second)[0]
+
+    assert models['loan_model'].return_loan(loan_id)[0]
+    assert available(models, book_id) == 0
+    assert hold_status(models, book_id, first) == HOLD_READY
+    assert hold_status(models, book_id, second) == HOLD_WAITING
+
+    # Only the user the copy is reserved for can borrow it
+    assert not models['loan_model'].create_loan(book_id, second)[0]
+    borrow(models, book_id, first)
+    assert hold_status(models, book_id, first) == HOLD_FULFILLED
+    assert available(models, book_id) == 0
+
+
+def test_uncollected_hold_expires_and_passes_the_copy_on(models, single_copy):
+    book_id = single_copy[0]
+    lender, first, second = user_ids(models)
+    loan_id = borrow(models, book_id, lender)
+    models['hold_model'].place_hold(book_id, first)
+    models['hold_model'].place_hold(book_id, second)
+    models['loan_model'].return_loan(loan_id)
+    after_pickup = datetime.now() + timedelta(days=models['hold_model'].pickup_days, hours=1)
+
+    assert models['hold_model'].expire_ready_holds(datetime.now()) == 0
+    assert models['hold_model'].expire_ready_holds(after_pickup) == 1
+    assert hold_status(models, book_id, first) == HOLD_EXPIRED
+    assert hold_status(models, book_id, second) == HOLD_READY
+    assert available(models, book_id) == 0
+
+    # Nobody is left waiting: the next expiry puts the copy back on the shelf
+    models['hold_model'].collection.update_one({'user_id': second}, {'$set': {'expires_at': datetime.now()}})
+    assert models['hold_model'].expire_ready_holds(after_pickup) == 1
+    assert available(models, book_id) == 1
+
+
+def test_bulk_return_reserves_only_the_held_copies(models, single_copy):
+    held, free = single_copy
+    lender, first, _ = user_ids(models)
+    loans = [borrow(models, book_id, lender) for book_id in single_copy]
+    models['hold_model'].place_hold(held, first)
+
+    outcomes = models['loan_model'].return_loans(loans, lender)
+    assert all(success for success, _ in outcomes.values())
+    assert available(models, held) == 0
+    assert hold_status(models, held, first) == HOLD_READY
+    assert available(models, free) == 1
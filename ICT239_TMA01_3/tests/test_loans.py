@@ -0,0 +1,140 @@
+"""
+Loan state changes: each guarded update changes the loan once, and the book's
+available count follows only the changes that actually happened.
+"""
+import pytest
+from bson.objectid import ObjectId
+
+from models import MAX_RENEWS
+
+
+@pytest.fixture
+def user_id(models):
+    return str(models['user_model'].find_user_by_email('poh@lib.sg')['_id'])
+
+
+@pytest.fixture
+def book_id(models):
+    return models['book_model'].get_books_page('All', 1, None)[0][0]['id']
+
+
+def available(models, book_id):
+    return models['book_model'].collection.find_one({'_id': ObjectId(book_id)})['available']
+
+
+def borrow(models, book_id, user_id):
+    """Creates a loan and returns its id."""
+    success, message = models['loan_model'].create_loan(book_id, user_id)
+    assert success, message
+    return str(models['loan_model'].collection.find_one({'book_id': book_id, 'user_id': user_id, 'return_date': None})['_id'])
+
+
+# --- Single renew and return (guarded find_one_and_update) ---
+
+def test_second_return_does_not_release_the_copy_again(models, book_id, user_id):
+    before = available(models, book_id)
+    loan_id = borrow(models, book_id, user_id)
+    assert available(models, book_id) == before - 1
+
+    assert models['loan_model'].return_loan(loan_id) == (True, "Book successfully returned!")
+    assert models['loan_model'].return_loan(loan_id) == (False, "This loan has already been marked as returned.")
+    assert available(models, book_id) == before
+
+
+def test_renewal_stops_at_the_limit(models, book_id, user_id):
+    loan_id = borrow(models, book_id, user_id)
+    for _ in range(MAX_RENEWS):
+        assert models['loan_model'].renew_loan(loan_id)[0]
+
+    success, message = models['loan_model'].renew_loan(loan_id)
+    assert not success
+    assert message.startswith('Renewal limit reached')
+    assert models['loan_model'].collection.find_one({'_id': ObjectId(loan_id)})['renew_count'] == MAX_RENEWS
+
+
+def test_returned_loan_cannot_be_renewed(models, book_id, user_id):
+    loan_id = borrow(models, book_id, user_id)
+    models['loan_model'].return_loan(loan_id)
+
+    assert models['loan_model'].renew_loan(loan_id) == (False, "Cannot renew a loan that has already been returned.")
+    assert models['loan_model'].collection.find_one({'_id': ObjectId(loan_id)})['renew_count'] == 0
+
+
+# --- Borrowing (mongomock has no transactions, so this is the compensating-delete path) ---
+
+def test_borrowing_an_unavailable_book_leaves_no_loan(models, book_id, user_id):
+    models['book_model'].collection.update_one({'_id': ObjectId(book_id)}, {'$set': {'available': 0}})
+
+    success, _ = models['loan_model'].create_loan(book_id, user_id)
+    assert not success
+    assert models['loan_model'].collection.count_documents({}) == 0
+    assert available(models, book_id) == 0
+
+
+def test_failed_take_copy_deletes_the_inserted_loan(models, book_id, user_id, monkeypatch):
+    def take_copy(book_id, session=None):
+        raise RuntimeError('connection reset')
+    monkeypatch.setattr(models['book_model'], 'take_copy', take_copy)
+    before = available(models, book_id)
+
+    success, message = models['loan_model'].create_loan(book_id, user_id)
+    assert not success
+    assert 'connection reset' in message
+    assert models['loan_model'].collection.count_documents({}) == 0
+    assert available(models, book_id) == before
+
+
+def test_second_active_loan_of_a_book_is_refused(models, book_id, user_id):
+    before = available(models, book_id)
+    borrow(models, book_id, user_id)
+
+    assert models['loan_model'].create_loan(book_id, user_id) == (
+        False, "You already have an active, unreturned loan for this book."
+    )
+    assert models['loan_model'].collection.count_documents({'book_id': book_id}) == 1
+    assert available(models, book_id) == before - 1
+
+
+# --- Bulk renew and return (one bulk_write, one outcome per loan) ---
+
+def book_ids(models, count):
+    return [book['id'] for book in models['book_model'].get_books_page('All', count, None)[0]]
+
+
+def test_bulk_renew_reports_each_loan(models, user_id):
+    first, second, third = book_ids(models, 3)
+    at_limit = borrow(models, first, user_id)
+    models['loan_model'].collection.update_one({'_id': ObjectId(at_limit)}, {'$set': {'renew_count': MAX_RENEWS}})
+    renewable = borrow(models, second, user_id)
+    returned = borrow(models, third, user_id)
+    models['loan_model'].return_loan(returned)
+    unknown = str(ObjectId())
+
+    outcomes = models['loan_model'].renew_loans([at_limit, renewable, returned, unknown, 'not-an-id'], user_id)
+
+    assert list(outcomes) == [at_limit, renewable, returned, unknown, 'not-an-id']
+    assert outcomes[at_limit] == (False, f"Renewal limit reached ({MAX_RENEWS}). Please return the book.")
+    assert outcomes[renewable][0]
+    assert outcomes[returned] == (False, "Cannot renew a loan that has already been returned.")
+    assert outcomes[unknown] == outcomes['not-an-id'] == (False, "Loan not found.")
+    renew_counts = {str(loan['_id']): loan['renew_count'] for loan in models['loan_model'].collection.find()}
+    assert renew_counts == {at_limit: MAX_RENEWS, renewable: 1, returned: 0}
+
+
+def test_bulk_return_releases_only_the_loans_it_returned(models, user_id):
+    first, second = book_ids(models, 2)
+    before = {book_id: available(models, book_id) for book_id in (first, second)}
+    active = borrow(models, first, user_id)
+    returned = borrow(models, second, user_id)
+    models['loan_model'].return_loan(returned)
+
+    other_user = str(models['user_model'].find_user_by_email('admin@lib.sg')['_id'])
+    outcomes = models['loan_model'].return_loans([active, returned], other_user)
+    assert outcomes == {active: (False, "Loan not found."), returned: (False, "Loan not found.")}
+
+    outcomes = models['loan_model'].return_loans([active, returned], user_id)
+    assert outcomes == {
+        active: (True, "Book successfully returned!"),
+        returned: (False, "This loan has already been marked as returned.")
+    }
+    assert {book_id: available(models, book_id) for book_id in (first, second)} == before
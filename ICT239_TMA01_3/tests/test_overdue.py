@@ -0,0 +1,51 @@
+"""Overdue flags and events through the loan's life: flagged once per missed due date."""
+from datetime import datetime, timedelta
+
+import pytest
+from bson.objectid import ObjectId
+
+
+@pytest.fixture
+def scanner(app):
+    scanner = app.extensions['library']['overdue_scanner']
+    scanner.ensure_indexes()
+    return scanner
+
+
+def overdue_loan(models, user_id, days_late=3):
+    """Creates a loan of a seed book whose due date passed days_late days ago. Returns its id."""
+    book_id = models['book_model'].get_books_page('All', 1, None)[0][0]['id']
+    models['loan_model'].create_loan(book_id, user_id, borrow_date=datetime.now() - timedelta(days=14 + days_late))
+    return str(models['loan_model'].collection.find_one({'book_id': book_id})['_id'])
+
+
+def user_id(models):
+    return str(models['user_model'].find_user_by_email('poh@lib.sg')['_id'])
+
+
+def test_scan_flags_an_overdue_loan_once(models, scanner):
+    loan_id = overdue_loan(models, user_id(models))
+
+    assert scanner.scan()['events'] == 1
+    assert scanner.scan()['events'] == 0
+    loan = models['loan_model'].collection.find_one({'_id': ObjectId(loan_id)})
+    assert loan['overdue'] is True
+
+
+@pytest.mark.parametrize('bulk', [False, True])
+def test_renewal_clears_the_flag_and_a_new_miss_raises_a_new_event(models, scanner, bulk):
+    uid = user_id(models)
+    loan_id = overdue_loan(models, uid, days_late=1)
+    scanner.scan()
+
+    if bulk:
+        assert models['loan_model'].renew_loans([loan_id], uid)[loan_id][0]
+    else:
+        assert models['loan_model'].renew_loan(loan_id)[0]
+    loan = models['loan_model'].collection.find_one({'_id': ObjectId(loan_id)})
+    assert 'overdue' not in loan and 'overdue_since' not in loan
+
+    # The renewed loan misses its new due date too
+    models['loan_model'].collection.update_one({'_id': loan['_id']}, {'$set': {'due_date': datetime.now() - timedelta(hours=1)}})
+    assert scanner.scan()['events'] == 1
+    assert scanner.events_collection.count_documents({'loan_id': loan['_id']}) == 2
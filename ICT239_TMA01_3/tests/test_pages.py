@@ -0,0 +1,25 @@
+"""What the pages offer the logged-in user."""
+
+
+def session_user_id(client):
+    with client.session_transaction() as session:
+        return session['user_id']
+
+
+def test_book_detail_offers_a_loan_of_a_book_not_on_loan(client, models):
+    book_id = models['book_model'].get_books_page('All', 1, None)[0][0]['id']
+
+    page = client.get(f'/book/{book_id}').data
+    assert b'Make a loan' in page
+    assert b'Return in My Loans' not in page
+
+
+def test_book_detail_of_a_book_on_loan_points_to_my_loans(client, models):
+    book_id = models['book_model'].get_books_page('All', 1, None)[0][0]['id']
+    assert models['loan_model'].create_loan(book_id, session_user_id(client))[0]
+
+    page = client.get(f'/book/{book_id}').data
+    assert b'On loan' in page
+    assert b'Return in My Loans' in page
+    assert b'Make a loan' not in page
+    assert b'Place hold' not in page
@@ -0,0 +1,97 @@
+"""
+The number of MongoDB round trips per page is fixed: it must not grow with the
+number of books listed or loans shown (no N+1 lookups).
+"""
+from datetime import datetime, timedelta
+
+
+def book_ids(models, count):
+    books, _ = models['book_model'].get_books_page('All', count, None)
+    return [book['id'] for book in books]
+
+
+def add_returned_loans(models, user_id, count):
+    """Inserts count returned loans of the seed books, oldest last."""
+    ids = book_ids(models, 10)
+    now = datetime.now()
+    models['loan_model'].collection.insert_many([{
+        'book_id': ids[index % len(ids)],
+        'user_id': user_id,
+        'borrow_date': now - timedelta(days=30 + index),
+        'due_date': now - timedelta(days=16 + index),
+        'return_date': now - timedelta(days=20 + index),
+        'renew_count': 0,
+        'updated_at': now
+    } for index in range(count)])
+
+
+def session_user_id(client):
+    with client.session_transaction() as session:
+        return session['user_id']
+
+
+# --- My Loans ---
+
+def test_my_loans_queries_do_not_grow_with_loans(client, models, queries):
+    user_id = session_user_id(client)
+    for book_id in book_ids(models, 3):
+        assert models['loan_model'].create_loan(book_id, user_id)[0]
+
+    queries.clear()
+    response = client.get('/my_loans')
+    assert response.status_code == 200
+    few_loans = list(queries.calls)
+
+    add_returned_loans(models, user_id, 40)
+    queries.clear()
+    response = client.get('/my_loans')
+    assert response.status_code == 200
+
+    # The loans, the archived loans and one batched read of their books
+    assert queries.calls == few_loans
+    assert queries.calls == [('loans', 'find'), ('loans_archive', 'aggregate'), ('books', 'find')]
+
+
+# --- Book Titles ---
+
+def test_catalog_page_queries(client, queries):
+    response = client.get('/books_titles')
+    assert response.status_code == 200
+    # Revision, the user's active loans, the page, the live availability of its cards,
+    # the title count and the facets
+    assert len(queries) == 6
+
+    queries.clear()
+    response = client.get('/books_titles')
+    assert response.status_code == 200
+    # Page, count and facets come from the cache; only the revision and availability are read
+    assert queries.calls == [('catalog_meta', 'find_one'), ('books', 'find')]
+
+
+def test_catalog_page_not_modified_reads_only_the_revision(client, queries):
+    etag = client.get('/books_titles').headers['ETag']
+
+    queries.clear()
+    response = client.get('/books_titles', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert queries.calls == [('catalog_meta', 'find_one')]
+
+
+# --- Book detail ---
+
+def test_book_detail_queries(client, models, queries):
+    book_id = book_ids(models, 1)[0]
+
+    queries.clear()
+    response = client.get(f'/book/{book_id}')
+    assert response.status_code == 200
+    # Revision and availability, the user's active loans (then kept in the session),
+    # recommendations, then the book itself
+    assert queries.calls == [('books', 'find_one'), ('loans', 'find'), ('book_recommendations', 'find_one'),
+                             ('books', 'find_one')]
+
+    etag = response.headers['ETag']
+    queries.clear()
+    response = client.get(f'/book/{book_id}', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert queries.calls == [('books', 'find_one')]
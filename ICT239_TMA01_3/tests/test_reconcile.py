@@ -0,0 +1,51 @@
+"""Inventory reconciliation: drift is found and fixed, changes still settling are left alone."""
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from bson.objectid import ObjectId
+
+import reconcile
+
+
+@pytest.fixture(params=['UTC', 'Asia/Singapore', 'America/New_York'])
+def local_timezone(request, monkeypatch):
+    """Runs the test with the host's local time in several zones (loans store local times)."""
+    monkeypatch.setenv('TZ', request.param)
+    time.tzset()
+    yield request.param
+    monkeypatch.undo()
+    time.tzset()
+
+
+def settle_books(models):
+    """Backdates the last write of every book (seeded just now) past the settle window."""
+    an_hour_ago = datetime.now(timezone.utc) - timedelta(hours=1)
+    models['book_model'].collection.update_many({}, {'$set': {'updated_at': an_hour_ago}})
+
+
+def test_fix_corrects_a_drifted_count(models, local_timezone, capsys):
+    book_id = models['book_model'].get_books_page('All', 1, None)[0][0]['id']
+    book = models['book_model'].collection.find_one({'_id': ObjectId(book_id)})
+    models['book_model'].collection.update_one({'_id': book['_id']}, {'$set': {'available': book['available'] - 1}})
+    settle_books(models)
+
+    assert reconcile.main(['--fix']) == 0
+    assert '"drifted": 1, "fixed": 1' in capsys.readouterr().out
+    assert models['book_model'].collection.find_one({'_id': book['_id']})['available'] == book['available']
+
+
+def test_book_with_a_loan_changed_just_now_is_left_to_the_next_run(models, local_timezone):
+    book_id = models['book_model'].get_books_page('All', 1, None)[0][0]['id']
+    user_id = str(models['user_model'].find_user_by_email('poh@lib.sg')['_id'])
+    assert models['loan_model'].create_loan(book_id, user_id)[0]
+    settle_books(models)
+    reconciler = reconcile.InventoryReconciler(models['book_model'].connection, models['book_model'])
+
+    stats = reconciler.reconcile(full=True)
+    assert (stats['checked'], stats['skipped_recent'], stats['drifted']) == (3, 1, 0)
+
+    # Once the loan has settled, the book is checked by the incremental run
+    later = datetime.now(timezone.utc) + timedelta(seconds=reconciler.settle_seconds + 1)
+    stats = reconciler.reconcile(now=later)
+    assert (stats['checked'], stats['skipped_recent'], stats['drifted']) == (1, 0, 0)